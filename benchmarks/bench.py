@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Benchmarks of the backup pipeline on synthetic datasets.
+
+Every profile describes the shape of a tree: how many files, how big, how deep and how much of the
+data compresses. Trees are generated from a seed, so the same profile and seed always give the same
+data, and are kept in the work directory between runs. For every profile the phases are run in
+isolation (walk, prepare, copy, compress, retention) and then the whole pipeline, and the results
+are written as JSON. --compare checks them against earlier results and fails on regressions.
+
+    python3 benchmarks/bench.py --profiles tiny-files mixed --fake-7z --output results.json
+    python3 benchmarks/bench.py --fake-7z --compare results.json --threshold 15
+
+--fake-7z runs a stand-in instead of 7z, so everything works offline and without 7z installed: it
+reads every input file, like 7z does, but writes a small archive instead of compressing."""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from locbkp.utils.utils import get_logger
+
+version = "bench"
+logger = get_logger(level=logging.WARNING, logpath=os.path.join(tempfile.gettempdir(), "LocBkp_bench.log"),
+                    redefine_default=True)
+
+from locbkp.Backup import Backup
+from locbkp.utils.dictionary import BACKUP_FILENAME_TEMPLATE, DATE_FORMAT, DESTINATION_DIRECTORY, BACKUP_LIST, \
+    BACKUP_NAME, RETENTION, COPY_THREADS, COMPRESSION_ENGINE, METRICS, PROGRESS_INTERVAL, P7Z_PATH
+from locbkp.utils.utils import scan_trees
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# files: number of files, size: (min, max) file size in bytes, depth and fanout: shape of the
+# directory tree, compressible: share of files with text-like data, the rest is random
+profiles = {
+    "tiny-files": {"files": 20000, "size": (16, 4096), "depth": 4, "fanout": 8, "compressible": 0.8},
+    "huge-files": {"files": 4, "size": (128 * 1024 * 1024, 256 * 1024 * 1024), "depth": 1, "fanout": 1,
+                   "compressible": 0.5},
+    "deep": {"files": 5000, "size": (512, 64 * 1024), "depth": 24, "fanout": 2, "compressible": 0.8},
+    "mixed": {"files": 5000, "size": (16, 8 * 1024 * 1024), "depth": 6, "fanout": 4, "compressible": 0.5}
+}
+phases = ["walk", "prepare", "copy", "compress", "retention", "full"]
+# Backups in the destination directory for the retention benchmark
+retention_backups = 200
+
+fake_7z_source = '''#!{python}
+"""Stand-in for 7z: reads every input file and writes a small archive."""
+import glob, os, sys, hashlib
+args = sys.argv[1:]
+archive = args[args.index("-t7z") + 1]
+inputs = []
+stdin_name = None
+for arg in args[args.index("-t7z") + 2:]:
+    if arg.startswith("@"):
+        with open(arg[1:], encoding="utf-8") as list_file:
+            inputs.extend(line.rstrip("\\n") for line in list_file if line.strip())
+    elif arg.startswith("-si"):
+        stdin_name = arg[3:]
+    elif not arg.startswith("-"):
+        inputs.extend(glob.glob(arg) if "*" in arg else [arg])
+digest = hashlib.sha256()
+for apath in inputs:
+    for root, _, names in os.walk(apath) if os.path.isdir(apath) else [("", [], [apath])]:
+        for name in names:
+            try:
+                with open(os.path.join(root, name), "rb") as afile:
+                    for block in iter(lambda: afile.read(1024 * 1024), b""):
+                        digest.update(block)
+            except OSError:
+                pass
+if stdin_name:
+    digest.update(sys.stdin.buffer.read())
+if any(arg.startswith("-v") for arg in args):
+    archive += ".001"
+with open(archive, "ab") as archive_file:
+    archive_file.write(digest.digest() * 32)
+print("100%")
+print("Everything is Ok")
+'''
+
+
+def get_dataset_path(workdir, name, profile, seed):
+    shape = "{files}f_{size[0]}-{size[1]}b_{depth}d_{fanout}w_{compressible}c".format(**profile)
+    return os.path.join(workdir, "data", "{}_{}_s{}".format(name, shape, seed))
+
+
+def get_directories(rng, profile, root):
+    """Directories of a tree with the given depth and fanout, as paths under root."""
+    directories = [root]
+    level = [root]
+    for _ in range(profile["depth"] - 1):
+        level = [os.path.join(parent, "d{}".format(num)) for parent in level for num in range(profile["fanout"])]
+        # Wide trees are thinned, so deep profiles do not explode
+        if len(level) > profile["files"]:
+            level = rng.sample(level, profile["files"])
+        directories.extend(level)
+    return directories
+
+
+def write_data(afile, rng, size, compressible):
+    if compressible:
+        # Text from a small vocabulary: compresses well, but is not one repeated block
+        words = [b"backup", b"archive", b"volume", b"retention", b"index", b"chunk", b"manifest", b"journal"]
+        text = b" ".join(rng.choice(words) for _ in range(16 * 1024))
+    written = 0
+    while written < size:
+        block_size = min(1024 * 1024, size - written)
+        if compressible:
+            offset = rng.randrange(len(text))
+            block = (text[offset:] + text * (block_size // len(text) + 1))[:block_size]
+        else:
+            block = rng.randbytes(block_size)
+        afile.write(block)
+        written += block_size
+
+
+def generate_dataset(path, profile, seed):
+    """Generates the tree once: a complete one has a marker file with its description."""
+    marker = os.path.join(path, ".dataset.json")
+    if os.path.exists(marker):
+        with open(marker, "r") as marker_file:
+            return json.load(marker_file)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    rng = random.Random(seed)
+    root = os.path.join(path, "tree")
+    directories = get_directories(rng, profile, root)
+    for adir in directories:
+        os.makedirs(adir, exist_ok=True)
+    total_size = 0
+    for num in range(profile["files"]):
+        size = rng.randint(*profile["size"])
+        compressible = rng.random() < profile["compressible"]
+        with open(os.path.join(rng.choice(directories), "f{}.{}".format(num, "txt" if compressible else "bin")),
+                  "wb") as afile:
+            write_data(afile, rng, size, compressible)
+        total_size += size
+    dataset = {"root": root, "files": profile["files"], "dirs": len(directories), "bytes": total_size}
+    with open(marker, "w") as marker_file:
+        json.dump(dataset, marker_file)
+    return dataset
+
+
+def write_fake_7z(workdir):
+    fake_7z_path = os.path.join(workdir, "fake7z")
+    with open(fake_7z_path, "w") as fake_7z:
+        fake_7z.write(fake_7z_source.format(python=sys.executable))
+    os.chmod(fake_7z_path, 0o755)
+    return fake_7z_path
+
+
+def write_backup_list(workdir, name, root, args, fake_7z_path):
+    destdir = os.path.join(workdir, "dest", name)
+    if os.path.exists(destdir):
+        shutil.rmtree(destdir)
+    os.makedirs(destdir)
+    backup_list = {DESTINATION_DIRECTORY: destdir, BACKUP_LIST: [root], BACKUP_NAME: "bench_{}".format(name),
+                   RETENTION: retention_backups // 2, COPY_THREADS: args.copy_threads,
+                   COMPRESSION_ENGINE: args.engine, METRICS: False, PROGRESS_INTERVAL: 3600}
+    if fake_7z_path:
+        backup_list[P7Z_PATH] = fake_7z_path
+    backup_list_path = os.path.join(workdir, "bench_{}.json".format(name))
+    with open(backup_list_path, "w") as backup_list_file:
+        json.dump(backup_list, backup_list_file)
+    return backup_list_path, destdir
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def cleanup_backup(backup):
+    for apath in (backup.packing_directory, backup.archive_path, backup.manifest_path):
+        if os.path.isdir(apath):
+            shutil.rmtree(apath)
+        elif os.path.exists(apath):
+            os.remove(apath)
+
+
+def clear_destination(destdir):
+    """Removes the archives and the catalog in .locbkp, which would list them otherwise."""
+    for afile in os.listdir(destdir):
+        apath = os.path.join(destdir, afile)
+        if os.path.isdir(apath):
+            shutil.rmtree(apath)
+        else:
+            os.remove(apath)
+
+
+def bench_walk(backup_list_path, root):
+    return timed(lambda: scan_trees([root]))[0]
+
+
+def bench_prepare(backup_list_path, root):
+    return timed(lambda: Backup(backup_list_path))[0]
+
+
+def bench_copy(backup_list_path, root):
+    backup = Backup(backup_list_path)
+    try:
+        backup.backup_empty_dirs(backup.dirs_to_backup)
+        return timed(lambda: backup.backup_files(backup.files_to_backup))[0]
+    finally:
+        cleanup_backup(backup)
+
+
+def bench_compress(backup_list_path, root):
+    backup = Backup(backup_list_path)
+    try:
+        backup.backup_empty_dirs(backup.dirs_to_backup)
+        backup.backup_files(backup.files_to_backup)
+        backup.size_before_compression = backup.backup_size / 1024 / 1024
+        return timed(lambda: backup.compress(None))[0]
+    finally:
+        cleanup_backup(backup)
+
+
+def bench_retention(backup_list_path, root):
+    backup = Backup(backup_list_path)
+    destdir = backup.backup_list[DESTINATION_DIRECTORY]
+    date = backup.time_start.timestamp()
+    for num in range(retention_backups):
+        name = BACKUP_FILENAME_TEMPLATE.format(backup.backup_list[BACKUP_NAME],
+                                               time.strftime(DATE_FORMAT, time.localtime(date - num * 3600)), "7z")
+        open(os.path.join(destdir, name), "wb").close()
+    try:
+        return timed(backup.handle_retention)[0]
+    finally:
+        clear_destination(destdir)
+
+
+def bench_full(backup_list_path, root):
+    backup = Backup(backup_list_path)
+    # start() prints the archive name
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, success = timed(backup.start)
+    if not success:
+        raise RuntimeError("backup failed")
+    record = backup.get_run_record()
+    destdir = backup.backup_list[DESTINATION_DIRECTORY]
+    clear_destination(destdir)
+    return seconds, {phase: record["phases"][phase] for phase in record["phases"]}
+
+
+phase_functions = {
+    "walk": bench_walk,
+    "prepare": bench_prepare,
+    "copy": bench_copy,
+    "compress": bench_compress,
+    "retention": bench_retention,
+    "full": bench_full
+}
+
+
+def summarize(runs):
+    return {"runs": [round(arun, 6) for arun in runs], "min": round(min(runs), 6),
+            "median": round(statistics.median(runs), 6), "mean": round(statistics.mean(runs), 6)}
+
+
+def run_profile(name, profile, args, fake_7z_path):
+    dataset_path = get_dataset_path(args.workdir, name, profile, args.seed)
+    print("{}: generating dataset...".format(name), flush=True)
+    generate_seconds, dataset = timed(lambda: generate_dataset(dataset_path, profile, args.seed))
+    print("{}: {} files, {} directories, {:.1f}Mb ({:.1f}s)".format(
+        name, dataset["files"], dataset["dirs"], dataset["bytes"] / 1024 / 1024, generate_seconds), flush=True)
+    backup_list_path, _ = write_backup_list(args.workdir, name, dataset["root"], args, fake_7z_path)
+    results = {}
+    for phase in args.phases:
+        runs = []
+        details = []
+        for _ in range(args.repeat):
+            seconds = phase_functions[phase](backup_list_path, dataset["root"])
+            if isinstance(seconds, tuple):
+                seconds, detail = seconds
+                details.append(detail)
+            runs.append(seconds)
+        results[phase] = summarize(runs)
+        if details:
+            results[phase]["phases"] = details
+        if phase in ("copy", "compress", "full"):
+            results[phase]["bytes_per_second"] = round(dataset["bytes"] / results[phase]["median"], 3)
+        print("{}: {:<10} median {:.3f}s, min {:.3f}s".format(name, phase, results[phase]["median"],
+                                                               results[phase]["min"]), flush=True)
+    return {"profile": profile, "seed": args.seed, "dataset": {key: dataset[key] for key in ("files", "dirs", "bytes")},
+            "results": results}
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of every median against the baseline. Returns False if any is slower by
+    more than threshold percent."""
+    passed = True
+    for name, profile_results in results["profiles"].items():
+        if name not in baseline["profiles"]:
+            continue
+        for phase, result in profile_results["results"].items():
+            base = baseline["profiles"][name]["results"].get(phase)
+            if base is None or not base["median"]:
+                continue
+            change = (result["median"] - base["median"]) / base["median"] * 100
+            regression = change > threshold
+            passed = passed and not regression
+            print("{}: {:<10} {:+.1f}%{}".format(name, phase, change, "  REGRESSION" if regression else ""))
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LocBkp benchmarks on synthetic datasets.")
+    parser.add_argument("--profiles", nargs="+", default=list(profiles), choices=list(profiles))
+    parser.add_argument("--phases", nargs="+", default=phases, choices=phases)
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the number of files of every profile.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "locbkp_bench"),
+                        help="Datasets are generated and kept here.")
+    parser.add_argument("--engine", default="7z", choices=["7z", "zip"])
+    parser.add_argument("--copy-threads", type=int, default=1)
+    parser.add_argument("--fake-7z", action="store_true", help="Use a stand-in instead of 7z.")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with results from this JSON file.")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="--compare fails if a median is slower by more than this many percent.")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    fake_7z_path = write_fake_7z(args.workdir) if args.fake_7z else None
+    results = {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "engine": args.engine,
+        "fake_7z": args.fake_7z,
+        "copy_threads": args.copy_threads,
+        "repeat": args.repeat,
+        "profiles": {}
+    }
+    for name in args.profiles:
+        profile = dict(profiles[name], files=max(1, int(profiles[name]["files"] * args.scale)))
+        results["profiles"][name] = run_profile(name, profile, args, fake_7z_path)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4)
+        print("Results are saved to {}.".format(args.output))
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if not compare(results, baseline, args.threshold):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
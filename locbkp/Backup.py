@@ -14,18 +14,46 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import json
+import itertools
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 import os
-from os.path import isfile, isdir
 
 from locbkp.utils.dictionary import BACKUP_LIST, DESTINATION_DIRECTORY, BACKUP_NAME, DATE_FORMAT, \
-    BACKUP_FILENAME_TEMPLATE, RETENTION, CREATE_SUBDIR
+    BACKUP_FILENAME_TEMPLATE, RETENTION, CREATE_SUBDIR, STREAMING, BACKUP_MODE, MODE_FULL, MODE_INCREMENTAL, \
+    MODE_DIFFERENTIAL, FULL_EVERY, INDEX_HASH, INCREMENTAL_FILENAME_TEMPLATE, DIFFERENTIAL_FILENAME_TEMPLATE, \
+    BACKEND, BACKEND_7Z, BACKEND_CHUNKSTORE, CHUNKSTORE_DIRECTORY, SNAPSHOT_FILENAME_TEMPLATE, COPY_THREADS, \
+    COPY_INFLIGHT_MB, STAGING_HARDLINKS, VOLUME_SIZE_MB, COMPRESSION_ENGINE, ENGINE_7Z, ENGINE_ZIP, COMPRESSION_LEVEL, \
+    COMPRESSION_THREADS, COMPRESSION_DICTIONARY_MB, COMPRESSION_CODEC, STORE_COMPRESSED, P7Z_PATH, SHARDS, \
+    SHARD_SUFFIX_TEMPLATE, SHARD_INDEX_SUFFIX, MANIFEST, MANIFEST_SUFFIX, JSON_REPORT, CHECKSUMS, CHECKSUM_SUFFIX, \
+    JOURNAL, BANDWIDTH_LIMIT_MB, NICE, IONICE_CLASS, MAX_THREADS, ADAPTIVE_THROTTLE, MAX_LOAD, MAX_DISK_UTIL_PCT, \
+    METRICS, METRICS_DIRECTORY, PROFILE, PROGRESS_INTERVAL, CATALOG, REMOTE_URL, TEMP_DIRECTORIES, \
+    TARGET_WINDOW_MINUTES, META_DIRECTORY, PENDING_FILENAME_TEMPLATE
+from locbkp.utils.compression import ZipEngine, is_compressed, get_7z_method_args, engine_extensions, compress_zip, \
+    honors_level, zip_codecs
+from locbkp.utils.catalog import get_chains, record_archive, remove_archive
+from locbkp.utils.destination import get_destination, TransferError
+from locbkp.utils.fastcopy import copy_file
+from locbkp.utils.chunkstore import ChunkStore, SNAP_SIZE, SNAP_MTIME_NS, SNAP_INODE, SNAP_CHUNKS
+from locbkp.utils.index import get_index_path, load_index, save_index, get_changes, get_journal_changes, IDX_HASH
+from locbkp.utils.journal import get_journal_dir, journal_position, read_journal, collect_journal_changes
+from locbkp.utils.manifest import ManifestWriter, ManifestReader, export_json_report, TYPE_FILE, TYPE_DIR
+from locbkp.utils.planner import Planner, get_free_space, read_history, describe_plan, window_levels, \
+    STRATEGY_STAGING, STRATEGY_STREAMING
+from locbkp.utils.progress import Progress, read_7z_output, default_progress_interval, format_size
+from locbkp.utils.metrics import Metrics, get_log_directory, get_peak_rss, write_run_record, stages, STAGE_WALK, \
+    STAGE_PLAN, STAGE_COPY, STAGE_COMPRESS, STAGE_TRANSFER
+from locbkp.utils.rules import get_rules, get_rules_fingerprint
+from locbkp.utils.throttle import Throttle, get_priority_prefix, set_process_priority, check_interval
 
-from locbkp.utils.utils import sanitize_path, get_tree, get_config, progress_bar, get_dir_size_mb, files, \
-    get_free_space_in_dir, get_dir_size
+from locbkp.utils.utils import sanitize_path, scan_trees, get_config, get_dir_size_mb, get_free_space_in_dir, \
+    partition_by_size, hash_file, write_checksums, get_archive_parts
 from __main__ import logger, version
 
 if os.name == "nt":
@@ -33,14 +61,37 @@ if os.name == "nt":
 else:
     p7z_path = "/usr/bin/7z"
 
+archive_templates = {
+    MODE_FULL: BACKUP_FILENAME_TEMPLATE,
+    MODE_INCREMENTAL: INCREMENTAL_FILENAME_TEMPLATE,
+    MODE_DIFFERENTIAL: DIFFERENTIAL_FILENAME_TEMPLATE
+}
+
+# Files from this size on are copied one per task by a separate, smaller pool
+large_file_size = 64 * 1024 * 1024
+# Small files are grouped into batches of this many files or bytes per task
+small_files_batch_len = 256
+small_files_batch_size = 16 * 1024 * 1024
+default_copy_inflight_mb = 512
+# Files sampled for STORE_COMPRESSED at a time
+stored_sample_batch_len = 1024
+# How often the temporary directory is checked for finished volumes while 7z runs
+volume_poll_interval = 1
+
 if os.name == "nt":
     packing_directories = [tempfile.gettempdir(), "C:\\vir\\locbkp"]
 else:
     packing_directories = [tempfile.gettempdir(), "/opt/locbkp_temp"]
 
 
+class BackupError(Exception):
+    pass
+
+
 class Backup:
-    def __init__(self, backup_list_path):
+    def __init__(self, backup_list_path, max_compression_threads=None, temp_reservation=None):
+        """max_compression_threads and temp_reservation (utils.planner.TempReservation) are the share of
+        a backup run together with others, known before it is planned."""
         self.logger = logger
         self.version = version
         self.backup_list_path = backup_list_path
@@ -56,102 +107,542 @@ class Backup:
         self.time_transfer_finished = self.time_start
         self.time_cleanup = timedelta(seconds=0)
         self.time_cleanup_finished = self.time_start
+        # Filled only without a manifest: with one, backed up paths are read back from it
         self.files_backed = []
         self.dirs_backed = []
+        self.files_backed_count = 0
+        self.dirs_backed_count = 0
+        self.files_not_backed = []
         self.size_before_compression = 0.0
         self.size_after_compression = 0.0
+        self.success = False
+        # Why the backup did not reach its destination, for the run record and the scheduler summary
+        self.failure = None
         self.curdate = self.time_start.strftime(DATE_FORMAT)
         self.backup_list = get_config(backup_list_path)
+        if not self.backup_list:
+            logger.error("Could not load backup list by path: {}".format(self.backup_list_path))
+            raise BackupError("Could not load backup list {}".format(self.backup_list_path))
+        self.create_subdir = self.backup_list[CREATE_SUBDIR] if CREATE_SUBDIR in self.backup_list else False
+        self.streaming = self.backup_list[STREAMING] if STREAMING in self.backup_list else False
+        self.copy_threads = self.backup_list[COPY_THREADS] if COPY_THREADS in self.backup_list else 1
+        self.staging_hardlinks = self.backup_list[STAGING_HARDLINKS] if STAGING_HARDLINKS in self.backup_list \
+            else False
+        self.copy_strategies = Counter()
+        self.volume_size = self.backup_list[VOLUME_SIZE_MB] if VOLUME_SIZE_MB in self.backup_list else None
+        self.engine = self.backup_list[COMPRESSION_ENGINE] if COMPRESSION_ENGINE in self.backup_list else ENGINE_7Z
+        if self.engine not in engine_extensions:
+            self.logger.warning("Unknown {} \"{}\". Will use {}.".format(COMPRESSION_ENGINE, self.engine, ENGINE_7Z))
+            self.engine = ENGINE_7Z
+        self.compression_level = self.backup_list[COMPRESSION_LEVEL] if COMPRESSION_LEVEL in self.backup_list else 5
+        self.compression_threads = self.backup_list[COMPRESSION_THREADS] if COMPRESSION_THREADS in self.backup_list \
+            else None
+        self.compression_dictionary = self.backup_list[COMPRESSION_DICTIONARY_MB] \
+            if COMPRESSION_DICTIONARY_MB in self.backup_list else None
+        self.compression_codec = self.backup_list[COMPRESSION_CODEC] if COMPRESSION_CODEC in self.backup_list \
+            else "lzma"
+        self.store_compressed = self.backup_list[STORE_COMPRESSED] if STORE_COMPRESSED in self.backup_list else False
+        self.p7z_path = self.backup_list[P7Z_PATH] if P7Z_PATH in self.backup_list else p7z_path
+        self.stored_files = set()
+        self.shards = self.backup_list[SHARDS] if SHARDS in self.backup_list else 1
+        if self.shards > 1 and self.volume_size:
+            self.logger.warning("{} is not supported with {}. Will create a single archive."
+                                .format(SHARDS, VOLUME_SIZE_MB))
+            self.shards = 1
+        if self.volume_size and self.engine != ENGINE_7Z:
+            self.logger.warning("{} is only supported by the {} engine. Will create a single archive."
+                                .format(VOLUME_SIZE_MB, ENGINE_7Z))
+            self.volume_size = None
+        if self.engine == ENGINE_ZIP:
+            if self.compression_codec not in zip_codecs:
+                self.logger.warning("Unknown {} \"{}\". Will use lzma.".format(COMPRESSION_CODEC,
+                                                                                self.compression_codec))
+                self.compression_codec = "lzma"
+            ignored = []
+            if COMPRESSION_LEVEL in self.backup_list and not honors_level(self.engine, self.compression_codec):
+                ignored.append(COMPRESSION_LEVEL)
+            if COMPRESSION_DICTIONARY_MB in self.backup_list and self.compression_codec != "lzma":
+                ignored.append(COMPRESSION_DICTIONARY_MB)
+            if ignored:
+                self.logger.warning("{} not supported by the {} engine with the {} codec. Will be ignored."
+                                    .format(", ".join(ignored), ENGINE_ZIP, self.compression_codec))
+        if self.volume_size and self.store_compressed:
+            # Stored files are added in a second 7z pass and multi-volume archives cannot be updated
+            self.logger.warning("{} is not supported with {}. Everything will be compressed."
+                                .format(STORE_COMPRESSED, VOLUME_SIZE_MB))
+            self.store_compressed = False
+        self.max_threads = self.backup_list[MAX_THREADS] if MAX_THREADS in self.backup_list else None
+        if self.max_threads:
+            self.copy_threads = min(self.copy_threads, self.max_threads)
+            # Shards are compressed at the same time, so they share the limit
+            share = max(1, self.max_threads // self.shards)
+            self.compression_threads = min(self.compression_threads or share, share)
+        if max_compression_threads:
+            self.compression_threads = min(self.compression_threads or max_compression_threads,
+                                           max_compression_threads)
+        self.temp_reservation = temp_reservation
+        self.nice = self.backup_list[NICE] if NICE in self.backup_list else None
+        self.ionice_class = self.backup_list[IONICE_CLASS] if IONICE_CLASS in self.backup_list else None
+        self.priority_prefix = get_priority_prefix(self.nice, self.ionice_class)
+        self.volumes_transferred = []
+        self.volumes_transferred_size = 0
+        self.volume_transfer_failed = False
+        self.copy_inflight_bytes = (self.backup_list[COPY_INFLIGHT_MB] if COPY_INFLIGHT_MB in self.backup_list
+                                    else default_copy_inflight_mb) * 1024 * 1024
+        self.backup_mode = self.backup_list[BACKUP_MODE] if BACKUP_MODE in self.backup_list else MODE_FULL
+        self.backend = self.backup_list[BACKEND] if BACKEND in self.backup_list else BACKEND_7Z
+        self.manifest_enabled = self.backup_list[MANIFEST] if MANIFEST in self.backup_list else False
+        self.json_report = self.backup_list[JSON_REPORT] if JSON_REPORT in self.backup_list else True
+        if self.manifest_enabled and self.backend == BACKEND_CHUNKSTORE:
+            self.logger.warning("{} is ignored with the {} backend: snapshots already list every file."
+                                .format(MANIFEST, BACKEND_CHUNKSTORE))
+            self.manifest_enabled = False
+        self.manifest = None
+        self.checksums = self.backup_list[CHECKSUMS] if CHECKSUMS in self.backup_list else False
+        self.catalog = self.backup_list[CATALOG] if CATALOG in self.backup_list else True
+        self.destination = get_destination(self.backup_list)
+        if self.destination.remote and self.backend == BACKEND_CHUNKSTORE:
+            self.logger.error("The {} backend cannot be used with {}.".format(BACKEND_CHUNKSTORE, REMOTE_URL))
+            raise BackupError("{} with {}".format(BACKEND_CHUNKSTORE, REMOTE_URL))
+        self.file_hashes = {}
+        self.part_hashes = {}
+        if self.backend == BACKEND_CHUNKSTORE and self.backup_mode != MODE_FULL:
+            self.logger.warning("{} is ignored with the {} backend: every snapshot is complete and "
+                                "unchanged data is deduplicated anyway.".format(BACKUP_MODE, BACKEND_CHUNKSTORE))
+            self.backup_mode = MODE_FULL
+        self.index_path = get_index_path(self.backup_list[DESTINATION_DIRECTORY], self.backup_list[BACKUP_NAME])
+        self.index = None
+        self.index_states = {}
+        self.files_deleted = []
+        self.base_backup = None
+        self.journal = self.backup_list[JOURNAL] if JOURNAL in self.backup_list else False
+        self.journal_dir = get_journal_dir(self.backup_list[DESTINATION_DIRECTORY], self.backup_list[BACKUP_NAME])
+        # Taken before anything is scanned: whatever changes from now on is picked up by the next backup
+        self.journal_position = journal_position(self.journal_dir, self.backup_list[BACKUP_LIST]) if self.journal \
+            else None
+        self.journal_removed = None
+        self.rules = get_rules(self.backup_list, self.backup_list[BACKUP_LIST])
+        self.metrics_enabled = self.backup_list[METRICS] if METRICS in self.backup_list else True
+        self.metrics_directory = self.backup_list[METRICS_DIRECTORY] if METRICS_DIRECTORY in self.backup_list \
+            else get_log_directory()
+        profile = self.backup_list[PROFILE] if PROFILE in self.backup_list else []
+        self.metrics = Metrics(stages if profile is True else profile)
+        self.errors = Counter()
+        self.progress_interval = self.backup_list[PROGRESS_INTERVAL] if PROGRESS_INTERVAL in self.backup_list \
+            else default_progress_interval
+        self.compress_progress = None
+        self.transfer_progress = None
+        self.rules_fingerprint = get_rules_fingerprint(self.backup_list)
+        self.pending_path = os.path.join(self.backup_list[DESTINATION_DIRECTORY], META_DIRECTORY,
+                                         PENDING_FILENAME_TEMPLATE.format(self.backup_list[BACKUP_NAME]))
+        if self.backend != BACKEND_CHUNKSTORE:
+            # Before the index is read: this backup builds on the pending one if it gets transferred
+            self.resume_pending_transfer()
+        if self.backup_mode != MODE_FULL:
+            self.load_incremental_index()
+        self.files_to_backup, self.dirs_to_backup, self.backup_size = self.prepare_backup_lists(
+            self.backup_list[BACKUP_LIST])
+        if self.index is not None:
+            self.prepare_incremental()
+        self.plan = None
         self.temp = self.check_size_requirements()
         if self.temp is None:
             logger.error("No suitable directories for temporary storage. Cannot proceed.")
-            exit(1)
+            raise BackupError("No suitable directories for temporary storage")
         self.packing_directory = sanitize_path(self.temp, "{}_{}".format(self.backup_list_name, self.curdate))
-        if not self.backup_list:
-            logger.error("Could not load backup list by path: {}".format(self.backup_list_path))
-            exit(1)
-        self.create_subdir = self.backup_list[CREATE_SUBDIR] if CREATE_SUBDIR in self.backup_list else False
-        self.archive_name = BACKUP_FILENAME_TEMPLATE.format(self.backup_list[BACKUP_NAME], self.curdate)
+        self.report_name = "LocBkp_report_{}.json".format(self.curdate)
+        if self.backend == BACKEND_CHUNKSTORE:
+            self.archive_name = SNAPSHOT_FILENAME_TEMPLATE.format(self.backup_list[BACKUP_NAME], self.curdate)
+        else:
+            self.archive_name = archive_templates[self.backup_mode].format(self.backup_list[BACKUP_NAME],
+                                                                           self.curdate, engine_extensions[self.engine])
+        if self.base_backup is None:
+            self.base_backup = self.archive_name
         self.archive_path = sanitize_path(self.temp, self.archive_name)
+        self.manifest_path = "{}.{}".format(self.archive_path, MANIFEST_SUFFIX)
+        self.throttle = self.get_throttle()
 
-    def check_size_requirements(self):
-        logger.info("Deciding temporary directory...")
-        backup_size = 0
-        for apath in self.backup_list[BACKUP_LIST]:
-            if os.path.exists(apath):
-                if isfile(apath):
-                    backup_size += os.path.getsize(apath)
-                elif isdir(apath):
-                    backup_size += get_dir_size(apath)
+    def get_throttle(self):
+        bandwidth_limit = self.backup_list[BANDWIDTH_LIMIT_MB] if BANDWIDTH_LIMIT_MB in self.backup_list else None
+        adaptive = self.backup_list[ADAPTIVE_THROTTLE] if ADAPTIVE_THROTTLE in self.backup_list else False
+        if not bandwidth_limit and not adaptive:
+            return
+        # Utilization is watched on every disk the backup reads from or writes to
+        paths = self.backup_list[BACKUP_LIST] + [self.temp, self.backup_list[DESTINATION_DIRECTORY]]
+        return Throttle(bandwidth_limit, adaptive,
+                        self.backup_list[MAX_LOAD] if MAX_LOAD in self.backup_list else None,
+                        self.backup_list[MAX_DISK_UTIL_PCT] if MAX_DISK_UTIL_PCT in self.backup_list else None,
+                        paths)
+
+    def get_hashing_threads(self):
+        threads = max(self.copy_threads, 4)
+        return min(threads, self.max_threads) if self.max_threads else threads
+
+    def get_required_temp_space(self):
+        if self.backend == BACKEND_CHUNKSTORE:
+            # Files are chunked straight into the destination, temp is not used for data
+            return 0
+        # Staging keeps both the copied files and the archive in temp, streaming only the archive
+        return self.plan.required_space
+
+    def check_dest_space(self, required_space):
         destdir = self.backup_list[DESTINATION_DIRECTORY]
+        if self.destination.remote:
+            return True
         dest_dir_free_space = get_free_space_in_dir(destdir)
-        if backup_size >= dest_dir_free_space:
+        if required_space >= dest_dir_free_space:
             self.logger.error("Insufficient free space in destination directory: {}."
                               "Free space: {}G. Backup size: {}G. Will not back up"
-                              .format(destdir, dest_dir_free_space/1024/1024/1024, backup_size/1024/1024/1024))
+                              .format(destdir, dest_dir_free_space/1024/1024/1024, required_space/1024/1024/1024))
+            return False
+        return True
+
+    def check_size_requirements(self):
+        """Picks the temporary directory, staging or streaming and the compression level (unless
+        STREAMING or COMPRESSION_LEVEL are set) so the archive fits and, with TARGET_WINDOW_MINUTES,
+        the backup is predicted to finish in time."""
+        logger.info("Deciding temporary directory...")
+        candidates = self.backup_list[TEMP_DIRECTORIES] if TEMP_DIRECTORIES in self.backup_list \
+            else packing_directories
+        if self.backend == BACKEND_CHUNKSTORE:
+            if not self.check_dest_space(self.backup_size):
+                return
+            return next(iter(get_free_space(candidates)), None)
+        window = self.backup_list[TARGET_WINDOW_MINUTES] * 60 if TARGET_WINDOW_MINUTES in self.backup_list \
+            else None
+        # Trying levels only makes sense where the level changes the archive
+        levels = window_levels if window is not None and COMPRESSION_LEVEL not in self.backup_list \
+            and honors_level(self.engine, self.compression_codec) else [self.compression_level]
+        if STREAMING in self.backup_list:
+            strategies = [STRATEGY_STREAMING if self.streaming else STRATEGY_STAGING]
+        else:
+            strategies = [STRATEGY_STAGING, STRATEGY_STREAMING]
+        with self.metrics.stage(STAGE_PLAN):
+            planner = Planner(self.files_to_backup, self.backup_size, self.engine, self.compression_codec,
+                              self.compression_threads or os.cpu_count(),
+                              read_history(self.metrics_directory, self.backup_list[BACKUP_NAME]))
+            if self.temp_reservation is None:
+                self.plan = planner.plan(candidates, levels, strategies, window)
+            else:
+                self.plan = self.temp_reservation.plan(planner, candidates, levels, strategies, window)
+        if self.plan is None:
+            self.logger.error("No temp directory has {} free for a {:.3f}Mb backup.".format(
+                format_size(planner.get_required_space(strategies[-1], planner.get_ratio(levels[-1]))),
+                self.backup_size / 1024 / 1024))
             return
-        for packdir in packing_directories:
-            try:
-                os.makedirs(packdir, exist_ok=True)
-            except BaseException as e:
-                self.logger.error("Could not create temp directory: {}.".format(e.__class__.__name__))
-                continue
-            packing_dir_free_space = get_free_space_in_dir(packdir)
-            logger.info("Checking {}: Free space in packing dir: {:.2f}G; Backup size is: {:2f}G."
-                        .format(packdir, packing_dir_free_space/1024/1024/1024, backup_size/1024/1024/1024))
-            if packing_dir_free_space > backup_size * 2 + 1 * 1024 * 1024 * 1024:
-                logger.info("{} seems suitable for packing.".format(packdir))
-                return packdir
+        if not self.check_dest_space(self.plan.archive_size):
+            return
+        self.logger.info("Plan: {}".format(describe_plan(self.plan, planner.sample_count)))
+        self.streaming = self.plan.strategy == STRATEGY_STREAMING
+        if self.streaming and STREAMING not in self.backup_list:
+            self.logger.warning("{} is not set, but staging does not fit or finish in time. Will compress from "
+                                "source paths (streaming): files changed meanwhile are archived as they are then."
+                                .format(STREAMING))
+        self.compression_level = self.plan.level
+        return self.plan.temp
+
+    def read_journal_changes(self):
+        if not self.journal or self.index is None or self.backup_mode == MODE_FULL or "dirs" not in self.index:
+            return
+        chain = self.index["chain"]
+        # A differential backup has everything that changed since the full backup
+        start = chain[0] if self.backup_mode == MODE_DIFFERENTIAL else chain[-1]
+        if start.get("rules") != self.rules_fingerprint:
+            self.logger.info("Exclusion rules have changed since {}. Will walk the tree.".format(start["archive"]))
+            return
+        try:
+            changes = read_journal(self.journal_dir, start.get("journal"), self.journal_position)
+        except BaseException as e:
+            self.logger.warning("Could not read change journal: {}".format(e.__class__.__name__))
+            return
+        if changes is None:
+            self.logger.info("Change journal does not cover everything since the previous backup "
+                             "(watcher restarted, stopped or overflowed). Will walk the tree.")
+            return
+        if self.rules is not None and self.rules.ignore_filename and \
+                any(os.path.basename(apath) == self.rules.ignore_filename for apath in changes[0]):
+            self.logger.info("An ignore file has changed. Will walk the tree.")
+            return
+        return changes
 
     def prepare_backup_lists(self, backup_list):
-        files_to_bkp = []
-        dirs_to_bkp = []
-        for anitem in backup_list:
-            newfiles = get_tree(anitem, False)
-            newdirs = get_tree(anitem, True)
-            for afile in newfiles:
-                if afile not in files_to_bkp:
-                    files_to_bkp.append(afile)
-                    dirpath = os.path.split(afile)[:-1]
-                    if not sanitize_path(*dirpath) in dirs_to_bkp:
-                        dirs_to_bkp.append(sanitize_path(*dirpath))
-            for adir in newdirs:
-                if adir not in dirs_to_bkp:
-                    dirs_to_bkp.append(adir)
-        return files_to_bkp, dirs_to_bkp
+        changes = self.read_journal_changes()
+        if changes is not None:
+            changed, new_dirs = changes
+            self.logger.info("Change journal has {} changed paths and {} new directories. Not walking the tree."
+                             .format(len(changed), len(new_dirs)))
+            with self.metrics.stage(STAGE_WALK):
+                files_to_bkp, dirs_to_bkp, self.journal_removed = collect_journal_changes(
+                    changed, new_dirs, self.index["files"], self.index["dirs"], self.rules)
+            return files_to_bkp, dirs_to_bkp, sum(st.st_size for st in files_to_bkp.values())
+        self.logger.info("Scanning {} backup paths...".format(len(backup_list)))
+        with self.metrics.stage(STAGE_WALK):
+            files_to_bkp, dirs_to_bkp, backup_size = scan_trees(backup_list, self.rules, self.errors)
+        self.logger.info("Found {} files and {} directories ({:.3f}Mb)."
+                         .format(len(files_to_bkp), len(dirs_to_bkp), backup_size / 1024 / 1024))
+        if self.rules is not None and self.rules.excluded:
+            self.logger.info("{} files and directories are excluded.".format(self.rules.excluded))
+        return files_to_bkp, dirs_to_bkp, backup_size
+
+    def choose_backup_mode(self):
+        if self.backup_mode not in archive_templates:
+            self.logger.warning("Unknown {} \"{}\". Will do a full backup.".format(BACKUP_MODE, self.backup_mode))
+            return MODE_FULL
+        if self.backup_mode == MODE_FULL:
+            return MODE_FULL
+        chain = self.index["chain"]
+        if not chain:
+            self.logger.info("No previous full backup in the index. Will do a full backup.")
+            return MODE_FULL
+        for alink in chain:
+            if not self.destination.has_archive(alink["archive"]):
+                self.logger.warning("Backup {} of the current chain is missing from {}. Will do a full backup."
+                                    .format(alink["archive"], self.destination.location))
+                return MODE_FULL
+        full_every = self.backup_list[FULL_EVERY] if FULL_EVERY in self.backup_list else None
+        if full_every is not None and len(chain) >= full_every:
+            self.logger.info("Chain has reached {} backups ({} is {}). Will do a full backup."
+                             .format(len(chain), FULL_EVERY, full_every))
+            return MODE_FULL
+        return self.backup_mode
+
+    def load_incremental_index(self):
+        self.index = load_index(self.index_path, self.backup_list[BACKUP_NAME])
+        self.backup_mode = self.choose_backup_mode()
+        if self.backup_mode == MODE_FULL:
+            self.index["chain"] = []
+            self.index["files"] = {}
+        else:
+            self.base_backup = self.index["chain"][0]["archive"]
+
+    def prepare_incremental(self):
+        use_hash = self.backup_list[INDEX_HASH] if INDEX_HASH in self.backup_list else False
+        if self.journal_removed is not None:
+            changed, self.files_deleted, self.index_states = get_journal_changes(
+                self.index, self.files_to_backup, self.journal_removed, use_hash)
+        else:
+            changed, self.files_deleted, self.index_states = get_changes(self.index, self.files_to_backup, use_hash)
+        if self.backup_mode == MODE_FULL:
+            return
+        self.logger.info("{} backup based on {}: {} of {} files changed, {} deleted."
+                         .format(self.backup_mode.capitalize(), self.base_backup, len(changed),
+                                 len(self.index_states), len(self.files_deleted)))
+        self.files_to_backup = changed
+        self.backup_size = sum(st.st_size for st in changed.values())
+
+    def update_index(self):
+        index = self.build_index()
+        if index is None:
+            return
+        try:
+            save_index(self.index_path, index)
+            self.logger.info("File-state index is saved to {}.".format(self.index_path))
+        except BaseException as e:
+            self.logger.error("Could not save file-state index {}: {}".format(self.index_path, e.__class__.__name__))
+
+    def build_index(self):
+        """The index with this backup added, or None without an index."""
+        if self.index is None:
+            return
+        # Files that could not be backed up keep their previous state so they are picked up next time
+        for apath in self.files_not_backed:
+            if apath in self.index["files"]:
+                self.index_states[apath] = self.index["files"][apath]
+            else:
+                del self.index_states[apath]
+        self.index["chain"].append({"archive": self.archive_name, "type": self.backup_mode, "date": self.curdate,
+                                    "journal": self.journal_position, "rules": self.rules_fingerprint})
+        if self.journal:
+            self.index["dirs"] = list(self.dirs_to_backup)
+        # A differential backup is always compared with the state of its full backup
+        if self.backup_mode != MODE_DIFFERENTIAL:
+            self.index["files"] = self.index_states
+        return self.index
 
     def start_backup(self):
-        files, dirs = self.prepare_backup_lists(self.backup_list[BACKUP_LIST])
         self.time_preparation_finished = datetime.now()
         self.time_preparation = self.time_preparation_finished - self.time_start
-        self.backup(self.backup_list[DESTINATION_DIRECTORY], files, dirs)
+        self.backup(self.backup_list[DESTINATION_DIRECTORY], self.files_to_backup, self.dirs_to_backup)
 
     def backup(self, destdir, files, dirs):
+        if self.backend == BACKEND_CHUNKSTORE:
+            with self.metrics.stage(STAGE_COPY):
+                self.backup_to_chunkstore(destdir, files, dirs)
+            return
+        if self.manifest_enabled:
+            self.manifest = ManifestWriter(self.manifest_path, {"backup_name": self.backup_list[BACKUP_NAME],
+                                                                "date": self.curdate, "archive": self.archive_name,
+                                                                "backup_type": self.backup_mode,
+                                                                "member_prefix": self.get_member_prefix()})
+        if self.streaming:
+            self.logger.info("Streaming mode: {} files will be compressed in place.".format(len(files)))
+            os.makedirs(self.packing_directory, exist_ok=True)
+            for adir in dirs:
+                self.dir_backed(adir)
+            with self.metrics.stage(STAGE_COPY):
+                if self.checksums:
+                    self.logger.info("Hashing {} files...".format(len(files)))
+                    # hashlib releases the GIL while hashing, so threads hash files in parallel
+                    with ThreadPoolExecutor(self.get_hashing_threads()) as executor:
+                        hash_source = self.metrics.profiled(STAGE_COPY, hash_file)
+                        hashes = executor.map(lambda x: hash_source(x, throttle=self.throttle), files)
+                        progress = Progress("Hashing", self.backup_size, len(files), self.progress_interval)
+                        for afile, file_hash in zip(files, hashes):
+                            self.file_backed(afile, file_hash=file_hash)
+                            progress.update(files[afile].st_size, 1)
+                        progress.finish()
+                else:
+                    for afile in files:
+                        self.file_backed(afile)
+            self.time_copy_temp_finished = datetime.now()
+            self.time_copy_temp = self.time_copy_temp_finished - self.time_preparation_finished
+            self.backup_finalize(destdir)
+            return
         self.logger.info("Creating directory structure...")
         self.logger.info("Will create {} directories...".format(len(dirs)))
         self.backup_empty_dirs(dirs)
 
         self.logger.info("Backing up {} files to {}...".format(len(files), self.packing_directory))
-        self.backup_files(files)
-        self.logger.info("Done backing up files.")
+        with self.metrics.stage(STAGE_COPY):
+            self.backup_files(files)
+        self.logger.info("Done backing up files. Copy strategies used: {}.".format(
+            ", ".join("{}: {}".format(strategy, count) for strategy, count in self.copy_strategies.most_common())))
         self.time_copy_temp_finished = datetime.now()
         self.time_copy_temp = self.time_copy_temp_finished - self.time_preparation_finished
         self.backup_finalize(destdir)
 
+    def file_backed(self, afile, strategy=None, file_hash=None):
+        self.files_backed_count += 1
+        if strategy is not None:
+            self.copy_strategies[strategy] += 1
+        if self.manifest is None:
+            self.files_backed.append(afile)
+            if file_hash is not None:
+                self.file_hashes[afile] = file_hash
+            return
+        if file_hash is None and afile in self.index_states:
+            file_hash = self.index_states[afile][IDX_HASH]
+        self.manifest.add_file(afile, self.files_to_backup[afile], file_hash)
+
+    def dir_backed(self, adir):
+        self.dirs_backed_count += 1
+        if self.manifest is None:
+            self.dirs_backed.append(adir)
+            return
+        self.manifest.add_dir(adir, self.dirs_to_backup[adir])
+
+    def iter_backed(self, entry_type):
+        """Backed up files (TYPE_FILE) or directories (TYPE_DIR), from the manifest if there is one."""
+        if not self.manifest_enabled:
+            yield from self.files_backed if entry_type == TYPE_FILE else self.dirs_backed
+            return
+        with ManifestReader(self.manifest_path) as reader:
+            for entry in reader.iter_entries():
+                if entry["type"] == entry_type:
+                    yield entry["path"]
+
+    def close_manifest(self):
+        """False if the manifest could not be written: the archive list is read from it."""
+        if self.manifest is None:
+            return True
+        try:
+            for apath in self.files_deleted:
+                self.manifest.add_deleted(apath)
+            self.manifest.close()
+            self.logger.info("Manifest of {} files and {} directories is written."
+                             .format(self.manifest.files, self.manifest.dirs))
+            return True
+        except BaseException as e:
+            self.logger.error("Could not write manifest {}: {}".format(self.manifest_path, e.__class__.__name__))
+            return False
+        finally:
+            self.manifest = None
+
+    def backup_to_chunkstore(self, destdir, files, dirs):
+        store_path = sanitize_path(destdir, CHUNKSTORE_DIRECTORY)
+        self.logger.info("Storing {} files in chunk store {}...".format(len(files), store_path))
+        store = ChunkStore(store_path)
+        try:
+            previous = store.list_snapshots(self.backup_list[BACKUP_NAME])
+            previous_files = store.load_snapshot(previous[-1][0])["files"] if previous else {}
+            snapshot_files = {}
+            reused = 0
+            progress = Progress("Chunk store", self.backup_size, len(files), self.progress_interval)
+            for afile, st in files.items():
+                entry = previous_files.get(afile)
+                # Unchanged files are not read again, their chunks are taken from the previous snapshot
+                if entry is not None and entry[SNAP_SIZE] == st.st_size and entry[SNAP_MTIME_NS] == st.st_mtime_ns \
+                        and entry[SNAP_INODE] == st.st_ino and store.has_chunks(entry[SNAP_CHUNKS]):
+                    snapshot_files[afile] = entry
+                    reused += 1
+                else:
+                    try:
+                        chunks = store.store_file(afile)
+                    except BaseException as e:
+                        self.logger.warning("Could not store {}: {}".format(afile, e.__class__.__name__))
+                        progress.update(st.st_size, 1)
+                        continue
+                    snapshot_files[afile] = [st.st_size, st.st_mtime_ns, st.st_mode, st.st_ino, chunks]
+                self.files_backed.append(afile)
+                self.files_backed_count += 1
+                progress.update(st.st_size, 1)
+            progress.finish()
+            self.dirs_backed = list(dirs)
+            self.dirs_backed_count = len(self.dirs_backed)
+            self.time_copy_temp_finished = datetime.now()
+            self.time_copy_temp = self.time_copy_temp_finished - self.time_preparation_finished
+            self.size_before_compression = self.backup_size / 1024 / 1024
+            self.size_after_compression = store.bytes_written / 1024 / 1024
+            self.logger.info("{} files were unchanged since the previous snapshot. Wrote {} new chunks ({:.3f}Mb)."
+                             .format(reused, store.chunks_written, self.size_after_compression))
+            snapshot = self.get_backup_report(self.size_before_compression)
+            snapshot["backup_name"] = self.backup_list[BACKUP_NAME]
+            snapshot["date"] = self.curdate
+            snapshot["files"] = snapshot_files
+            snapshot["dirs"] = {adir: dirs[adir].st_mode for adir in self.dirs_backed}
+            store.save_snapshot(self.archive_name, snapshot)
+            self.logger.info("Snapshot {} is saved.".format(self.archive_name))
+            self.success = True
+        finally:
+            store.close()
+        self.time_compress_finished = self.time_transfer_finished = self.time_cleanup_finished = datetime.now()
+
+    def get_backup_report(self, backup_size, with_lists=True):
+        report = {
+            "locbkp_version": self.version,
+            "files_backed": self.files_backed,
+            "dirs_backed": self.dirs_backed,
+            "size_uncompressed_mb": backup_size,
+            "backup_type": self.backup_mode,
+            "base_backup": self.base_backup,
+            "files_deleted": self.files_deleted,
+            "volume_size_mb": self.volume_size,
+            "shards": self.shards,
+            # The planner may pick streaming without STREAMING set, and it changes the member names
+            "strategy": STRATEGY_STREAMING if self.streaming else STRATEGY_STAGING,
+            "member_prefix": self.get_member_prefix()
+        }
+        if self.manifest_enabled:
+            report["manifest"] = os.path.basename(self.manifest_path)
+        elif self.checksums and with_lists and self.json_report:
+            report["file_hashes"] = self.file_hashes
+        if not with_lists or not self.json_report:
+            # Without the lists the report is a small summary, the manifest lists the files
+            del report["files_backed"]
+            del report["dirs_backed"]
+        return report
+
     def generate_backup_report(self, backup_size):
+        report_path = sanitize_path(self.packing_directory, self.report_name)
         try:
-            with open(sanitize_path(self.packing_directory, "LocBkp_report_{}.json".format(self.curdate)),
-                      "w") as locbkp_report:
-                json.dump(
-                    {
-                        "locbkp_version": self.version,
-                        "files_backed": self.files_backed,
-                        "dirs_backed": self.dirs_backed,
-                        "size_uncompressed_mb": backup_size
-                    },
-                    locbkp_report,
-                    indent=4
-                )
+            if self.json_report and self.manifest_enabled and os.path.exists(self.manifest_path):
+                # Exported from the manifest entry by entry instead of serializing the lists at once
+                with open(report_path, "w", encoding="utf-8") as locbkp_report:
+                    export_json_report(self.manifest_path, locbkp_report,
+                                       self.get_backup_report(backup_size, with_lists=False))
+                return
+            with open(report_path, "w") as locbkp_report:
+                json.dump(self.get_backup_report(backup_size), locbkp_report, indent=4)
         except BaseException as e:
             self.logger.error("Could not create backup report! Error: {}".format(e.__class__.__name__))
 
@@ -161,114 +652,831 @@ class Backup:
             try:
                 # logger.info("Backing up directory structure: {} to {}".format(adir, final_path))
                 os.makedirs(final_path)
-                self.dirs_backed.append(adir)
+                self.dir_backed(adir)
             except FileExistsError:
                 pass
             except BaseException as e:
                 self.logger.warning("Could not create a directory {}: {}".format(final_path, e.__class__.__name__))
 
     def backup_files(self, fileslist):
-        total_files = len(fileslist)
-        for num, afile in enumerate(fileslist):
-            progress_bar(num, total_files)
-            if os.path.exists(afile) and os.path.isfile(afile):
-                if self.backup_file(afile):
-                    self.files_backed.append(afile)
+        progress = Progress("Copy", sum(st.st_size for st in fileslist.values()), len(fileslist),
+                            self.progress_interval)
+        if self.copy_threads > 1:
+            self.backup_files_parallel(fileslist, progress)
+        else:
+            for afile, st in fileslist.items():
+                strategy = self.backup_file(afile)
+                if strategy:
+                    self.file_backed(afile, strategy, self.hash_staged_file(afile))
+                progress.update(st.st_size, 1)
+        progress.finish()
+
+    def backup_batch(self, batch):
+        copied = []
+        for afile in batch:
+            strategy = self.backup_file(afile)
+            if strategy:
+                copied.append((afile, strategy, self.hash_staged_file(afile)))
+        return copied
+
+    def hash_staged_file(self, afile):
+        """Hashes the copy in the packing directory, which is what goes into the archive.
+        It has just been written, so it is usually read from the page cache."""
+        if not self.checksums:
+            return
+        return hash_file(sanitize_path(self.packing_directory, afile))
+
+    def get_copy_batches(self, fileslist):
+        """Yields (executor index, files, size): every large file is a task of its own for the
+        large-files pool (1), small files are batched for the small-files pool (0)."""
+        batch = []
+        batch_size = 0
+        for afile, st in fileslist.items():
+            if st.st_size >= large_file_size:
+                yield 1, [afile], st.st_size
+                continue
+            batch.append(afile)
+            batch_size += st.st_size
+            if len(batch) >= small_files_batch_len or batch_size >= small_files_batch_size:
+                yield 0, batch, batch_size
+                batch = []
+                batch_size = 0
+        if batch:
+            yield 0, batch, batch_size
+
+    def backup_files_parallel(self, fileslist, progress):
+        large_threads = max(1, self.copy_threads // 4)
+        self.logger.info("Copying with {} threads for small files and {} for large files, up to {:.0f}Mb in flight."
+                         .format(self.copy_threads, large_threads, self.copy_inflight_bytes / 1024 / 1024))
+        inflight = {}
+        inflight_bytes = 0
+        # All bookkeeping happens in this thread, workers only copy and return what succeeded
+        backup_batch = self.metrics.profiled(STAGE_COPY, self.backup_batch)
+        with ThreadPoolExecutor(self.copy_threads) as small_pool, ThreadPoolExecutor(large_threads) as large_pool:
+            executors = (small_pool, large_pool)
+
+            def collect():
+                nonlocal inflight_bytes
+                finished, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch_len, batch_size = inflight.pop(future)
+                    inflight_bytes -= batch_size
+                    for afile, strategy, file_hash in future.result():
+                        self.file_backed(afile, strategy, file_hash)
+                    progress.update(batch_size, batch_len)
+
+            for executor_index, batch, batch_size in self.get_copy_batches(fileslist):
+                # A single file bigger than the limit still goes when nothing else is in flight
+                while inflight and inflight_bytes + batch_size > self.copy_inflight_bytes:
+                    collect()
+                future = executors[executor_index].submit(backup_batch, batch)
+                inflight[future] = (len(batch), batch_size)
+                inflight_bytes += batch_size
+            while inflight:
+                collect()
 
     def backup_finalize(self, destdir):
         self.logger.info("Backup finished. Finalizing...")
-        self.size_before_compression = get_dir_size_mb(self.packing_directory)
+        manifest_written = self.close_manifest()
+        if self.streaming:
+            self.size_before_compression = self.backup_size / 1024 / 1024
+        else:
+            self.size_before_compression = get_dir_size_mb(self.packing_directory)
         self.logger.info("Backed up {:.3f}Mb of data.".format(self.size_before_compression))
-        self.logger.info("Generating backup report...")
-        self.generate_backup_report(self.size_before_compression)
-        self.logger.info("Compressing backup...")
         time_pre_compress = datetime.now()
-        self.compress_backup()
+        with self.metrics.stage(STAGE_COMPRESS):
+            compressed = manifest_written and self.compress(destdir)
         self.time_compress_finished = datetime.now()
         self.time_compress = self.time_compress_finished - time_pre_compress
-        self.size_after_compression = os.path.getsize(self.archive_path) / 1024 / 1024
-        self.logger.info("Backup is compressed. Compressed size is {:.3f}Mb".format(self.size_after_compression))
-        self.transfer_file(destdir)
+        self.size_after_compression = (self.volumes_transferred_size +
+                                       sum(os.path.getsize(apart) for apart in self.get_archive_parts())) / 1024 / 1024
+        transferred = False
+        if compressed:
+            self.logger.info("Backup is compressed. Compressed size is {:.3f}Mb".format(self.size_after_compression))
+            with self.metrics.stage(STAGE_TRANSFER):
+                transferred = self.transfer_file(destdir)
+            if not transferred:
+                self.failure = "transfer failed"
+        else:
+            # A partial archive must not reach the destination, nor the index claim its files are backed up
+            self.logger.error("Compression failed. The backup is not transferred.")
+            self.failure = "compression failed"
+            self.delete_transferred_volumes()
+            self.time_transfer_finished = datetime.now()
+        self.success = compressed and transferred
+        kept = False
+        if self.success:
+            self.update_index()
+            # Has everything the archive an earlier run could not transfer has
+            self.discard_pending()
+        elif compressed:
+            kept = self.keep_pending()
         self.logger.info("Done. Cleaning up...")
-        os.remove(self.archive_path)
+        if not kept:
+            for apart in self.get_archive_parts():
+                os.remove(apart)
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
         shutil.rmtree(self.packing_directory)
         self.logger.info("Cleaned up.")
         self.time_cleanup_finished = datetime.now()
         self.time_cleanup = self.time_cleanup_finished - self.time_transfer_finished
 
-    def compress_backup(self):
-        if self.create_subdir:
-            p7z_cmd = [p7z_path, "a", "-t7z", self.archive_path, "-mx5", "-aoa", self.packing_directory]
+    def delete_transferred_volumes(self):
+        """Removes the volumes of a failed archive that were moved to the destination while 7z was running."""
+        for volume_name in self.volumes_transferred:
+            try:
+                self.destination.delete(volume_name)
+            except BaseException as e:
+                self.logger.error("Could not delete {}: {}".format(self.destination.describe(volume_name),
+                                                                 e.__class__.__name__))
+        self.volumes_transferred = []
+        self.volumes_transferred_size = 0
+
+    def compress(self, destdir):
+        self.compress_progress = Progress("Compress", self.backup_size, interval=self.progress_interval)
+        try:
+            return self.compress_archive(destdir)
+        finally:
+            self.compress_progress.finish()
+            self.compress_progress = None
+
+    def compress_archive(self, destdir):
+        if self.store_compressed:
+            self.stored_files = self.select_stored_files()
+            self.logger.info("{} files are already compressed and will be stored as is.".format(len(self.stored_files)))
+        if self.shards > 1:
+            self.logger.info("Compressing backup into {} shards...".format(self.shards))
+            return self.compress_backup_sharded()
+        elif self.engine == ENGINE_ZIP:
+            self.logger.info("Compressing backup in-process ({} codec)...".format(self.compression_codec))
+            return self.compress_backup_zip()
+        elif self.streaming:
+            self.logger.info("Compressing backup from source paths...")
+            return self.compress_backup_streaming(destdir)
         else:
-            p7z_cmd = [p7z_path, "a", "-t7z", self.archive_path, "-mx5", "-aoa", os.path.join(self.packing_directory, "*")]
+            self.logger.info("Generating backup report...")
+            self.generate_backup_report(self.size_before_compression)
+            self.logger.info("Compressing backup...")
+            return self.compress_backup(destdir)
+
+    def get_volume_path(self, number):
+        return "{}.{:03d}".format(self.archive_path, number)
+
+    def get_archive_parts(self):
+        return get_archive_parts(self.temp, self.archive_name, bool(self.volume_size or self.shards > 1))
+
+    def get_shard_path(self, num):
+        return "{}.{}".format(self.archive_path, SHARD_SUFFIX_TEMPLATE.format(num))
+
+    def get_disk_path(self, afile):
+        return afile if self.streaming else sanitize_path(self.packing_directory, afile)
+
+    def get_member_name(self, apath):
+        """Name of a backed up file or directory in the archive: the same as it is in the packing
+        directory, whether it was staged or not."""
+        base = self.temp if self.create_subdir else self.packing_directory
+        return os.path.relpath(sanitize_path(self.packing_directory, apath), base)
+
+    def get_member_prefix(self):
+        """Directory the backed up paths are under in the archive: the packing directory with
+        CREATE_SUBDIR, except for 7z in streaming mode, which stores paths as they are on disk."""
+        if not self.create_subdir or (self.streaming and self.engine == ENGINE_7Z):
+            return ""
+        return os.path.basename(self.packing_directory)
+
+    def select_stored_files(self):
+        threads = max(self.copy_threads, self.compression_threads or 1)
+        stored = set()
+        files = self.iter_backed(TYPE_FILE)
+        # Sampling is mostly waiting for reads, so it is done in parallel, a batch at a time
+        with ThreadPoolExecutor(threads) as executor:
+            while True:
+                batch = list(itertools.islice(files, stored_sample_batch_len))
+                if not batch:
+                    return stored
+                sizes = [self.files_to_backup[afile].st_size for afile in batch]
+                compressed = executor.map(is_compressed, map(self.get_disk_path, batch), sizes)
+                stored.update(afile for afile, is_stored in zip(batch, compressed) if is_stored)
+
+    def get_7z_command(self, *args, archive_path=None):
+        p7z_cmd = [self.p7z_path, "a", "-t7z", archive_path or self.archive_path]
+        p7z_cmd.extend(get_7z_method_args(self.compression_level, self.compression_threads,
+                                          self.compression_dictionary))
+        if self.volume_size:
+            p7z_cmd.append("-v{}m".format(self.volume_size))
+        p7z_cmd.extend(args)
+        return p7z_cmd
+
+    def execute_7z(self, p7z_cmd, destdir=None, cwd=None, output_name=None, size=0):
+        """Runs 7z. size: bytes it compresses, for the progress of the compress phase."""
+        p7z_cmd = self.priority_prefix + p7z_cmd + ["-bsp1"]
         self.logger.info("Executing: {}".format(" ".join(p7z_cmd)))
+        # Not in the packing directory: everything there ends up in the archive
+        output_path = sanitize_path(self.temp, "{}.log".format(output_name or self.archive_name))
+        try:
+            with open(output_path, "wb") as output:
+                process = subprocess.Popen(p7z_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+                # Progress lines are parsed, the rest of the output is kept for error messages
+                reader = threading.Thread(target=read_7z_output,
+                                          args=(process.stdout, output, self.compress_progress, size))
+                reader.start()
+                try:
+                    if self.volume_size and destdir is not None:
+                        returncode = self.wait_7z_pipelined(process, destdir)
+                    else:
+                        returncode = self.wait_7z(process)
+                finally:
+                    reader.join()
+                    process.stdout.close()
+            with open(output_path, "r", errors="replace") as output:
+                output = output.read()
+        except BaseException as e:
+            self.logger.error("Could not compress backup: {}".format(e.__class__.__name__))
+            return False
+        finally:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        # 7z exits with 1 on warnings, e.g. when a file vanished or could not be opened
+        if returncode == 1:
+            self.logger.warning("7z finished with warnings: {}".format(output))
+        elif returncode != 0:
+            self.logger.error("Could not compress backup: 7z exited with code {}".format(returncode))
+            self.logger.error("Process stdout: {}".format(output))
+            return False
+        return True
+
+    def wait_7z_pipelined(self, process, destdir):
+        """Moves finished volumes to destdir while the next ones are being compressed. A volume is
+        finished once the next one appears. The first volume is left in temp: 7z rewrites its
+        start header when the archive is complete."""
+        number = 2
+        try:
+            while True:
+                finished = process.poll() is not None
+                while os.path.exists(self.get_volume_path(number)) and \
+                        (finished or os.path.exists(self.get_volume_path(number + 1))):
+                    self.transfer_volume(self.get_volume_path(number), destdir)
+                    number += 1
+                if finished:
+                    return process.returncode
+                if self.throttle is not None:
+                    self.throttle.pace(process)
+                time.sleep(volume_poll_interval)
+        finally:
+            if self.throttle is not None:
+                self.throttle.resume(process)
+
+    def wait_7z(self, process):
+        """Waits for 7z, pausing it while the system is overloaded (ADAPTIVE_THROTTLE)."""
+        if self.throttle is None or not self.throttle.adaptive:
+            return process.wait()
+        try:
+            while process.poll() is None:
+                self.throttle.pace(process)
+                time.sleep(check_interval)
+            return process.returncode
+        finally:
+            self.throttle.resume(process)
+
+    def hash_part(self, part_path):
+        if self.checksums and os.path.basename(part_path) not in self.part_hashes:
+            self.part_hashes[os.path.basename(part_path)] = hash_file(part_path, throttle=self.throttle)
+
+    def write_part_hashes(self, path_to, archive_name=None, temp=None, part_hashes=None):
+        """Of this backup's archive unless another one (see resume_pending_transfer) is given."""
+        if not self.checksums:
+            return
+        part_hashes = self.part_hashes if part_hashes is None else part_hashes
+        checksums_name = "{}.{}".format(archive_name or self.archive_name, CHECKSUM_SUFFIX)
+        # Written in place locally, uploaded from temp to a remote destination
+        checksums_path = sanitize_path((temp or self.temp) if self.destination.remote else path_to, checksums_name)
+        try:
+            write_checksums(checksums_path, {name: part_hash for name, part_hash in part_hashes.items()
+                                             if part_hash is not None})
+            if self.destination.remote:
+                self.destination.put(checksums_path, checksums_name)
+                os.remove(checksums_path)
+            self.logger.info("Checksums of {} files are saved to {}.".format(
+                len(part_hashes), self.destination.describe(checksums_name)))
+        except BaseException as e:
+            self.logger.error("Could not save checksums to {}: {}".format(self.destination.describe(checksums_name),
+                                                                        e.__class__.__name__))
+
+    def transfer_volume(self, volume_path, destdir):
+        destfile = self.destination.describe(os.path.basename(volume_path))
+        size = os.path.getsize(volume_path)
+        self.hash_part(volume_path)
+        try:
+            self.destination.put(volume_path, os.path.basename(volume_path),
+                                 throttle=self.transfer_progress or self.throttle)
+        except BaseException as e:
+            self.logger.error("Could not transfer {} to {}: {}".format(os.path.basename(volume_path), destfile,
+                                                                     e.__class__.__name__))
+            self.volume_transfer_failed = True
+            return False
+        if os.path.exists(volume_path):
+            os.remove(volume_path)
+        self.volumes_transferred.append(os.path.basename(volume_path))
+        self.volumes_transferred_size += size
+        self.logger.info("{} is transferred.".format(os.path.basename(volume_path)))
+        return True
+
+    def add_report_7z(self, report, archive_path=None):
+        """report: the report as bytes or as a file opened for reading."""
+        p7z_cmd = self.priority_prefix + [self.p7z_path, "a", "-t7z", archive_path or self.archive_path,
+                   "-mx{}".format(self.compression_level), "-si" + self.report_name]
+        report_input = {"input": report} if isinstance(report, bytes) else {"stdin": report}
+        try:
+            subprocess.run(p7z_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True, **report_input)
+        except BaseException as e:
+            self.logger.error("Could not add backup report to the archive: {}".format(e.__class__.__name__))
+            return False
+        return True
+
+    def write_list_file(self, list_name, entries):
+        list_path = sanitize_path(self.packing_directory, "LocBkp_{}_{}.txt".format(list_name, self.curdate))
+        with open(list_path, "w", encoding="utf-8") as list_file:
+            for anentry in entries:
+                list_file.write(anentry + "\n")
+        return list_path
+
+    def compress_stored_files(self, cwd, stored_files=None, archive_path=None):
+        """Adds the files selected by select_stored_files to the archive without compression."""
+        stored_files = sorted(self.stored_files if stored_files is None else stored_files)
+        archive_path = archive_path or self.archive_path
+        if self.streaming:
+            entries = stored_files
+            args = ["-spf2"]
+        else:
+            entries = [self.get_member_name(afile) for afile in stored_files]
+            args = []
+        list_path = self.write_list_file("storelist_{}".format(os.path.basename(archive_path)), entries)
+        p7z_cmd = [self.p7z_path, "a", "-t7z", archive_path, "-m0=Copy", "-spd", "-scsUTF-8"] + args + \
+                  ["@" + list_path]
+        return self.execute_7z(p7z_cmd, cwd=cwd, output_name=os.path.basename(archive_path),
+                               size=self.get_entries_size(stored_files))
+
+    def compress_backup(self, destdir=None):
+        if self.stored_files:
+            # Everything is listed relative to the directory that is the root of the archive, so the
+            # layout is the same as with the wildcard below
+            cwd = self.temp if self.create_subdir else self.packing_directory
+            entries = (self.get_member_name(apath) for apath in self.iter_archive_list()
+                       if apath not in self.stored_files)
+            list_path = self.write_list_file("filelist", itertools.chain(
+                entries, [self.get_member_name(self.report_name)]))
+            p7z_cmd = self.get_7z_command("-spd", "-scsUTF-8", "@" + list_path)
+            size = self.backup_size - self.get_entries_size(self.stored_files)
+            return self.execute_7z(p7z_cmd, destdir, cwd=cwd, size=size) and self.compress_stored_files(cwd)
+        if self.create_subdir:
+            p7z_cmd = self.get_7z_command("-aoa", self.packing_directory)
+        else:
+            p7z_cmd = self.get_7z_command("-aoa", os.path.join(self.packing_directory, "*"))
+        return self.execute_7z(p7z_cmd, destdir, size=self.backup_size)
+
+    def get_entries_size(self, entries):
+        return sum(self.files_to_backup[apath].st_size for apath in entries if apath in self.files_to_backup)
+
+    def iter_archive_list(self):
+        # Directories given to 7z are added recursively, so only the ones that had no children
+        # during the scan are listed to keep empty directories in the archive
+        parents = set(os.path.dirname(apath) for apath in self.iter_backed(TYPE_FILE))
+        parents.update(os.path.dirname(apath) for apath in self.iter_backed(TYPE_DIR))
+        yield from self.iter_backed(TYPE_FILE)
+        yield from (adir for adir in self.iter_backed(TYPE_DIR) if adir not in parents)
+
+    def compress_backup_streaming(self, destdir=None):
+        if self.create_subdir:
+            self.logger.warning("{} is ignored in streaming mode: paths are stored as they are on disk."
+                                .format(CREATE_SUBDIR))
+        entries = (apath for apath in self.iter_archive_list() if apath not in self.stored_files)
+        self.generate_backup_report(self.size_before_compression)
+        if self.volume_size:
+            # Multi-volume archives cannot be updated, so the report has to go in with the files.
+            # 7z runs in the packing directory, where the relative report path is stored as is.
+            entries = itertools.chain(entries, [self.report_name])
+        list_path = self.write_list_file("filelist", entries)
+        p7z_cmd = self.get_7z_command("-spf2", "-spd", "-scsUTF-8", "@" + list_path)
+        size = self.backup_size - self.get_entries_size(self.stored_files)
+        if not self.execute_7z(p7z_cmd, destdir, cwd=self.packing_directory, size=size):
+            return False
+        if self.volume_size:
+            return True
+        if self.stored_files and not self.compress_stored_files(self.packing_directory):
+            return False
+        self.logger.info("Adding backup report to the archive...")
+        with open(sanitize_path(self.packing_directory, self.report_name), "rb") as report:
+            return self.add_report_7z(report)
+
+    def compress_backup_zip(self):
+        engine = ZipEngine(self.compression_codec, self.compression_level, self.compression_threads,
+                           self.compression_dictionary)
+        self.generate_backup_report(self.size_before_compression)
+        report = (sanitize_path(self.packing_directory, self.report_name), self.get_member_name(self.report_name))
+        members = itertools.chain(((self.get_disk_path(apath), self.get_member_name(apath))
+                                   for apath in self.iter_archive_list()), [report])
+        stored = set(self.get_disk_path(afile) for afile in self.stored_files)
         try:
-            process = subprocess.run(p7z_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, check=True)
+            engine.compress(self.archive_path, members, stored, progress=self.compress_progress)
         except BaseException as e:
             self.logger.error("Could not compress backup: {}".format(e.__class__.__name__))
-            self.logger.error("Process stdout: {}".format(process.stdout))
+            return False
+        return True
+
+    def compress_shard_7z(self, num, shard_path, entries, report):
+        shard_name = os.path.basename(shard_path)
+        stored = [apath for apath in entries if apath in self.stored_files]
+        if self.streaming:
+            cwd = self.packing_directory
+            list_entries = [apath for apath in entries if apath not in self.stored_files]
+            args = ["-spf2"]
+        else:
+            cwd = self.temp if self.create_subdir else self.packing_directory
+            list_entries = [self.get_member_name(apath) for apath in entries if apath not in self.stored_files]
+            args = []
+        list_path = self.write_list_file("filelist_{}".format(SHARD_SUFFIX_TEMPLATE.format(num)), list_entries)
+        p7z_cmd = self.get_7z_command(*args, "-spd", "-scsUTF-8", "@" + list_path, archive_path=shard_path)
+        size = self.get_entries_size(entries) - self.get_entries_size(stored)
+        if not self.execute_7z(p7z_cmd, cwd=cwd, output_name=shard_name, size=size):
+            return False
+        if stored and not self.compress_stored_files(cwd, stored, shard_path):
+            return False
+        return self.add_report_7z(report, shard_path)
+
+    def compress_backup_sharded(self):
+        """Splits the archive into shards balanced by size and compresses them at the same time: 7z
+        shards are separate 7z processes, zip shards are compressed in worker processes. Every shard
+        has a report of its own files, the shard index lists the shards of the set."""
+        # Shards are balanced over the whole list, so it is the one place the list is in memory
+        entries = list(self.iter_archive_list())
+        sizes = [self.files_to_backup[apath].st_size if apath in self.files_to_backup else 0 for apath in entries]
+        shards = partition_by_size(zip(entries, sizes), self.shards)
+        dirs = list(self.iter_backed(TYPE_DIR)) if self.json_report else []
+        jobs = []
+        for num, shard_entries in enumerate(shards, 1):
+            shard_files = [apath for apath in shard_entries if apath in self.files_to_backup]
+            report = self.get_backup_report(self.size_before_compression, with_lists=False)
+            if self.json_report:
+                report["files_backed"] = shard_files
+                report["dirs_backed"] = dirs
+            report["shard"] = num
+            jobs.append((num, self.get_shard_path(num), shard_entries,
+                         json.dumps(report, indent=4).encode("utf-8"),
+                         sum(self.files_to_backup[afile].st_size for afile in shard_files)))
+        if self.engine == ENGINE_ZIP:
+            # Every shard compresses on threads of its own
+            threads = self.compression_threads or max(1, (os.cpu_count() or 1) // self.shards)
+            executor = ProcessPoolExecutor(min(self.shards, self.max_threads or self.shards),
+                                           initializer=set_process_priority, initargs=(self.nice, self.ionice_class))
+        else:
+            executor = ThreadPoolExecutor(self.shards)
+        with executor:
+            futures = []
+            for num, shard_path, shard_entries, report, _ in jobs:
+                if self.engine == ENGINE_ZIP:
+                    members = [(self.get_disk_path(apath), self.get_member_name(apath)) for apath in shard_entries]
+                    stored = set(self.get_disk_path(apath) for apath in shard_entries if apath in self.stored_files)
+                    futures.append(executor.submit(compress_zip, shard_path, members, stored,
+                                                   [(self.get_member_name(self.report_name), report)],
+                                                   self.compression_codec, self.compression_level, threads,
+                                                   self.compression_dictionary))
+                else:
+                    futures.append(executor.submit(self.compress_shard_7z, num, shard_path, shard_entries, report))
+            failed = 0
+            for future in futures:
+                try:
+                    if future.result() is False:
+                        failed += 1
+                except BaseException as e:
+                    self.logger.error("Could not compress a shard: {}".format(e.__class__.__name__))
+                    failed += 1
+        if failed:
+            self.logger.error("{} of {} shards could not be compressed.".format(failed, self.shards))
+            # Without the index the other shards are not a restorable set
+            for _, shard_path, _, _, _ in jobs:
+                if os.path.exists(shard_path):
+                    os.remove(shard_path)
+            return False
+        shard_index = {
+            "locbkp_version": self.version,
+            "archive": self.archive_name,
+            "report": self.report_name,
+            "shards": [{"name": os.path.basename(shard_path), "files": len(shard_entries), "size": size}
+                       for _, shard_path, shard_entries, _, size in jobs]
+        }
+        with open("{}.{}".format(self.archive_path, SHARD_INDEX_SUFFIX), "w") as index_file:
+            json.dump(shard_index, index_file, indent=4)
+        return True
+
+    def transfer_manifest(self, path_to):
+        if not os.path.exists(self.manifest_path):
+            return True
+        destfile = self.destination.describe(os.path.basename(self.manifest_path))
+        self.hash_part(self.manifest_path)
+        try:
+            self.destination.put(self.manifest_path, os.path.basename(self.manifest_path), throttle=self.throttle)
+        except BaseException as e:
+            self.logger.error("Could not transfer manifest to {}: {}".format(destfile, e.__class__.__name__))
+            return False
+        return True
 
     def transfer_file(self, path_to):
         self.logger.info("Transferring backup to destination location...")
         time_pre_transfer = datetime.now()
-        destfile = sanitize_path(path_to, self.archive_name)
         try:
-            shutil.copy(self.archive_path, destfile)
+            # Goes first: a backup is complete once its archive is in the destination
+            self.transfer_manifest(path_to)
+            parts = self.get_archive_parts()
+            self.transfer_progress = Progress("Transfer", sum(os.path.getsize(apart) for apart in parts),
+                                              interval=self.progress_interval, throttle=self.throttle)
+            if self.volume_size or self.shards > 1:
+                if self.checksums:
+                    with ThreadPoolExecutor(min(len(parts) or 1, self.get_hashing_threads())) as executor:
+                        list(executor.map(self.hash_part, parts))
+                for apart in parts:
+                    self.transfer_volume(apart, path_to)
+                self.logger.info("Transferred {} parts to {}.".format(len(self.volumes_transferred), path_to))
+                self.write_part_hashes(path_to)
+                if not self.volume_transfer_failed:
+                    self.add_to_catalog(path_to, self.volumes_transferred)
+                return not self.volume_transfer_failed
+            destfile = self.destination.describe(self.archive_name)
+            self.hash_part(self.archive_path)
+            try:
+                # The archive is removed from temp afterwards, so it can simply be moved on the same filesystem
+                strategy = self.destination.put(self.archive_path, self.archive_name, throttle=self.transfer_progress)
+                self.logger.info("Transferred {} using {}.".format(destfile, strategy))
+            except BaseException as e:
+                self.logger.error("Could not transfer backup to {}: {}".format(destfile, e.__class__.__name__))
+                return False
+            self.write_part_hashes(path_to)
+            self.add_to_catalog(path_to, [self.archive_name])
+            return True
+        finally:
+            # Nothing was copied when the archive could be renamed into place
+            if self.transfer_progress is not None and self.transfer_progress.done_bytes:
+                self.transfer_progress.finish()
+            self.transfer_progress = None
+            self.time_transfer_finished = datetime.now()
+            self.time_transfer = self.time_transfer_finished - time_pre_transfer
+
+    def add_to_catalog(self, path_to, parts):
+        if not self.catalog:
+            return
+        extra = ["{}.{}".format(self.archive_name, suffix) for suffix in (MANIFEST_SUFFIX, CHECKSUM_SUFFIX)]
+        report = self.get_member_name(self.report_name) if self.json_report else None
+        record_archive(path_to, self.backup_list[BACKUP_NAME], self.archive_name,
+                       datetime.strptime(self.curdate, DATE_FORMAT), self.backup_mode, report, parts + extra,
+                       self.part_hashes, self.destination)
+
+    def keep_pending(self):
+        """Keeps an archive that could not be transferred in temp, with what is needed to finish the
+        transfer, so the next run transfers it (see resume_pending_transfer). Returns whether it is kept."""
+        pending = {"archive_name": self.archive_name, "date": self.curdate, "backup_type": self.backup_mode,
+                   "temp": self.temp, "multipart": bool(self.volume_size or self.shards > 1),
+                   "report": self.get_member_name(self.report_name) if self.json_report else None,
+                   "transferred": self.volumes_transferred, "part_hashes": self.part_hashes,
+                   "index": self.build_index()}
+        # Whatever an earlier run left is in this archive as well
+        self.discard_pending()
+        try:
+            save_index(self.pending_path, pending)
         except BaseException as e:
-            self.logger.error("Could not transfer backup to {}: {}".format(destfile, e.__class__.__name__))
-        self.time_transfer_finished = datetime.now()
-        self.time_transfer = self.time_transfer_finished - time_pre_transfer
+            self.logger.error("Could not save {}: {}".format(self.pending_path, e.__class__.__name__))
+            self.delete_transferred_volumes()
+            return False
+        self.logger.warning("{} is kept in {}. The next run will transfer it.".format(self.archive_name, self.temp))
+        return True
+
+    def load_pending(self):
+        if not os.path.exists(self.pending_path):
+            return
+        try:
+            with open(self.pending_path, "r", encoding="utf-8") as pending_file:
+                return json.load(pending_file)
+        except BaseException as e:
+            self.logger.warning("Could not read {}: {}".format(self.pending_path, e.__class__.__name__))
+
+    def discard_pending(self):
+        """Removes an archive an earlier run could not transfer from temp and its parts from the destination."""
+        pending = self.load_pending()
+        if pending is None:
+            return
+        self.logger.info("Discarding {} left by an earlier run.".format(pending["archive_name"]))
+        for apart in get_archive_parts(pending["temp"], pending["archive_name"], pending["multipart"]) + \
+                [sanitize_path(pending["temp"], "{}.{}".format(pending["archive_name"], MANIFEST_SUFFIX))]:
+            if os.path.exists(apart):
+                os.remove(apart)
+        # The manifest goes first, so it may be there too
+        for volume_name in pending["transferred"] + ["{}.{}".format(pending["archive_name"], MANIFEST_SUFFIX)]:
+            try:
+                self.destination.delete(volume_name)
+            except FileNotFoundError:
+                pass
+            except BaseException as e:
+                self.logger.error("Could not delete {}: {}".format(self.destination.describe(volume_name),
+                                                                 e.__class__.__name__))
+        os.remove(self.pending_path)
+
+    def resume_pending_transfer(self):
+        """Transfers the archive an earlier run compressed but could not transfer (see keep_pending).
+        Interrupted uploads resume where they stopped. Its index is saved once it is transferred."""
+        pending = self.load_pending()
+        if pending is None:
+            return
+        destdir = self.backup_list[DESTINATION_DIRECTORY]
+        archive_name = pending["archive_name"]
+        temp = pending["temp"]
+        parts = get_archive_parts(temp, archive_name, pending["multipart"])
+        if not parts:
+            self.logger.warning("{} left by an earlier run is gone from {}.".format(archive_name, temp))
+            self.discard_pending()
+            return
+        self.logger.info("Transferring {} left in {} by an earlier run...".format(archive_name, temp))
+        manifest_path = sanitize_path(temp, "{}.{}".format(archive_name, MANIFEST_SUFFIX))
+        part_hashes = pending["part_hashes"]
+        for apart in ([manifest_path] if os.path.exists(manifest_path) else []) + parts:
+            if self.checksums and os.path.basename(apart) not in part_hashes:
+                part_hashes[os.path.basename(apart)] = hash_file(apart)
+            try:
+                self.destination.put(apart, os.path.basename(apart))
+            except BaseException as e:
+                self.logger.error("Could not transfer {} to {}: {}. The next run will try again.".format(
+                    os.path.basename(apart), self.destination.location, e.__class__.__name__))
+                try:
+                    save_index(self.pending_path, pending)
+                except BaseException as e:
+                    self.logger.error("Could not save {}: {}".format(self.pending_path, e.__class__.__name__))
+                return
+            if apart != manifest_path:
+                # Volumes and shards that are already there are not transferred again
+                pending["transferred"].append(os.path.basename(apart))
+                if os.path.exists(apart):
+                    os.remove(apart)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        self.write_part_hashes(destdir, archive_name, temp, part_hashes)
+        if self.catalog:
+            extra = ["{}.{}".format(archive_name, suffix) for suffix in (MANIFEST_SUFFIX, CHECKSUM_SUFFIX)]
+            record_archive(destdir, self.backup_list[BACKUP_NAME], archive_name,
+                           datetime.strptime(pending["date"], DATE_FORMAT), pending["backup_type"],
+                           pending["report"], pending["transferred"] + extra, part_hashes, self.destination)
+        if pending["index"] is not None:
+            try:
+                save_index(self.index_path, pending["index"])
+            except BaseException as e:
+                self.logger.error("Could not save file-state index {}: {}".format(self.index_path,
+                                                                                 e.__class__.__name__))
+        os.remove(self.pending_path)
+        self.logger.info("Transferred {} left by an earlier run.".format(archive_name))
 
     def backup_file(self, file_path):
         destination = sanitize_path(self.packing_directory, file_path)
         # logger.info("Backing up {} to {}".format(file_path, destination))
         try:
-            shutil.copy(file_path, destination)
+            copy_start = time.monotonic()
+            strategy = copy_file(file_path, destination, allow_link=self.staging_hardlinks, throttle=self.throttle)
+            self.metrics.file_copied(file_path, time.monotonic() - copy_start, self.files_to_backup[file_path].st_size)
+            return strategy
         except BaseException as e:
             self.logger.warning("Could not copy {} to {}: {}".format(file_path, destination, e.__class__.__name__))
-        return True
+            self.files_not_backed.append(file_path)
+            return
+
+    def handle_chunkstore_retention(self):
+        store = ChunkStore(sanitize_path(self.backup_list[DESTINATION_DIRECTORY], CHUNKSTORE_DIRECTORY))
+        try:
+            retention = self.backup_list[RETENTION]
+            snapshots = store.list_snapshots(self.backup_list[BACKUP_NAME])
+            self.logger.info("There is {} snapshots in the chunk store. Retention is set to {}."
+                             .format(len(snapshots), retention))
+            if len(snapshots) <= retention:
+                self.logger.info("Nothing to delete.")
+                return
+            for asnapshot in snapshots[:len(snapshots) - retention]:
+                self.logger.info("Removing snapshot {}...".format(asnapshot[0]))
+                store.remove_snapshot(asnapshot[0])
+            store.collect_garbage()
+        finally:
+            store.close()
 
     def handle_retention(self):
+        if self.backend == BACKEND_CHUNKSTORE:
+            self.handle_chunkstore_retention()
+            return
         destdir = self.backup_list[DESTINATION_DIRECTORY]
-        filesindir = files(destdir)
         retention = self.backup_list[RETENTION]
-        backup_files = []
+        try:
+            chains = get_chains(destdir, self.backup_list[BACKUP_NAME], self.catalog, self.destination)
+        except TransferError as e:
+            # The backup itself is done: retention is tried again on the next run
+            self.logger.error("Could not list backups in {}: {}. Skipping retention."
+                              .format(self.destination.location, e))
+            return
+        backup_files_quan = sum(len(achain) for achain in chains)
+        self.logger.info("There is {} backups in {} chains in destination directory. Retention is set to {}."
+                         .format(backup_files_quan, len(chains), retention))
         backups_to_remove = []
-        for afile in filesindir:
-            try:
-                if afile.startswith(self.backup_list[BACKUP_NAME]):
-                    backup_date = datetime.strptime(afile[len(self.backup_list[BACKUP_NAME])+1:-3], DATE_FORMAT)
-                    backup_files.append((afile, backup_date))
-            except Exception as e:
-                continue
-        backup_files_quan = len(backup_files)
-        self.logger.info("There is {} backup files in destination directory. Retention is set to {}."
-                         .format(backup_files_quan, retention))
-        if backup_files_quan > retention:
-            backups_to_remove_quan = backup_files_quan - retention
-            self.logger.info("Will remove {} old backups.".format(backups_to_remove_quan))
-            backup_files.sort(key=lambda x: x[1])
-            backups_to_remove = backup_files[:backups_to_remove_quan]
-        else:
+        # Whole chains are removed, oldest first, so a full backup is never deleted while
+        # backups that depend on it are kept. The newest chain is always kept.
+        while len(chains) > 1 and backup_files_quan - len(chains[0]) >= retention:
+            backup_files_quan -= len(chains[0])
+            backups_to_remove.extend(chains.pop(0))
+        if not backups_to_remove:
             self.logger.info("Nothing to delete.")
             return
-        for afile in backups_to_remove:
-            self.logger.info("Removing {}...".format(afile[0]))
-            os.remove(os.path.join(destdir, afile[0]))
+        self.logger.info("Will remove {} old backups.".format(len(backups_to_remove)))
+        for abackup in backups_to_remove:
+            removed = True
+            for afile in abackup[3]:
+                self.logger.info("Removing {}...".format(afile))
+                try:
+                    self.destination.delete(afile)
+                except FileNotFoundError:
+                    self.logger.warning("{} is already removed.".format(afile))
+                except BaseException as e:
+                    self.logger.error("Could not remove {}: {}".format(afile, e))
+                    removed = False
+            # Left in the catalog otherwise, so the next retention tries again
+            if self.catalog and removed:
+                remove_archive(destdir, self.backup_list[BACKUP_NAME], abackup[0])
+
+    def get_run_record(self):
+        phases = {
+            "preparation": self.time_preparation.total_seconds(),
+            "copy": self.time_copy_temp.total_seconds(),
+            "compress": self.time_compress.total_seconds(),
+            "transfer": self.time_transfer.total_seconds(),
+            "cleanup": self.time_cleanup.total_seconds()
+        }
+        walk = [astage["seconds"] for astage in self.metrics.stages if astage["stage"] == STAGE_WALK]
+        if walk:
+            phases["walk"] = sum(walk)
+        size_before = self.size_before_compression * 1024 * 1024
+        size_after = self.size_after_compression * 1024 * 1024
+        rss_self, rss_children = get_peak_rss()
+        return {
+            "locbkp_version": self.version,
+            "backup_name": self.backup_list[BACKUP_NAME],
+            "backup_list": self.backup_list_path,
+            "archive": self.archive_name,
+            "backup_type": self.backup_mode,
+            "started": self.time_start.timestamp(),
+            "finished": datetime.now().timestamp(),
+            "success": self.success,
+            "failure": self.failure,
+            "phases": phases,
+            "stages": self.metrics.stages,
+            "files": {"found": len(self.files_to_backup), "backed": self.files_backed_count,
+                      "dirs": self.dirs_backed_count, "deleted": len(self.files_deleted)},
+            "bytes": {"uncompressed": round(size_before), "compressed": round(size_after)},
+            "bytes_per_second": {phase: round(size, 3) for phase, size in (
+                ("copy", size_before / phases["copy"] if phases["copy"] else None),
+                ("compress", size_before / phases["compress"] if phases["compress"] else None),
+                ("transfer", size_after / phases["transfer"] if phases["transfer"] else None)) if size is not None},
+            "files_per_second": round(self.files_backed_count / phases["copy"], 3) if phases["copy"] else None,
+            "compression_ratio": round(size_after / size_before, 6) if size_before else None,
+            "compression_level": self.compression_level,
+            "plan": self.plan.to_record() if self.plan is not None else None,
+            "errors": {"stat": self.errors["stat"], "scan": self.errors["scan"],
+                       "copy": len(self.files_to_backup) - self.files_backed_count},
+            "slowest_files": self.metrics.get_slowest_files(),
+            "throttled_seconds": round(self.throttle.time_throttled, 3) if self.throttle is not None else None,
+            "peak_rss_bytes": {"self": rss_self, "children": rss_children}
+        }
+
+    def export_metrics(self):
+        try:
+            os.makedirs(self.metrics_directory, exist_ok=True)
+            write_run_record(self.metrics_directory, self.get_run_record())
+            self.metrics.write_profiles(self.metrics_directory, self.backup_list[BACKUP_NAME], self.curdate)
+            self.logger.info("Metrics are saved to {}.".format(self.metrics_directory))
+        except BaseException as e:
+            self.logger.error("Could not save metrics to {}: {}".format(self.metrics_directory, e.__class__.__name__))
 
     def start(self):
         self.start_backup()
         total_time = datetime.now() - self.time_start
-        self.logger.info("Backed up {} files and {} directories.".format(len(self.files_backed), len(self.dirs_backed)))
+        self.logger.info("Backed up {} files and {} directories.".format(self.files_backed_count,
+                                                                        self.dirs_backed_count))
         self.logger.info(
             "Time: Preparation: {:.3f}s; Copy: {:.3f}s; Compress: {:.3f}s; Transfer: {:.3f}s; Cleanup: {:3f}s."
             .format(self.time_preparation.total_seconds(), self.time_copy_temp.total_seconds(),
                     self.time_compress.total_seconds(),
                     self.time_transfer.total_seconds(), self.time_cleanup.total_seconds()))
-        self.logger.info("Compression effectiveness is {:.2f}%".format(
-            100 - (self.size_after_compression / self.size_before_compression) * 100))
+        if self.success and self.size_before_compression:
+            self.logger.info("Compression effectiveness is {:.2f}%".format(
+                100 - (self.size_after_compression / self.size_before_compression) * 100))
+        if self.throttle is not None:
+            self.logger.info("Throttling waits: {:.3f}s (summed over threads).".format(self.throttle.time_throttled))
         self.logger.info("Total time is {:.3f}s.".format(total_time.total_seconds()))
+        if not self.success:
+            self.logger.error("Backup {} failed: {}.".format(self.archive_name, self.failure or "see the errors above"))
         self.logger.info("Done backing up. Working on retention...")
         self.handle_retention()
+        if self.metrics_enabled:
+            self.export_metrics()
         self.logger.info("=== LocBkp finished ===")
         print(self.archive_name)
+        return self.success
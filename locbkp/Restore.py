@@ -0,0 +1,387 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import json
+import shutil
+import subprocess
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_NAME, DATE_FORMAT, CREATE_SUBDIR, STREAMING, \
+    BACKEND, BACKEND_CHUNKSTORE, CHUNKSTORE_DIRECTORY, COMPRESSION_ENGINE, ENGINE_7Z, P7Z_PATH, MANIFEST_SUFFIX, \
+    SHARD_INDEX_SUFFIX, CHECKSUM_SUFFIX, CATALOG, REMOTE_URL, MODE_DIFFERENTIAL
+from locbkp.utils.catalog import get_chains, rescan_catalog
+from locbkp.utils.chunkstore import ChunkStore, SNAP_MTIME_NS, SNAP_MODE, SNAP_CHUNKS
+from locbkp.utils.manifest import ManifestReader, TYPE_FILE, TYPE_DIR, TYPE_DELETED
+from locbkp.utils.utils import sanitize_path, get_config, split_archive_part, hash_file
+from __main__ import logger
+
+if os.name == "nt":
+    p7z_path = "C:\\Program Files\\7-Zip\\7z.exe"
+else:
+    p7z_path = "/usr/bin/7z"
+
+# Members of one zip archive are split between extraction jobs in slices of at least this many
+min_members_per_job = 64
+staging_directory_name = ".locbkp_restore"
+
+
+def parse_restore_time(value):
+    """Accepts the date format of archive names and ISO 8601."""
+    if value is None:
+        return datetime.now()
+    try:
+        return datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(value)
+
+
+def path_matches(apath, restore_path):
+    return apath == restore_path or apath.startswith(restore_path.rstrip("/") + "/")
+
+
+class Restore:
+    """Restores a path (a file or a directory with everything under it) as it was at a given time:
+    finds the chain of backups made up to that time and takes every file from the newest backup
+    of the chain that has it, so each file is extracted exactly once. Archives are extracted in
+    parallel and only the selected members are extracted."""
+
+    def __init__(self, backup_list_path, restore_path, restore_time=None, target=None, threads=None):
+        self.logger = logger
+        self.backup_list_path = backup_list_path
+        self.backup_list_name = sanitize_path(*os.path.basename(backup_list_path).split(".")[:-1])
+        self.backup_list = get_config(backup_list_path)
+        self.restore_path = os.path.abspath(restore_path)
+        self.restore_time = parse_restore_time(restore_time)
+        self.target = os.path.abspath(target or os.getcwd())
+        self.threads = threads or os.cpu_count() or 1
+        self.files_restored = 0
+        self.dirs_restored = 0
+        self.files_failed = 0
+        self.expected_hashes = {}
+        # Appended to by the extraction jobs
+        self.files_mismatched = []
+        # Reports read from archives by archive path, extracting one can take a while
+        self.reports = {}
+        if not self.backup_list:
+            return
+        self.destdir = self.backup_list[DESTINATION_DIRECTORY]
+        self.backup_name = self.backup_list[BACKUP_NAME]
+        self.p7z_path = self.backup_list[P7Z_PATH] if P7Z_PATH in self.backup_list else p7z_path
+        self.engine = self.backup_list[COMPRESSION_ENGINE] if COMPRESSION_ENGINE in self.backup_list else ENGINE_7Z
+        self.catalog = self.backup_list[CATALOG] if CATALOG in self.backup_list else True
+        self.staging_directory = sanitize_path(self.target, staging_directory_name)
+
+    def start(self):
+        if not self.backup_list:
+            return False
+        if REMOTE_URL in self.backup_list:
+            self.logger.error("Restoring from {} is not supported. Download the archives into a directory and "
+                              "restore from there.".format(REMOTE_URL))
+            return False
+        self.logger.info("Restoring {} as of {} from {} to {}...".format(
+            self.restore_path, self.restore_time.strftime(DATE_FORMAT), self.backup_name, self.target))
+        time_start = datetime.now()
+        backend = self.backup_list[BACKEND] if BACKEND in self.backup_list else None
+        if backend == BACKEND_CHUNKSTORE:
+            result = self.restore_from_chunkstore()
+        else:
+            result = self.restore_from_archives()
+        self.logger.info("Restored {} files and {} directories in {:.3f}s, {} files failed, {} do not match "
+                         "their checksums.".format(self.files_restored, self.dirs_restored,
+                                                   (datetime.now() - time_start).total_seconds(), self.files_failed,
+                                                   len(self.files_mismatched)))
+        return result and not self.files_failed
+
+    def get_restore_chain(self):
+        """Backups of the newest chain made up to the restore time, newest first. A differential
+        backup has everything that changed since the full backup, so only the newest one is used:
+        a file an older differential has and a newer one does not was deleted in between."""
+        chain = []
+        for achain in get_chains(self.destdir, self.backup_name, self.catalog):
+            backups = []
+            for abackup in achain:
+                if abackup[1] > self.restore_time:
+                    continue
+                if abackup[2] == MODE_DIFFERENTIAL:
+                    backups = [x for x in backups if x[2] != MODE_DIFFERENTIAL]
+                backups.append(abackup)
+            if backups:
+                chain = backups
+        return list(reversed(chain))
+
+    def get_manifest_path(self, abackup):
+        return os.path.join(self.destdir, "{}.{}".format(abackup[0], MANIFEST_SUFFIX))
+
+    def get_member_prefix(self, abackup):
+        if os.path.exists(self.get_manifest_path(abackup)):
+            with ManifestReader(self.get_manifest_path(abackup)) as reader:
+                if "member_prefix" in reader.header:
+                    return reader.header["member_prefix"]
+        for archive_file in self.get_archive_files(abackup):
+            report = self.read_report(archive_file)
+            if report is not None and "member_prefix" in report:
+                return report["member_prefix"]
+        # Backups from before the prefix was recorded: the same rule as Backup.get_member_prefix
+        create_subdir = self.backup_list[CREATE_SUBDIR] if CREATE_SUBDIR in self.backup_list else False
+        streaming = self.backup_list[STREAMING] if STREAMING in self.backup_list else False
+        if not create_subdir or (streaming and self.engine == ENGINE_7Z):
+            return ""
+        return "{}_{}".format(self.backup_list_name, abackup[1].strftime(DATE_FORMAT))
+
+    def get_archive_files(self, abackup):
+        """Files to open to read the archive: the archive, its first volume or its shards."""
+        parts = {}
+        for afile in abackup[3]:
+            parts[split_archive_part(afile)[1]] = os.path.join(self.destdir, afile)
+        if None in parts:
+            return [parts[None]]
+        if "001" in parts:
+            return [parts["001"]]
+        return [apath for part, apath in sorted(parts.items())
+                if part not in ("001", SHARD_INDEX_SUFFIX, MANIFEST_SUFFIX, CHECKSUM_SUFFIX)
+                and part.startswith("s")]
+
+    def read_report(self, archive_file):
+        if archive_file not in self.reports:
+            self.reports[archive_file] = self.extract_report(archive_file)
+        return self.reports[archive_file]
+
+    def extract_report(self, archive_file):
+        if zipfile.is_zipfile(archive_file):
+            with zipfile.ZipFile(archive_file) as archive:
+                for member in archive.namelist():
+                    if os.path.basename(member).startswith("LocBkp_report_"):
+                        return json.loads(archive.read(member))
+            return
+        result = subprocess.run([self.p7z_path, "e", "-so", archive_file, "-r", "LocBkp_report_*.json"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode not in (0, 1) or not result.stdout:
+            return
+        return json.loads(result.stdout)
+
+    def iter_backup_entries(self, abackup):
+        """Yields (path, type, mode, mtime_ns, hash) of entries of a backup under the restore path:
+        from the manifest if there is one, otherwise from the json-reports in the archive, which have
+        no modes and mtimes."""
+        if os.path.exists(self.get_manifest_path(abackup)):
+            with ManifestReader(self.get_manifest_path(abackup)) as reader:
+                for entry in reader.iter_entries(self.restore_path):
+                    if path_matches(entry["path"], self.restore_path):
+                        yield entry["path"], entry["type"], entry["mode"], entry["mtime_ns"], entry["hash"]
+            return
+        self.logger.info("{} has no manifest. Reading its report...".format(abackup[0]))
+        for archive_file in self.get_archive_files(abackup):
+            report = self.read_report(archive_file)
+            if report is None:
+                self.logger.warning("Could not read the report of {}.".format(os.path.basename(archive_file)))
+                continue
+            file_hashes = report.get("file_hashes") or {}
+            for key, entry_type in (("files_backed", TYPE_FILE), ("dirs_backed", TYPE_DIR),
+                                    ("files_deleted", TYPE_DELETED)):
+                for apath in report.get(key) or []:
+                    if path_matches(apath, self.restore_path):
+                        yield apath, entry_type, None, None, file_hashes.get(apath)
+
+    def resolve_entries(self, chain):
+        """Returns {path: (type, mode, mtime_ns, index of the backup in chain, hash)}."""
+        resolved = {}
+        for num, abackup in enumerate(chain):
+            for apath, entry_type, mode, mtime_ns, file_hash in self.iter_backup_entries(abackup):
+                # The newest backup that has a path wins, a deletion hides the older copies
+                if apath not in resolved:
+                    resolved[apath] = (entry_type, mode, mtime_ns, num, file_hash)
+        return resolved
+
+    def restore_from_archives(self):
+        chain = self.get_restore_chain()
+        if self.catalog and any(not os.path.exists(os.path.join(self.destdir, afile))
+                                for abackup in chain for afile in abackup[3]):
+            self.logger.warning("The catalog of {} is out of date. Rebuilding it...".format(self.destdir))
+            rescan_catalog(self.destdir, self.backup_name)
+            chain = self.get_restore_chain()
+        if not chain:
+            self.logger.error("No backups of {} made before {} in {}.".format(
+                self.backup_name, self.restore_time.strftime(DATE_FORMAT), self.destdir))
+            return False
+        self.logger.info("Restoring from {} backups: {}.".format(len(chain), ", ".join(x[0] for x in reversed(chain))))
+        resolved = self.resolve_entries(chain)
+        to_restore = {apath: entry for apath, entry in resolved.items() if entry[0] == TYPE_FILE}
+        dirs = [(apath, entry[1], entry[2]) for apath, entry in resolved.items() if entry[0] == TYPE_DIR]
+        if not to_restore and not dirs:
+            self.logger.error("{} is not in the backups.".format(self.restore_path))
+            return False
+        jobs = []
+        for num, abackup in enumerate(chain):
+            paths = sorted(apath for apath, entry in to_restore.items() if entry[3] == num)
+            if not paths:
+                continue
+            archive_files = self.get_archive_files(abackup)
+            member_prefix = self.get_member_prefix(abackup)
+            if len(archive_files) > 1:
+                # Shards: every shard is searched for all the paths, 7z skips the ones it does not have
+                jobs.extend((archive_file, member_prefix, paths) for archive_file in archive_files)
+                continue
+            # 7z archives are solid: every slice would decompress the same blocks again, so only zip
+            # members, compressed one by one, are spread over jobs
+            slices = max(1, min(self.threads // len(chain), len(paths) // min_members_per_job)) \
+                if zipfile.is_zipfile(archive_files[0]) else 1
+            jobs.extend((archive_files[0], member_prefix, paths[i::slices]) for i in range(slices))
+        self.expected_hashes = {apath: entry[4] for apath, entry in to_restore.items() if entry[4] is not None}
+        self.logger.info("Extracting {} files with {} jobs...".format(len(to_restore), len(jobs)))
+        extracted = set()
+        os.makedirs(self.staging_directory, exist_ok=True)
+        try:
+            with ThreadPoolExecutor(self.threads) as executor:
+                futures = [executor.submit(self.extract_job, num, *ajob) for num, ajob in enumerate(jobs)]
+                # Files are moved into place here, so a file extracted from two shards is placed once
+                for future in futures:
+                    try:
+                        staging, members = future.result()
+                    except BaseException as e:
+                        self.logger.error("Extraction failed: {}".format(e.__class__.__name__))
+                        continue
+                    for member, apath in members.items():
+                        if apath not in extracted and self.place_file(os.path.join(staging, member), apath,
+                                                                      to_restore[apath]):
+                            extracted.add(apath)
+        finally:
+            shutil.rmtree(self.staging_directory, ignore_errors=True)
+        for apath in to_restore:
+            if apath not in extracted:
+                self.logger.warning("Could not restore {}.".format(apath))
+                self.files_failed += 1
+        self.restore_dirs(dirs)
+        return True
+
+    def extract_job(self, job_num, archive_file, member_prefix, paths):
+        """Extracts paths from one archive file into a staging directory of its own.
+        Returns (staging directory, {member name: path})."""
+        members = {os.path.join(member_prefix, apath.lstrip("/")): apath for apath in paths}
+        staging = os.path.join(self.staging_directory, str(job_num))
+        os.makedirs(staging, exist_ok=True)
+        if zipfile.is_zipfile(archive_file):
+            self.extract_zip(archive_file, members, staging)
+        else:
+            self.extract_7z(archive_file, members, staging, job_num)
+        # Checked here, so files are hashed by all the jobs in parallel
+        for member, apath in members.items():
+            extracted = os.path.join(staging, member)
+            if apath in self.expected_hashes and os.path.exists(extracted) and \
+                    hash_file(extracted) != self.expected_hashes[apath]:
+                # Kept: a file written to while a streaming backup hashed and then compressed it has
+                # a checksum of other bytes than the archived ones, and this copy is the only one
+                self.logger.warning("{} from {} does not match its checksum: it changed while it was backed up or "
+                                    "the archive is damaged. Restoring it as archived.".format(
+                                        apath, os.path.basename(archive_file)))
+                self.files_mismatched.append(apath)
+        return staging, members
+
+    def extract_7z(self, archive_file, members, staging, job_num):
+        list_path = os.path.join(self.staging_directory, "list_{}.txt".format(job_num))
+        with open(list_path, "w", encoding="utf-8") as list_file:
+            for member in members:
+                list_file.write(member + "\n")
+        p7z_cmd = [self.p7z_path, "x", archive_file, "-o" + staging, "-y", "-spd", "-scsUTF-8", "@" + list_path]
+        result = subprocess.run(p7z_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # 1 is a warning, e.g. a shard that does not have some of the members
+        if result.returncode not in (0, 1):
+            self.logger.error("Could not extract from {}: 7z exited with code {}: {}".format(
+                os.path.basename(archive_file), result.returncode, result.stdout.decode(errors="replace")))
+
+    def extract_zip(self, archive_file, members, staging):
+        with zipfile.ZipFile(archive_file) as archive:
+            names = set(archive.namelist())
+            for member in members:
+                if member in names:
+                    archive.extract(member, staging)
+
+    def apply_metadata(self, apath, mode, mtime_ns):
+        try:
+            if mode is not None:
+                os.chmod(apath, mode & 0o7777)
+            if mtime_ns is not None:
+                os.utime(apath, ns=(mtime_ns, mtime_ns))
+        except OSError as e:
+            self.logger.warning("Could not restore permissions or mtime of {}: {}".format(apath, e.__class__.__name__))
+
+    def place_file(self, extracted, apath, entry):
+        if not os.path.exists(extracted):
+            return False
+        destination = sanitize_path(self.target, apath)
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.replace(extracted, destination)
+        except BaseException as e:
+            self.logger.warning("Could not restore {} to {}: {}".format(apath, destination, e.__class__.__name__))
+            return False
+        self.apply_metadata(destination, entry[1], entry[2])
+        self.files_restored += 1
+        return True
+
+    def restore_dirs(self, dirs):
+        # Deepest first: restoring a child changes the mtime of its parent
+        for adir, mode, mtime_ns in sorted(dirs, key=lambda x: x[0].count("/"), reverse=True):
+            destination = sanitize_path(self.target, adir)
+            try:
+                os.makedirs(destination, exist_ok=True)
+            except BaseException as e:
+                self.logger.warning("Could not create directory {}: {}".format(destination, e.__class__.__name__))
+                continue
+            self.apply_metadata(destination, mode, mtime_ns)
+            self.dirs_restored += 1
+
+    def restore_from_chunkstore(self):
+        store = ChunkStore(sanitize_path(self.destdir, CHUNKSTORE_DIRECTORY))
+        try:
+            snapshots = [asnapshot for asnapshot in store.list_snapshots(self.backup_name)
+                         if asnapshot[1] <= self.restore_time]
+            if not snapshots:
+                self.logger.error("No snapshots of {} made before {}.".format(
+                    self.backup_name, self.restore_time.strftime(DATE_FORMAT)))
+                return False
+            self.logger.info("Restoring from snapshot {}.".format(snapshots[-1][0]))
+            snapshot = store.load_snapshot(snapshots[-1][0])
+            to_restore = {apath: entry for apath, entry in snapshot["files"].items()
+                          if path_matches(apath, self.restore_path)}
+            dirs = [(adir, mode, None) for adir, mode in snapshot["dirs"].items() if path_matches(adir, self.restore_path)]
+            if not to_restore and not dirs:
+                self.logger.error("{} is not in the snapshot.".format(self.restore_path))
+                return False
+            with ThreadPoolExecutor(self.threads) as executor:
+                results = executor.map(self.restore_chunked_file, [store] * len(to_restore), to_restore.items())
+                for restored in results:
+                    if restored:
+                        self.files_restored += 1
+                    else:
+                        self.files_failed += 1
+            self.restore_dirs(dirs)
+        finally:
+            store.close()
+        return True
+
+    def restore_chunked_file(self, store, item):
+        apath, entry = item
+        destination = sanitize_path(self.target, apath)
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            store.restore_file(entry[SNAP_CHUNKS], destination)
+        except BaseException as e:
+            self.logger.warning("Could not restore {} to {}: {}".format(apath, destination, e.__class__.__name__))
+            return False
+        self.apply_metadata(destination, entry[SNAP_MODE], entry[SNAP_MTIME_NS])
+        return True
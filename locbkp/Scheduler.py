@@ -0,0 +1,156 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from locbkp.Backup import Backup
+from locbkp.utils.catalog import get_chains
+from locbkp.utils.destination import get_destination
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_NAME, MODE_FULL, CATALOG
+from locbkp.utils.planner import TempSpace, TempReservation
+from locbkp.utils.utils import sanitize_path, get_config
+from __main__ import logger
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+
+class Job:
+    def __init__(self, backup_list_path):
+        self.backup_list_path = backup_list_path
+        self.name = sanitize_path(*os.path.basename(backup_list_path).split(".")[:-1])
+        self.estimate = None
+        self.status = STATUS_PENDING
+        self.error = ""
+        self.backup = None
+        self.reserved = 0
+        self.time_start = None
+        self.time_end = None
+
+
+def estimate_size(backup_list_path):
+    """Size of the last full backup of a list with its chain, or None if there is none. Compressed
+    size is only a proxy for the work a backup takes, but it is known without scanning anything."""
+    config = get_config(backup_list_path)
+    if not config:
+        return
+    destdir = config[DESTINATION_DIRECTORY]
+    use_catalog = config[CATALOG] if CATALOG in config else True
+    destination = get_destination(config)
+    try:
+        chains = [achain for achain in get_chains(destdir, config[BACKUP_NAME], use_catalog, destination)
+                  if achain[0][2] == MODE_FULL]
+        if not chains:
+            return
+        return sum(destination.get_size(afile) or 0 for abackup in chains[-1] for afile in abackup[3])
+    except BaseException as e:
+        logger.warning("Could not estimate the size of {}: {}".format(backup_list_path, e))
+
+
+class Scheduler:
+    """Runs backup lists concurrently: at most max_jobs at once, with at most max_temp_gb of temporary
+    space reserved by running jobs and max_compression_threads shared between them. The biggest
+    backups start first, so the long ones do not end up running alone at the end of the window.
+    A failing backup does not stop the others."""
+
+    def __init__(self, backup_lists, max_jobs=1, max_temp_gb=None, max_compression_threads=None):
+        self.logger = logger
+        self.jobs = [Job(alist) for alist in backup_lists]
+        self.max_jobs = max(1, max_jobs or 1)
+        self.max_temp_space = max_temp_gb * 1024 * 1024 * 1024 if max_temp_gb else None
+        self.max_compression_threads = max_compression_threads
+        self.reserved = 0
+        self.condition = threading.Condition()
+        # Free temp space the running backups planned with, so they do not pick the same space
+        self.temp_space = TempSpace()
+
+    def reserve(self, job):
+        if self.max_temp_space is None:
+            return
+        job.reserved = job.backup.get_required_temp_space()
+        with self.condition:
+            # A job bigger than the limit still runs, but only alone
+            while self.reserved and self.reserved + job.reserved > self.max_temp_space:
+                self.logger.info("{} waits for {:.3f}G of temporary space.".format(
+                    job.name, job.reserved / 1024 / 1024 / 1024))
+                self.condition.wait()
+            self.reserved += job.reserved
+
+    def release(self, job):
+        if self.max_temp_space is None:
+            return
+        with self.condition:
+            self.reserved -= job.reserved
+            job.reserved = 0
+            self.condition.notify_all()
+
+    def run_job(self, job):
+        job.status = STATUS_RUNNING
+        job.time_start = datetime.now()
+        share = max(1, self.max_compression_threads // self.max_jobs) if self.max_compression_threads else None
+        reservation = TempReservation(self.temp_space)
+        try:
+            # The share is passed in, so the plan is made with it
+            job.backup = Backup(job.backup_list_path, share, reservation)
+            self.reserve(job)
+            try:
+                job.status = STATUS_OK if job.backup.start() else STATUS_FAILED
+                if job.status == STATUS_FAILED:
+                    job.error = job.backup.failure or ""
+            finally:
+                self.release(job)
+        # SystemExit too: one backup must not end the whole batch
+        except BaseException as e:
+            self.logger.error("Backup {} failed: {}: {}".format(job.name, e.__class__.__name__, e))
+            job.status = STATUS_FAILED
+            job.error = "{}: {}".format(e.__class__.__name__, e)
+        finally:
+            reservation.release()
+        job.time_end = datetime.now()
+
+    def run(self):
+        for job in self.jobs:
+            job.estimate = estimate_size(job.backup_list_path)
+        # Unknown sizes first: a list that has never been backed up gets a full backup
+        self.jobs.sort(key=lambda x: (x.estimate is not None, -(x.estimate or 0)))
+        self.logger.info("Running {} backups, {} at a time.".format(len(self.jobs), self.max_jobs))
+        if self.max_jobs == 1:
+            for job in self.jobs:
+                self.run_job(job)
+        else:
+            with ThreadPoolExecutor(self.max_jobs) as executor:
+                list(executor.map(self.run_job, self.jobs))
+        self.log_summary()
+        return all(job.status == STATUS_OK for job in self.jobs)
+
+    def log_summary(self):
+        rows = [("Backup list", "Status", "Files", "Size, Mb", "Compressed, Mb", "Time, s", "Error")]
+        for job in self.jobs:
+            backup = job.backup
+            rows.append((job.name, job.status,
+                         str(backup.files_backed_count) if backup else "-",
+                         "{:.3f}".format(backup.size_before_compression) if backup else "-",
+                         "{:.3f}".format(backup.size_after_compression) if backup else "-",
+                         "{:.3f}".format((job.time_end - job.time_start).total_seconds()) if job.time_end else "-",
+                         job.error))
+        widths = [max(len(row[num]) for row in rows) for num in range(len(rows[0]))]
+        self.logger.info("Summary:")
+        for row in rows:
+            self.logger.info(" | ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
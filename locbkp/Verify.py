@@ -0,0 +1,114 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_NAME, BACKEND, BACKEND_CHUNKSTORE, \
+    CHUNKSTORE_DIRECTORY, CHECKSUM_SUFFIX, CATALOG, REMOTE_URL
+from locbkp.utils.catalog import get_chains
+from locbkp.utils.chunkstore import ChunkStore, SNAP_CHUNKS
+from locbkp.utils.utils import sanitize_path, get_config, hash_file, read_checksums
+from __main__ import logger
+
+
+class Verify:
+    """Re-reads the backups of a backup list in DESTDIR and checks them against the checksums
+    stored next to them (CHECKSUMS) without extracting anything. Files are hashed in parallel:
+    hashlib releases the GIL, so the threads are only limited by the disks."""
+
+    def __init__(self, backup_list_path, threads=None):
+        self.logger = logger
+        self.backup_list_path = backup_list_path
+        self.backup_list = get_config(backup_list_path)
+        self.threads = threads or os.cpu_count() or 1
+        self.files_verified = 0
+        self.files_failed = 0
+        self.backups_unverified = 0
+
+    def start(self):
+        if not self.backup_list:
+            return False
+        if REMOTE_URL in self.backup_list:
+            self.logger.error("Verifying backups in {} is not supported: parts are checked by their MD5 and SHA-256 "
+                              "while they are uploaded.".format(REMOTE_URL))
+            return False
+        time_start = datetime.now()
+        backend = self.backup_list[BACKEND] if BACKEND in self.backup_list else None
+        if backend == BACKEND_CHUNKSTORE:
+            self.verify_chunkstore()
+        else:
+            self.verify_archives()
+        self.logger.info("Verified {} files in {:.3f}s: {} failed, {} backups have no checksums."
+                         .format(self.files_verified, (datetime.now() - time_start).total_seconds(),
+                                 self.files_failed, self.backups_unverified))
+        return not self.files_failed
+
+    def verify_file(self, apath, expected):
+        if not os.path.exists(apath):
+            return "missing"
+        if hash_file(apath) != expected:
+            return "checksum mismatch"
+
+    def verify_archives(self):
+        destdir = self.backup_list[DESTINATION_DIRECTORY]
+        checks = []
+        use_catalog = self.backup_list[CATALOG] if CATALOG in self.backup_list else True
+        for achain in get_chains(destdir, self.backup_list[BACKUP_NAME], use_catalog):
+            for archive_name, _, _, _ in achain:
+                checksums_path = os.path.join(destdir, "{}.{}".format(archive_name, CHECKSUM_SUFFIX))
+                if not os.path.exists(checksums_path):
+                    self.logger.info("{} has no checksums. Skipping it.".format(archive_name))
+                    self.backups_unverified += 1
+                    continue
+                checks.extend((os.path.join(destdir, filename), expected)
+                              for filename, expected in read_checksums(checksums_path).items())
+        self.logger.info("Verifying {} files in {} with {} threads...".format(len(checks), destdir, self.threads))
+        with ThreadPoolExecutor(self.threads) as executor:
+            for (apath, _), error in zip(checks, executor.map(lambda x: self.verify_file(*x), checks)):
+                self.files_verified += 1
+                if error is not None:
+                    self.logger.error("{}: {}".format(os.path.basename(apath), error))
+                    self.files_failed += 1
+
+    def verify_chunk(self, store, chunk_hash):
+        try:
+            store.read_chunk(chunk_hash)
+        except BaseException as e:
+            return e.__class__.__name__
+
+    def verify_chunkstore(self):
+        """Every chunk referenced by a snapshot is read back and checked against its hash."""
+        store = ChunkStore(sanitize_path(self.backup_list[DESTINATION_DIRECTORY], CHUNKSTORE_DIRECTORY))
+        try:
+            referenced = set()
+            for snapshot_name, _ in store.list_snapshots(self.backup_list[BACKUP_NAME]):
+                for entry in store.load_snapshot(snapshot_name)["files"].values():
+                    referenced.update(entry[SNAP_CHUNKS])
+            missing = [chunk_hash for chunk_hash in referenced if chunk_hash not in store.chunks]
+            for chunk_hash in missing:
+                self.logger.error("Chunk {}: missing".format(chunk_hash))
+            self.files_failed += len(missing)
+            chunks = [chunk_hash for chunk_hash in referenced if chunk_hash in store.chunks]
+            self.logger.info("Verifying {} chunks with {} threads...".format(len(chunks), self.threads))
+            with ThreadPoolExecutor(self.threads) as executor:
+                for chunk_hash, error in zip(chunks, executor.map(self.verify_chunk, [store] * len(chunks), chunks)):
+                    self.files_verified += 1
+                    if error is not None:
+                        self.logger.error("Chunk {}: {}".format(chunk_hash, error))
+                        self.files_failed += 1
+        finally:
+            store.close()
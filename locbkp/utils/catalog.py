@@ -0,0 +1,231 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Catalog of the archives in a destination directory (.locbkp/catalog.sqlite), so retention,
+listing and restore do not list and parse the whole directory. An archive is added when it is
+transferred and removed by retention, both in a transaction. The first time a backup name is looked
+up, its archives are found by scanning the directory; --rescan does the same after the directory was
+changed by hand. With a remote destination the catalog is still kept in DESTDIR and scans list the
+remote objects."""
+
+import os
+import sqlite3
+from datetime import datetime
+
+from locbkp.utils.destination import LocalDestination, TransferError
+from locbkp.utils.dictionary import META_DIRECTORY, CATALOG_FILENAME, CHECKSUM_SUFFIX
+from locbkp.utils.utils import logger, parse_backup_filename, read_checksums, get_backup_chains, \
+    group_backup_chains
+
+CATALOG_VERSION = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job TEXT PRIMARY KEY,
+    scanned TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archives (
+    archive TEXT PRIMARY KEY,
+    job TEXT NOT NULL,
+    date TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    report TEXT
+);
+CREATE INDEX IF NOT EXISTS archives_job_date ON archives (job, date);
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    archive TEXT NOT NULL,
+    size INTEGER,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+"""
+
+
+def get_catalog_path(destdir):
+    return os.path.join(destdir, META_DIRECTORY, CATALOG_FILENAME)
+
+
+class Catalog:
+    """Archives are (archive name, date, mode, report) rows of a job (a backup name), every file of
+    an archive (volumes, shards, the manifest, checksums) is a (filename, size, sha256) row. Dates
+    are ISO 8601, so they sort as text and are read back exactly."""
+
+    def __init__(self, destdir, destination=None):
+        self.destdir = destdir
+        self.destination = destination or LocalDestination(destdir)
+        os.makedirs(os.path.join(destdir, META_DIRECTORY), exist_ok=True)
+        # No WAL: it needs shared memory, which network filesystems do not have
+        self.connection = sqlite3.connect(get_catalog_path(destdir), timeout=60)
+        try:
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, CATALOG_VERSION):
+                raise sqlite3.DatabaseError("unsupported catalog version {}".format(version))
+            with self.connection:
+                self.connection.executescript(schema)
+                self.connection.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+        except BaseException:
+            self.connection.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def is_scanned(self, job):
+        return self.connection.execute("SELECT 1 FROM jobs WHERE job = ?", (job,)).fetchone() is not None
+
+    def insert_archive(self, job, archive_name, date, mode, report, archive_files):
+        """archive_files: (filename, size, sha256 or None). Call within a transaction."""
+        self.connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)",
+                                (archive_name, job, date.isoformat(), mode, report))
+        self.connection.execute("DELETE FROM files WHERE archive = ?", (archive_name,))
+        self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                                    [(filename, archive_name, size, file_hash)
+                                     for filename, size, file_hash in archive_files])
+
+    def add_archive(self, job, archive_name, date, mode, report, archive_files):
+        with self.connection:
+            self.insert_archive(job, archive_name, date, mode, report, archive_files)
+
+    def remove_archive(self, archive_name):
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE archive = ?", (archive_name,))
+            self.connection.execute("DELETE FROM archives WHERE archive = ?", (archive_name,))
+
+    def rescan(self, job):
+        """Replaces what the catalog has for job with what is in the directory."""
+        logger.info("Scanning {} for backups of {}...".format(self.destination.location, job))
+        sizes = {name: size for name, size in self.destination.list_files().items()
+                 if parse_backup_filename(name, job) is not None}
+        chains = get_backup_chains(sizes, job)
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE archive IN (SELECT archive FROM archives WHERE job = ?)",
+                                    (job,))
+            self.connection.execute("DELETE FROM archives WHERE job = ?", (job,))
+            for achain in chains:
+                for archive_name, date, mode, archive_files in achain:
+                    hashes = {}
+                    checksums_name = "{}.{}".format(archive_name, CHECKSUM_SUFFIX)
+                    if checksums_name in sizes and not self.destination.remote:
+                        try:
+                            hashes = read_checksums(os.path.join(self.destdir, checksums_name))
+                        except OSError as e:
+                            logger.warning("Could not read {}: {}".format(checksums_name, e.__class__.__name__))
+                    self.insert_archive(job, archive_name, date, mode, None,
+                                        [(afile, sizes[afile], hashes.get(afile)) for afile in archive_files])
+            self.connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?)", (job, datetime.now().isoformat()))
+        logger.info("Catalog of {}: {} backups of {}.".format(self.destination.location, sum(len(x) for x in chains),
+                                                            job))
+
+    def get_backups(self, job):
+        """(archive name, date, mode, report, [(filename, size, sha256)]) sorted by date. The directory is
+        scanned if job is looked up for the first time."""
+        if not self.is_scanned(job):
+            self.rescan(job)
+        backups = {}
+        rows = self.connection.execute(
+            "SELECT archives.archive, date, mode, report, filename, size, hash FROM archives "
+            "JOIN files ON files.archive = archives.archive WHERE job = ? ORDER BY date, filename", (job,))
+        for archive_name, date, mode, report, filename, size, file_hash in rows:
+            backups.setdefault(archive_name, (archive_name, datetime.fromisoformat(date), mode, report, []))[4] \
+                .append((filename, size, file_hash))
+        return list(backups.values())
+
+    def get_backup_chains(self, job):
+        """The same chains as utils.get_backup_chains gives for the directory."""
+        return group_backup_chains([(archive_name, date, mode, [afile[0] for afile in archive_files])
+                                    for archive_name, date, mode, _, archive_files in self.get_backups(job)])
+
+
+def get_chains(destdir, backup_name, use_catalog=True, destination=None):
+    """Chains of backups of backup_name from the catalog of destdir, or from the destination itself if
+    the catalog is disabled or cannot be used."""
+    destination = destination or LocalDestination(destdir)
+    if use_catalog:
+        try:
+            with Catalog(destdir, destination) as catalog:
+                return catalog.get_backup_chains(backup_name)
+        except (sqlite3.Error, OSError, TransferError) as e:
+            logger.warning("Could not use the catalog of {}: {}. Scanning the directory.".format(destdir, e))
+    return get_backup_chains(destination.list_files(), backup_name)
+
+
+def rescan_catalog(destdir, backup_name, destination=None):
+    try:
+        with Catalog(destdir, destination) as catalog:
+            catalog.rescan(backup_name)
+        return True
+    except (sqlite3.Error, OSError, TransferError) as e:
+        logger.error("Could not rebuild the catalog of {}: {}".format(destdir, e))
+        return False
+
+
+def record_archive(destdir, backup_name, archive_name, date, mode, report, filenames, hashes, destination=None):
+    """Adds a transferred archive: filenames are its files in the destination, hashes their sha256 if known."""
+    try:
+        with Catalog(destdir, destination) as catalog:
+            # An archive added to a catalog that was never filled would hide the older ones
+            if catalog.is_scanned(backup_name):
+                sizes = [(filename, catalog.destination.get_size(filename)) for filename in filenames]
+                catalog.add_archive(backup_name, archive_name, date, mode, report,
+                                    [(filename, size, hashes.get(filename)) for filename, size in sizes
+                                     if size is not None])
+    except (sqlite3.Error, OSError, TransferError) as e:
+        logger.error("Could not add {} to the catalog: {}".format(archive_name, e))
+        forget_job(destdir, backup_name)
+
+
+def remove_archive(destdir, backup_name, archive_name):
+    try:
+        with Catalog(destdir) as catalog:
+            catalog.remove_archive(archive_name)
+    except (sqlite3.Error, OSError) as e:
+        logger.error("Could not remove {} from the catalog: {}".format(archive_name, e))
+        forget_job(destdir, backup_name)
+
+
+def forget_job(destdir, backup_name):
+    """A catalog that may be out of date is rebuilt from a scan the next time it is used."""
+    try:
+        with Catalog(destdir) as catalog:
+            with catalog.connection:
+                catalog.connection.execute("DELETE FROM jobs WHERE job = ?", (backup_name,))
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def print_backups(destdir, backup_name, rescan=False, destination=None):
+    """Prints the backups of backup_name: name, date, mode, size and number of files."""
+    try:
+        with Catalog(destdir, destination) as catalog:
+            if rescan:
+                catalog.rescan(backup_name)
+            backups = catalog.get_backups(backup_name)
+    except (sqlite3.Error, OSError, TransferError) as e:
+        logger.error("Could not read the catalog of {}: {}".format(destdir, e))
+        return False
+    for archive_name, date, mode, _, archive_files in backups:
+        size = sum(afile[1] or 0 for afile in archive_files)
+        print("{}\t{}\t{}\t{:.3f}Mb\t{} files".format(archive_name, date.isoformat(sep=" "), mode,
+                                                    size / 1024 / 1024, len(archive_files)))
+    logger.info("{} backups of {} in {}.".format(len(backups), backup_name, destdir))
+    return True
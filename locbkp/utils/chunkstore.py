@@ -0,0 +1,291 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import hashlib
+import json
+import os
+import zlib
+from collections import Counter
+from datetime import datetime
+
+from locbkp.utils.dictionary import DATE_FORMAT
+from locbkp.utils.utils import logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+PACK_SIZE = 64 * 1024 * 1024
+# Packs that have less live data than this are rewritten during garbage collection
+REPACK_RATIO = 0.5
+COMPRESSION_LEVEL = 3
+
+# Chunk boundaries are content-defined: every byte is mapped to one bit and a chunk ends where
+# the resulting bit string contains ANCHOR. The boundary only depends on the last len(ANCHOR)
+# bytes, so inserting data into a file shifts only the chunks around the insertion.
+# bytes.translate and bytes.find run in C, which is orders of magnitude faster than a rolling
+# hash computed byte by byte in Python. The average chunk is CHUNK_MIN_SIZE + 2^len(ANCHOR).
+BIT_TABLE = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+ANCHOR = bytes((int.from_bytes(hashlib.sha256(b"LocBkp").digest(), "little") >> i) & 1 for i in range(20))
+
+# Positions of the values stored per file in snapshots
+SNAP_SIZE = 0
+SNAP_MTIME_NS = 1
+SNAP_MODE = 2
+SNAP_INODE = 3
+SNAP_CHUNKS = 4
+
+
+def find_chunk_boundary(buf, start, end):
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    search_from = start + CHUNK_MIN_SIZE - len(ANCHOR)
+    found = buf[search_from:end].translate(BIT_TABLE).find(ANCHOR)
+    if found == -1:
+        return end
+    return search_from + found + len(ANCHOR)
+
+
+def iter_chunks(afile):
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        while not eof and len(buf) - pos < CHUNK_MAX_SIZE:
+            data = afile.read(READ_SIZE)
+            if not data:
+                eof = True
+                break
+            buf = buf[pos:] + data
+            pos = 0
+        if pos >= len(buf):
+            return
+        cut = find_chunk_boundary(buf, pos, min(len(buf), pos + CHUNK_MAX_SIZE))
+        yield buf[pos:cut]
+        pos = cut
+
+
+class ChunkStore:
+    """A content-addressed chunk repository. Chunks are stored once by their sha256 in pack files
+    (packs/pack-N.pack) described by pack indexes (packs/pack-N.idx, written when a pack is sealed).
+    Every backup run is a snapshot manifest in snapshots/ that maps paths to lists of chunks."""
+
+    def __init__(self, path):
+        self.path = path
+        self.packs_path = os.path.join(path, "packs")
+        self.snapshots_path = os.path.join(path, "snapshots")
+        os.makedirs(self.packs_path, exist_ok=True)
+        os.makedirs(self.snapshots_path, exist_ok=True)
+        self.lock_file = open(os.path.join(path, "lock"), "a")
+        if fcntl is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.chunks = {}
+        self.pack_chunks = {}
+        self.current_pack = None
+        self.current_pack_id = None
+        self.current_pack_chunks = {}
+        self.next_pack_id = 0
+        self.bytes_written = 0
+        self.chunks_written = 0
+        self.load_packs()
+
+    def pack_path(self, pack_id, extension):
+        return os.path.join(self.packs_path, "pack-{:08d}.{}".format(pack_id, extension))
+
+    def load_packs(self):
+        for afile in os.listdir(self.packs_path):
+            name, extension = os.path.splitext(afile)
+            if not name.startswith("pack-"):
+                continue
+            pack_id = int(name[len("pack-"):])
+            self.next_pack_id = max(self.next_pack_id, pack_id + 1)
+            if extension == ".pack" and not os.path.exists(self.pack_path(pack_id, "idx")):
+                # Left over by an interrupted run: nothing references it
+                logger.warning("Removing unsealed pack {}.".format(afile))
+                os.remove(os.path.join(self.packs_path, afile))
+            elif extension == ".idx":
+                with open(os.path.join(self.packs_path, afile), "r") as idx_file:
+                    pack_index = json.load(idx_file)
+                self.pack_chunks[pack_id] = pack_index
+                for chunk_hash, entry in pack_index.items():
+                    self.chunks[chunk_hash] = (pack_id, entry[0], entry[1], entry[2])
+        logger.info("Chunk store {}: {} chunks in {} packs.".format(self.path, len(self.chunks),
+                                                                    len(self.pack_chunks)))
+
+    def close(self):
+        self.seal_pack()
+        if fcntl is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+    def seal_pack(self):
+        if self.current_pack is None:
+            return
+        self.current_pack.flush()
+        os.fsync(self.current_pack.fileno())
+        self.current_pack.close()
+        idx_path = self.pack_path(self.current_pack_id, "idx")
+        with open(idx_path + ".tmp", "w") as idx_file:
+            json.dump(self.current_pack_chunks, idx_file)
+            idx_file.flush()
+            os.fsync(idx_file.fileno())
+        os.replace(idx_path + ".tmp", idx_path)
+        self.pack_chunks[self.current_pack_id] = self.current_pack_chunks
+        self.current_pack = None
+        self.current_pack_id = None
+        self.current_pack_chunks = {}
+
+    def write_record(self, chunk_hash, record, compressed):
+        if self.current_pack is None:
+            self.current_pack_id = self.next_pack_id
+            self.next_pack_id += 1
+            self.current_pack = open(self.pack_path(self.current_pack_id, "pack"), "wb")
+        offset = self.current_pack.tell()
+        self.current_pack.write(record)
+        self.current_pack_chunks[chunk_hash] = [offset, len(record), compressed]
+        self.chunks[chunk_hash] = (self.current_pack_id, offset, len(record), compressed)
+        self.bytes_written += len(record)
+        self.chunks_written += 1
+        if offset + len(record) >= PACK_SIZE:
+            self.seal_pack()
+
+    def add_chunk(self, data):
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        if chunk_hash in self.chunks:
+            return chunk_hash
+        record = zlib.compress(data, COMPRESSION_LEVEL)
+        if len(record) < len(data):
+            self.write_record(chunk_hash, record, 1)
+        else:
+            self.write_record(chunk_hash, data, 0)
+        return chunk_hash
+
+    def read_record(self, chunk_hash):
+        pack_id, offset, length, compressed = self.chunks[chunk_hash]
+        if pack_id == self.current_pack_id:
+            self.current_pack.flush()
+        with open(self.pack_path(pack_id, "pack"), "rb") as pack:
+            pack.seek(offset)
+            return pack.read(length), compressed
+
+    def read_chunk(self, chunk_hash):
+        record, compressed = self.read_record(chunk_hash)
+        data = zlib.decompress(record) if compressed else record
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise IOError("Chunk {} is corrupted".format(chunk_hash))
+        return data
+
+    def has_chunks(self, chunk_hashes):
+        return all(chunk_hash in self.chunks for chunk_hash in chunk_hashes)
+
+    def store_file(self, file_path):
+        with open(file_path, "rb") as afile:
+            return [self.add_chunk(chunk) for chunk in iter_chunks(afile)]
+
+    def restore_file(self, chunk_hashes, destination):
+        with open(destination, "wb") as afile:
+            for chunk_hash in chunk_hashes:
+                afile.write(self.read_chunk(chunk_hash))
+
+    def snapshot_path(self, snapshot_name):
+        return os.path.join(self.snapshots_path, snapshot_name)
+
+    def save_snapshot(self, snapshot_name, snapshot):
+        # Chunks must be durable before a snapshot references them
+        self.seal_pack()
+        snapshot_path = self.snapshot_path(snapshot_name)
+        with open(snapshot_path + ".tmp", "w", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+
+    def load_snapshot(self, snapshot_name):
+        with open(self.snapshot_path(snapshot_name), "r", encoding="utf-8") as snapshot_file:
+            return json.load(snapshot_file)
+
+    def list_snapshots(self, backup_name=None):
+        """Returns (snapshot_name, date) of snapshots sorted by date, oldest first."""
+        snapshots = []
+        for afile in os.listdir(self.snapshots_path):
+            if not afile.endswith(".json"):
+                continue
+            # DATE_FORMAT has an underscore in it, so the date is the last two fields
+            parts = afile[:-len(".json")].rsplit("_", 2)
+            if len(parts) != 3:
+                continue
+            name, date = parts[0], "_".join(parts[1:])
+            if backup_name is not None and name != backup_name:
+                continue
+            try:
+                snapshots.append((afile, datetime.strptime(date, DATE_FORMAT)))
+            except ValueError:
+                continue
+        snapshots.sort(key=lambda x: x[1])
+        return snapshots
+
+    def remove_snapshot(self, snapshot_name):
+        os.remove(self.snapshot_path(snapshot_name))
+
+    def count_references(self):
+        references = Counter()
+        for snapshot_name, _ in self.list_snapshots():
+            for entry in self.load_snapshot(snapshot_name)["files"].values():
+                references.update(entry[SNAP_CHUNKS])
+        return references
+
+    def collect_garbage(self):
+        """Reference-counted garbage collection: packs without referenced chunks are deleted,
+        packs with less than REPACK_RATIO of live data are rewritten with live chunks only."""
+        self.seal_pack()
+        references = self.count_references()
+        removed_packs = 0
+        repacked = []
+        freed = 0
+        for pack_id, pack_index in list(self.pack_chunks.items()):
+            total = sum(entry[1] for entry in pack_index.values())
+            live = {chunk_hash: entry for chunk_hash, entry in pack_index.items() if references[chunk_hash] > 0}
+            live_size = sum(entry[1] for entry in live.values())
+            if live and live_size >= total * REPACK_RATIO:
+                continue
+            for chunk_hash, entry in live.items():
+                record, compressed = self.read_record(chunk_hash)
+                self.write_record(chunk_hash, record, compressed)
+            for chunk_hash in pack_index:
+                if chunk_hash not in live:
+                    del self.chunks[chunk_hash]
+            freed += total - live_size
+            if live:
+                repacked.append(pack_id)
+            else:
+                self.remove_pack(pack_id)
+                removed_packs += 1
+        # Old packs are removed only after their live chunks are durable in the new ones
+        self.seal_pack()
+        for pack_id in repacked:
+            self.remove_pack(pack_id)
+        logger.info("Garbage collection: removed {} packs, repacked {} packs, freed {:.3f}Mb."
+                    .format(removed_packs, len(repacked), freed / 1024 / 1024))
+
+    def remove_pack(self, pack_id):
+        os.remove(self.pack_path(pack_id, "idx"))
+        os.remove(self.pack_path(pack_id, "pack"))
+        del self.pack_chunks[pack_id]
+
@@ -0,0 +1,227 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from locbkp.utils.dictionary import ENGINE_7Z, ENGINE_ZIP
+from locbkp.utils.utils import logger
+
+# Formats that are already compressed: compressing them again only burns CPU
+compressed_extensions = {
+    ".7z", ".zip", ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".lz", ".lz4", ".lzma", ".zst", ".rar", ".cab",
+    ".jar", ".war", ".apk", ".deb", ".rpm", ".whl", ".egg",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".aac", ".ogg", ".opus", ".flac", ".m4a",
+    ".mp4", ".m4v", ".mkv", ".webm", ".avi", ".mov",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub"
+}
+# Files of unknown type from this size on get a quick sample compression to detect random data
+sample_threshold = 1024 * 1024
+sample_size = 64 * 1024
+# A sample that compresses to more than this is considered incompressible
+incompressible_ratio = 0.95
+
+zip_codecs = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA
+}
+# Python 3.14+
+if hasattr(zipfile, "ZIP_ZSTANDARD"):
+    zip_codecs["zstd"] = zipfile.ZIP_ZSTANDARD
+zip_level_codecs = {"deflate", "bzip2", "lzma", "zstd"}
+default_zip_level = 6
+# Members are compressed into spool files by the threads, in memory up to this size, and then copied
+# into the archive in order. Bigger ones are spooled to the directory of the archive.
+spool_size = 16 * 1024 * 1024
+read_size = 1024 * 1024
+
+engine_extensions = {
+    ENGINE_7Z: "7z",
+    ENGINE_ZIP: "zip"
+}
+
+
+def is_compressed(apath, size):
+    if os.path.splitext(apath)[1].lower() in compressed_extensions:
+        return True
+    if size < sample_threshold:
+        return False
+    try:
+        with open(apath, "rb") as afile:
+            afile.seek(size // 2)
+            sample = afile.read(sample_size)
+    except OSError:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * incompressible_ratio
+
+
+def honors_level(engine, codec):
+    """Whether COMPRESSION_LEVEL changes anything for engine and codec."""
+    return engine == ENGINE_7Z or codec in zip_level_codecs
+
+
+def get_7z_method_args(level, threads=None, dictionary_mb=None):
+    args = ["-mx{}".format(level)]
+    if threads:
+        args.append("-mmt{}".format(threads))
+    if dictionary_mb:
+        args.append("-md{}m".format(dictionary_mb))
+    return args
+
+
+class LzmaCompressor:
+    """zipfile.LZMACompressor with a preset and a dictionary size: a zip LZMA member is a small
+    header with the filter properties and a raw LZMA1 stream."""
+
+    def __init__(self, preset, dictionary_size=None):
+        lzma_filter = {"id": lzma.FILTER_LZMA1, "preset": preset}
+        if dictionary_size:
+            lzma_filter["dict_size"] = dictionary_size
+        props = lzma._encode_filter_properties(lzma_filter)
+        self.header = struct.pack("<BBH", 9, 4, len(props)) + props
+        self.compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+            lzma._decode_filter_properties(lzma.FILTER_LZMA1, props)])
+
+    def compress(self, data):
+        header, self.header = self.header, b""
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b""
+        return header + self.compressor.flush()
+
+
+class ZipEngine:
+    """In-process engine: writes a zip archive, so no external binary is needed. Every member gets
+    its own codec: already compressed files are stored. Members are compressed by threads (zlib, bz2
+    and lzma release the GIL) and written raw in order, so the level and, for lzma, the dictionary
+    size are honored, which zipfile does not do for lzma."""
+
+    def __init__(self, codec="lzma", level=None, threads=None, dictionary_mb=None):
+        if codec not in zip_codecs:
+            raise ValueError("Unknown zip codec: {}. Known codecs: {}".format(codec, ", ".join(zip_codecs)))
+        self.codec = zip_codecs[codec]
+        self.level = default_zip_level if level is None else max(0, min(level, 9))
+        self.threads = threads or os.cpu_count() or 1
+        self.dictionary_size = dictionary_mb * 1024 * 1024 if dictionary_mb else None
+
+    def get_compressor(self, compress_type):
+        if compress_type == zipfile.ZIP_LZMA:
+            return LzmaCompressor(self.level, self.dictionary_size)
+        # bzip2 has no level 0
+        return zipfile._get_compressor(compress_type, max(self.level, 1) if compress_type == zipfile.ZIP_BZIP2
+                                       else self.level)
+
+    def compress_member(self, apath, arcname, compress_type, spool_directory):
+        """Returns (ZipInfo with sizes and CRC, spool file with the compressed data)."""
+        zinfo = zipfile.ZipInfo.from_file(apath, arcname)
+        zinfo.compress_type = compress_type
+        if compress_type == zipfile.ZIP_LZMA:
+            # Compressed data includes an end-of-stream marker
+            zinfo.flag_bits |= 0x02
+        compressor = self.get_compressor(compress_type)
+        spool = tempfile.SpooledTemporaryFile(spool_size, dir=spool_directory)
+        crc = 0
+        size = 0
+        try:
+            with open(apath, "rb") as afile:
+                for block in iter(lambda: afile.read(read_size), b""):
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    spool.write(compressor.compress(block) if compressor is not None else block)
+            if compressor is not None:
+                spool.write(compressor.flush())
+        except BaseException:
+            spool.close()
+            raise
+        # The file may have changed since it was stat-ed: the sizes are of what was read
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = spool.tell()
+        spool.seek(0)
+        return zinfo, spool
+
+    def compress(self, archive_path, members, stored, extra_members=(), progress=None):
+        """members: (path on disk, name in archive) of files and directories, stored: paths on disk
+        to store without compression, extra_members: (name in archive, bytes) written from memory.
+        progress (utils.progress.Progress) is updated with the size of every member written."""
+        written = 0
+        spool_directory = os.path.dirname(os.path.abspath(archive_path))
+        with zipfile.ZipFile(archive_path, "w", self.codec, allowZip64=True) as archive, \
+                ThreadPoolExecutor(self.threads) as executor:
+            # Up to twice the threads in flight: the threads do not wait for the writer, and that many
+            # spool files exist at most
+            in_flight = deque()
+            for apath, arcname in members:
+                if os.path.isdir(apath):
+                    in_flight.append((apath, arcname, None))
+                else:
+                    compress_type = zipfile.ZIP_STORED if apath in stored else self.codec
+                    in_flight.append((apath, arcname, executor.submit(self.compress_member, apath, arcname,
+                                                                      compress_type, spool_directory)))
+                while len(in_flight) > 2 * self.threads:
+                    written += self.write_member(archive, *in_flight.popleft(), progress)
+            while in_flight:
+                written += self.write_member(archive, *in_flight.popleft(), progress)
+            for arcname, data in extra_members:
+                archive.writestr(arcname, data)
+        return written
+
+    def write_member(self, archive, apath, arcname, future, progress):
+        """Writes a directory or a member compressed by compress_member. Returns 1 if it is written."""
+        try:
+            if future is None:
+                archive.write(apath, arcname)
+                return 1
+            zinfo, spool = future.result()
+        except OSError as e:
+            logger.warning("Could not archive {}: {}".format(apath, e.__class__.__name__))
+            return 0
+        with spool:
+            write_raw(archive, zinfo, spool)
+        if progress is not None:
+            progress.update(zinfo.file_size)
+        return 1
+
+
+def write_raw(archive, zinfo, data):
+    """Writes a member whose data (a file object) is already compressed, zinfo has its sizes and CRC.
+    zipfile has no API for it: this is what ZipFile.open(zinfo, "w") does, without compressing."""
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.fp.tell()
+    archive._writecheck(zinfo)
+    archive._didModify = True
+    archive.fp.write(zinfo.FileHeader(zip64))
+    shutil.copyfileobj(data, archive.fp, read_size)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+
+
+def compress_zip(archive_path, members, stored, extra_members, codec, level, threads=None, dictionary_mb=None):
+    """ZipEngine.compress for worker processes."""
+    return ZipEngine(codec, level, threads, dictionary_mb).compress(archive_path, members, stored, extra_members)
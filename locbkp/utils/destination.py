@@ -0,0 +1,445 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Destinations archives are transferred to: a directory (DESTDIR) or an S3-compatible object store
+(REMOTE_URL, e.g. "https://s3.example.com/bucket/prefix", path-style). DESTDIR stays a local
+directory either way: the catalog, the indexes and the change journals are kept there.
+
+Files bigger than a part are uploaded with multipart uploads: parts are uploaded in parallel, each
+with its MD5 (checked by the server) and SHA-256 (signed), and a failed part is retried with
+exponential backoff. The upload id is saved in DESTDIR/.locbkp/uploads until the upload completes,
+so an interrupted upload of the same file resumes, in the same run or in the next one (Backup keeps
+an archive it could not transfer): parts the server already has with the right checksum are not sent
+again. Uploads whose files are gone are aborted.
+
+locbkp.utils.objectserver is a minimal server with the same API to try this against."""
+
+import base64
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, quote
+
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, META_DIRECTORY, SHARD_INDEX_SUFFIX, REMOTE_URL, \
+    REMOTE_ACCESS_KEY, REMOTE_SECRET_KEY, REMOTE_REGION, UPLOAD_PART_MB, UPLOAD_THREADS, UPLOAD_RETRIES, \
+    UPLOADS_DIRECTORY
+from locbkp.utils.fastcopy import copy_file
+from locbkp.utils.utils import logger, archive_exists
+
+STRATEGY_PUT = "put"
+STRATEGY_MULTIPART = "multipart"
+
+default_part_mb = 64
+default_upload_threads = 4
+default_upload_retries = 5
+default_region = "us-east-1"
+# S3 limits
+min_part_size = 5 * 1024 * 1024
+max_parts = 10000
+# Backoff before retry n is min(max_backoff, backoff_base * 2^n) seconds, with jitter
+backoff_base = 1
+max_backoff = 60
+request_timeout = 300
+# Responses worth retrying: the server or the network had a problem, not the request
+retryable_statuses = {408, 429, 500, 502, 503, 504}
+s3_namespace = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+class TransferError(Exception):
+    def __init__(self, message, status=None, retryable=True):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class LocalDestination:
+    remote = False
+
+    def __init__(self, path):
+        self.path = path
+        self.location = path
+
+    def describe(self, name):
+        return os.path.join(self.path, name)
+
+    def put(self, local_path, name, throttle=None):
+        """Transfers local_path as name. Returns the strategy used."""
+        return copy_file(local_path, os.path.join(self.path, name), allow_move=True, throttle=throttle)
+
+    def delete(self, name):
+        os.remove(os.path.join(self.path, name))
+
+    def get_size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.path, name))
+        except OSError:
+            return
+
+    def has_archive(self, archive_name):
+        return archive_exists(self.path, archive_name)
+
+    def list_files(self):
+        """{name: size} of every file."""
+        sizes = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+        return sizes
+
+
+def get_signing_key(secret_key, date, region):
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in (date, region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    return key
+
+
+def sign_request(method, host, path, query, headers, payload_hash, access_key, secret_key, region):
+    """Adds the AWS Signature Version 4 headers to headers."""
+    now = datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = "{}/{}/s3/aws4_request".format(now.strftime("%Y%m%d"), region)
+    headers["x-amz-date"] = amz_date
+    headers["x-amz-content-sha256"] = payload_hash
+    signed = {"host": host}
+    signed.update({key.lower(): str(value).strip() for key, value in headers.items()})
+    signed_headers = ";".join(sorted(signed))
+    canonical_query = "&".join("{}={}".format(quote(key, safe="-_.~"), quote(value, safe="-_.~"))
+                               for key, value in sorted(query.items()))
+    canonical_request = "\n".join([method, quote(path, safe="/-_.~"), canonical_query,
+                                   "".join("{}:{}\n".format(key, signed[key]) for key in sorted(signed)),
+                                   signed_headers, payload_hash])
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+    signature = hmac.new(get_signing_key(secret_key, now.strftime("%Y%m%d"), region),
+                         string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+        access_key, scope, signed_headers, signature)
+
+
+def find_all(element, tag):
+    return element.iter(s3_namespace + tag) if element.tag.startswith(s3_namespace) else element.iter(tag)
+
+
+def find_text(element, tag):
+    for found in find_all(element, tag):
+        return found.text
+
+
+def get_backoff(attempt):
+    return min(max_backoff, backoff_base * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+class ObjectStoreDestination:
+    """An S3-compatible bucket, addressed path-style. Requests are signed if there are credentials
+    (REMOTE_ACCESS_KEY and REMOTE_SECRET_KEY or AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY)."""
+    remote = True
+
+    def __init__(self, url, state_directory, access_key=None, secret_key=None, region=default_region,
+                 part_size=default_part_mb * 1024 * 1024, threads=default_upload_threads,
+                 retries=default_upload_retries):
+        parts = urlsplit(url)
+        self.url = url.rstrip("/")
+        self.location = self.url
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        path = parts.path.strip("/")
+        self.bucket, _, self.prefix = path.partition("/")
+        self.access_key = access_key or os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.region = region
+        self.part_size = max(min_part_size, part_size)
+        self.threads = max(1, threads)
+        self.retries = retries
+        self.state_directory = state_directory
+        self.connections = threading.local()
+
+    def get_key(self, name):
+        return "{}/{}".format(self.prefix, name) if self.prefix else name
+
+    def describe(self, name):
+        return "{}/{}".format(self.url, name)
+
+    def get_connection(self):
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            connection = connection_class(self.host, timeout=request_timeout)
+            self.connections.connection = connection
+        return connection
+
+    def drop_connection(self):
+        connection = getattr(self.connections, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.connections.connection = None
+
+    def request(self, method, key=None, query=None, body=b"", headers=None, payload_hash=None):
+        """One request: returns (status, headers, body) for 2xx responses, raises TransferError otherwise."""
+        query = query or {}
+        headers = dict(headers or {})
+        path = "/" + self.bucket + ("/" + key if key is not None else "")
+        if payload_hash is None:
+            payload_hash = hashlib.sha256(body).hexdigest()
+        if self.access_key and self.secret_key:
+            sign_request(method, self.host, path, query, headers, payload_hash, self.access_key, self.secret_key,
+                         self.region)
+        url = quote(path, safe="/-_.~")
+        if query:
+            url += "?" + "&".join("{}={}".format(quote(akey, safe="-_.~"), quote(value, safe="-_.~"))
+                                  if value else quote(akey, safe="-_.~") for akey, value in sorted(query.items()))
+        try:
+            connection = self.get_connection()
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.drop_connection()
+            raise TransferError("{} {}: {}".format(method, path, e.__class__.__name__))
+        if response.status >= 300:
+            code = None
+            try:
+                code = find_text(ElementTree.fromstring(data), "Code")
+            except ElementTree.ParseError:
+                pass
+            raise TransferError("{} {}: HTTP {} {}".format(method, path, response.status, code or response.reason),
+                                response.status, response.status in retryable_statuses)
+        return response.status, response.headers, data
+
+    def request_with_retries(self, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request(*args, **kwargs)
+            except TransferError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+                delay = get_backoff(attempt)
+                logger.warning("{}. Retrying in {:.1f}s...".format(e, delay))
+                time.sleep(delay)
+
+    def get_size(self, name):
+        try:
+            _, headers, _ = self.request_with_retries("HEAD", self.get_key(name))
+        except TransferError as e:
+            if e.status == 404:
+                return
+            raise
+        return int(headers.get("Content-Length", 0))
+
+    def has_archive(self, archive_name):
+        return any(self.get_size(name) is not None for name in
+                   (archive_name, "{}.001".format(archive_name), "{}.{}".format(archive_name, SHARD_INDEX_SUFFIX)))
+
+    def delete(self, name):
+        self.request_with_retries("DELETE", self.get_key(name))
+
+    def list_files(self):
+        """{name: size} of every object under the prefix (but not in "subdirectories" of it)."""
+        sizes = {}
+        prefix = self.get_key("")
+        query = {"list-type": "2", "prefix": prefix, "delimiter": "/"}
+        while True:
+            _, _, data = self.request_with_retries("GET", query=query)
+            result = ElementTree.fromstring(data)
+            for contents in find_all(result, "Contents"):
+                sizes[find_text(contents, "Key")[len(prefix):]] = int(find_text(contents, "Size"))
+            token = find_text(result, "NextContinuationToken")
+            if find_text(result, "IsTruncated") != "true" or not token:
+                return sizes
+            query["continuation-token"] = token
+
+    def put(self, local_path, name, throttle=None):
+        size = os.path.getsize(local_path)
+        if size <= self.part_size:
+            with open(local_path, "rb") as afile:
+                body = afile.read()
+            if throttle is not None:
+                throttle.consume(len(body))
+            self.upload_body("PUT", self.get_key(name), {}, body)
+            return STRATEGY_PUT
+        self.abort_stale_uploads()
+        # A failed part fails the upload, which is resumed: parts already uploaded are kept
+        for attempt in range(self.retries + 1):
+            try:
+                self.upload_multipart(local_path, name, size, throttle)
+                return STRATEGY_MULTIPART
+            except TransferError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+                delay = get_backoff(attempt)
+                logger.warning("Upload of {} failed: {}. Resuming in {:.1f}s...".format(name, e, delay))
+                time.sleep(delay)
+
+    def upload_body(self, method, key, query, body):
+        """Uploads a part or a whole object and checks the ETag the server computed."""
+        md5 = hashlib.md5(body)
+        headers = {"Content-MD5": base64.b64encode(md5.digest()).decode("ascii"),
+                   "Content-Length": str(len(body))}
+        for attempt in range(self.retries + 1):
+            try:
+                _, response_headers, _ = self.request(method, key, query, body, headers,
+                                                      hashlib.sha256(body).hexdigest())
+                etag = response_headers.get("ETag", "").strip("\"")
+                if etag and etag != md5.hexdigest():
+                    raise TransferError("{} {}: ETag {} does not match MD5 {}".format(method, key, etag,
+                                                                                    md5.hexdigest()))
+                return md5.hexdigest()
+            except TransferError as e:
+                if not e.retryable or attempt == self.retries:
+                    raise
+                delay = get_backoff(attempt)
+                logger.warning("{}. Retrying in {:.1f}s...".format(e, delay))
+                time.sleep(delay)
+
+    def get_state_path(self, key):
+        return os.path.join(self.state_directory, "{}.json".format(hashlib.sha1(
+            "{}/{}".format(self.url, key).encode("utf-8")).hexdigest()))
+
+    def load_state(self, key, local_path, size, part_size):
+        """The upload of key that can be resumed for local_path, or None. Others are aborted."""
+        state_path = self.get_state_path(key)
+        if not os.path.exists(state_path):
+            return
+        try:
+            with open(state_path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            os.remove(state_path)
+            return
+        if (state["source"], state["size"], state["mtime_ns"], state["part_size"]) == \
+                (local_path, size, os.stat(local_path).st_mtime_ns, part_size):
+            return state
+        self.abort_upload(state)
+        return
+
+    def save_state(self, state):
+        os.makedirs(self.state_directory, exist_ok=True)
+        state_path = self.get_state_path(state["key"])
+        with open(state_path + ".tmp", "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file)
+        os.replace(state_path + ".tmp", state_path)
+
+    def abort_upload(self, state):
+        try:
+            self.request_with_retries("DELETE", state["key"], {"uploadId": state["upload_id"]})
+        except TransferError as e:
+            # Already completed or aborted
+            if e.status != 404:
+                logger.warning("Could not abort the upload of {}: {}".format(state["key"], e))
+                return
+        state_path = self.get_state_path(state["key"])
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def abort_stale_uploads(self):
+        """Aborts uploads left by earlier runs whose files are gone, so the server frees their parts."""
+        if not os.path.isdir(self.state_directory):
+            return
+        for afile in os.listdir(self.state_directory):
+            if not afile.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.state_directory, afile), "r", encoding="utf-8") as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                continue
+            if state.get("url") == self.url and not os.path.exists(state["source"]):
+                logger.info("Aborting the unfinished upload of {}.".format(state["key"]))
+                self.abort_upload(state)
+
+    def list_parts(self, state):
+        """{part number: ETag} of the parts the server has, or None if the upload is gone."""
+        parts = {}
+        query = {"uploadId": state["upload_id"]}
+        while True:
+            try:
+                _, _, data = self.request_with_retries("GET", state["key"], query)
+            except TransferError as e:
+                if e.status == 404:
+                    return
+                raise
+            result = ElementTree.fromstring(data)
+            for part in find_all(result, "Part"):
+                parts[int(find_text(part, "PartNumber"))] = find_text(part, "ETag").strip("\"")
+            marker = find_text(result, "NextPartNumberMarker")
+            if find_text(result, "IsTruncated") != "true" or not marker:
+                return parts
+            query["part-number-marker"] = marker
+
+    def upload_multipart(self, local_path, name, size, throttle=None):
+        key = self.get_key(name)
+        part_size = max(self.part_size, -(-size // max_parts))
+        state = self.load_state(key, local_path, size, part_size)
+        uploaded = self.list_parts(state) if state is not None else None
+        if uploaded is None:
+            _, _, data = self.request_with_retries("POST", key, {"uploads": ""})
+            state = {"url": self.url, "key": key, "upload_id": find_text(ElementTree.fromstring(data), "UploadId"),
+                     "source": local_path, "size": size, "mtime_ns": os.stat(local_path).st_mtime_ns,
+                     "part_size": part_size}
+            self.save_state(state)
+            uploaded = {}
+        elif uploaded:
+            logger.info("Resuming the upload of {}: the server has {} parts.".format(name, len(uploaded)))
+        parts_count = -(-size // part_size)
+        fd = os.open(local_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            def upload_part(number):
+                body = os.pread(fd, part_size, (number - 1) * part_size)
+                if uploaded.get(number) == hashlib.md5(body).hexdigest():
+                    return number, uploaded[number]
+                # Parts the server has are not sent, so they do not count against the limit
+                if throttle is not None:
+                    throttle.consume(len(body))
+                return number, self.upload_body("PUT", key, {"partNumber": str(number),
+                                                             "uploadId": state["upload_id"]}, body)
+
+            with ThreadPoolExecutor(min(self.threads, parts_count)) as executor:
+                etags = dict(executor.map(upload_part, range(1, parts_count + 1)))
+        finally:
+            os.close(fd)
+        body = "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format("".join(
+            "<Part><PartNumber>{}</PartNumber><ETag>\"{}\"</ETag></Part>".format(number, etags[number])
+            for number in sorted(etags))).encode("utf-8")
+        _, _, data = self.request_with_retries("POST", key, {"uploadId": state["upload_id"]}, body)
+        # S3 reports some failures of a completion in a 200 response
+        if b"<Error>" in data:
+            raise TransferError("Could not complete the upload of {}: {}".format(
+                name, find_text(ElementTree.fromstring(data), "Code")))
+        os.remove(self.get_state_path(key))
+
+
+def get_destination(backup_list):
+    destdir = backup_list[DESTINATION_DIRECTORY]
+    if REMOTE_URL not in backup_list:
+        return LocalDestination(destdir)
+    part_mb = backup_list[UPLOAD_PART_MB] if UPLOAD_PART_MB in backup_list else default_part_mb
+    return ObjectStoreDestination(
+        backup_list[REMOTE_URL], os.path.join(destdir, META_DIRECTORY, UPLOADS_DIRECTORY),
+        backup_list[REMOTE_ACCESS_KEY] if REMOTE_ACCESS_KEY in backup_list else None,
+        backup_list[REMOTE_SECRET_KEY] if REMOTE_SECRET_KEY in backup_list else None,
+        backup_list[REMOTE_REGION] if REMOTE_REGION in backup_list else default_region,
+        part_mb * 1024 * 1024,
+        backup_list[UPLOAD_THREADS] if UPLOAD_THREADS in backup_list else default_upload_threads,
+        backup_list[UPLOAD_RETRIES] if UPLOAD_RETRIES in backup_list else default_upload_retries)
@@ -21,6 +21,77 @@ TYPE_DIRECTORY = "DIR"
 TYPE_FILE = "FILE"
 BACKUP_NAME = "BACKUP_NAME"
 DATE_FORMAT = "%d-%m-%Y_%H.%M.%S"
-BACKUP_FILENAME_TEMPLATE = "{}_{}.7z"
+BACKUP_FILENAME_TEMPLATE = "{}_{}.{}"
+INCREMENTAL_FILENAME_TEMPLATE = "{}_{}_inc.{}"
+DIFFERENTIAL_FILENAME_TEMPLATE = "{}_{}_diff.{}"
 RETENTION = "RETENTION"
 CREATE_SUBDIR = "CREATE_SUBDIR"
+STREAMING = "STREAMING"
+BACKUP_MODE = "BACKUP_MODE"
+MODE_FULL = "full"
+MODE_INCREMENTAL = "incremental"
+MODE_DIFFERENTIAL = "differential"
+FULL_EVERY = "FULL_EVERY"
+INDEX_HASH = "INDEX_HASH"
+META_DIRECTORY = ".locbkp"
+INDEX_FILENAME_TEMPLATE = "{}_index.json"
+# An archive compressed by a run that could not transfer it, for the next run to transfer
+PENDING_FILENAME_TEMPLATE = "{}_pending.json"
+BACKEND = "BACKEND"
+BACKEND_7Z = "7z"
+BACKEND_CHUNKSTORE = "chunkstore"
+CHUNKSTORE_DIRECTORY = "LocBkp_chunkstore"
+SNAPSHOT_FILENAME_TEMPLATE = "{}_{}.json"
+COPY_THREADS = "COPY_THREADS"
+COPY_INFLIGHT_MB = "COPY_INFLIGHT_MB"
+STAGING_HARDLINKS = "STAGING_HARDLINKS"
+VOLUME_SIZE_MB = "VOLUME_SIZE_MB"
+COMPRESSION_ENGINE = "COMPRESSION_ENGINE"
+ENGINE_7Z = "7z"
+ENGINE_ZIP = "zip"
+COMPRESSION_LEVEL = "COMPRESSION_LEVEL"
+COMPRESSION_THREADS = "COMPRESSION_THREADS"
+COMPRESSION_DICTIONARY_MB = "COMPRESSION_DICTIONARY_MB"
+COMPRESSION_CODEC = "COMPRESSION_CODEC"
+STORE_COMPRESSED = "STORE_COMPRESSED"
+P7Z_PATH = "P7Z_PATH"
+SHARDS = "SHARDS"
+SHARD_SUFFIX_TEMPLATE = "s{:03d}"
+SHARD_INDEX_SUFFIX = "shards.json"
+MANIFEST = "MANIFEST"
+MANIFEST_SUFFIX = "manifest"
+JSON_REPORT = "JSON_REPORT"
+CHECKSUMS = "CHECKSUMS"
+CHECKSUM_SUFFIX = "sha256"
+JOURNAL = "JOURNAL"
+JOURNAL_MAX_MB = "JOURNAL_MAX_MB"
+JOURNAL_DIRECTORY_TEMPLATE = "{}_journal"
+BANDWIDTH_LIMIT_MB = "BANDWIDTH_LIMIT_MB"
+NICE = "NICE"
+IONICE_CLASS = "IONICE_CLASS"
+MAX_THREADS = "MAX_THREADS"
+ADAPTIVE_THROTTLE = "ADAPTIVE_THROTTLE"
+MAX_LOAD = "MAX_LOAD"
+MAX_DISK_UTIL_PCT = "MAX_DISK_UTIL_PCT"
+EXCLUDE = "EXCLUDE"
+INCLUDE = "INCLUDE"
+MAX_FILE_SIZE_MB = "MAX_FILE_SIZE_MB"
+MAX_FILE_AGE_DAYS = "MAX_FILE_AGE_DAYS"
+IGNORE_FILE = "IGNORE_FILE"
+IGNORE_FILENAME = ".locbkpignore"
+METRICS = "METRICS"
+METRICS_DIRECTORY = "METRICS_DIRECTORY"
+PROFILE = "PROFILE"
+PROGRESS_INTERVAL = "PROGRESS_INTERVAL"
+CATALOG = "CATALOG"
+CATALOG_FILENAME = "catalog.sqlite"
+REMOTE_URL = "REMOTE_URL"
+REMOTE_ACCESS_KEY = "REMOTE_ACCESS_KEY"
+REMOTE_SECRET_KEY = "REMOTE_SECRET_KEY"
+REMOTE_REGION = "REMOTE_REGION"
+UPLOAD_PART_MB = "UPLOAD_PART_MB"
+UPLOAD_THREADS = "UPLOAD_THREADS"
+UPLOAD_RETRIES = "UPLOAD_RETRIES"
+UPLOADS_DIRECTORY = "uploads"
+TEMP_DIRECTORIES = "TEMP_DIRECTORIES"
+TARGET_WINDOW_MINUTES = "TARGET_WINDOW_MINUTES"
@@ -0,0 +1,160 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STRATEGY_RENAME = "rename"
+STRATEGY_HARDLINK = "hardlink"
+STRATEGY_REFLINK = "reflink"
+STRATEGY_COPY_FILE_RANGE = "copy_file_range"
+STRATEGY_SENDFILE = "sendfile"
+STRATEGY_BUFFERED = "buffered"
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+# Errors meaning "this strategy does not work between these filesystems", not "this file is broken"
+unsupported_errnos = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS}
+# Errors of one file (immutable, append-only, opened in another mode): the next strategy is tried
+# for it, but the strategy stays enabled for the others
+file_errnos = {errno.EPERM, errno.EBADF}
+
+# (source device, destination device) -> strategies that already failed there, so every file
+# does not pay for a failing syscall
+disabled_strategies = {}
+
+
+class GiveUp(Exception):
+    """Raised by a strategy that copied nothing of a file that is not empty: some filesystems (FUSE,
+    overlay, proc-like files) report the end of the file at once. The next strategy is tried."""
+
+
+def try_reflink(fsrc, fdst, throttle=None):
+    if fcntl is None:
+        return False
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    return True
+
+
+def try_copy_file_range(fsrc, fdst, throttle=None):
+    if not hasattr(os, "copy_file_range"):
+        return False
+    # Smaller steps when throttled, so the rate is kept smoothly
+    step = BUFFER_SIZE if throttle is not None else KERNEL_COPY_SIZE
+    total = 0
+    while True:
+        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), step)
+        if copied == 0:
+            if total == 0 and os.fstat(fsrc.fileno()).st_size > 0:
+                raise GiveUp()
+            return True
+        total += copied
+        if throttle is not None:
+            throttle.consume(copied)
+
+
+def try_sendfile(fsrc, fdst, throttle=None):
+    if not hasattr(os, "sendfile") or os.name == "nt":
+        return False
+    step = BUFFER_SIZE if throttle is not None else KERNEL_COPY_SIZE
+    offset = 0
+    while True:
+        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, step)
+        if sent == 0:
+            if offset == 0 and os.fstat(fsrc.fileno()).st_size > 0:
+                raise GiveUp()
+            return True
+        offset += sent
+        if throttle is not None:
+            throttle.consume(sent)
+
+
+def copy_buffered(fsrc, fdst, throttle=None):
+    if throttle is None:
+        shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+        return
+    for block in iter(lambda: fsrc.read(BUFFER_SIZE), b""):
+        fdst.write(block)
+        throttle.consume(len(block))
+
+
+kernel_strategies = (
+    (STRATEGY_REFLINK, try_reflink),
+    (STRATEGY_COPY_FILE_RANGE, try_copy_file_range),
+    (STRATEGY_SENDFILE, try_sendfile)
+)
+
+
+def copy_data(fsrc, fdst, throttle=None):
+    disabled = disabled_strategies.setdefault((os.fstat(fsrc.fileno()).st_dev, os.fstat(fdst.fileno()).st_dev),
+                                              set())
+    for strategy, copy_function in kernel_strategies:
+        if strategy in disabled:
+            continue
+        try:
+            if copy_function(fsrc, fdst, throttle):
+                return strategy
+            disabled.add(strategy)
+        except GiveUp:
+            pass
+        except OSError as e:
+            # Only a failure before anything was written can be retried with another strategy
+            if e.errno not in unsupported_errnos | file_errnos or fdst.tell() != 0 or \
+                    os.fstat(fdst.fileno()).st_size != 0:
+                raise
+            if e.errno in unsupported_errnos:
+                disabled.add(strategy)
+        fsrc.seek(0)
+        fdst.seek(0)
+    copy_buffered(fsrc, fdst, throttle)
+    return STRATEGY_BUFFERED
+
+
+def copy_file(src, dst, allow_link=False, allow_move=False, throttle=None):
+    """Copies src to dst (with permission bits, like shutil.copy) using the cheapest strategy
+    that works: rename (allow_move, src is gone afterwards), hardlink (allow_link, dst shares
+    the inode with src), FICLONE reflink, copy_file_range, sendfile, buffered copy. Data that is
+    actually copied is reported to throttle.consume (utils.throttle.Throttle or utils.progress.Progress),
+    renames, links and reflinks are not.
+    Returns the name of the strategy used."""
+    if allow_move:
+        try:
+            os.rename(src, dst)
+            return STRATEGY_RENAME
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    if allow_link:
+        try:
+            os.link(src, dst)
+            return STRATEGY_HARDLINK
+        except OSError as e:
+            # EPERM: hardlinks to files of other users may be forbidden (fs.protected_hardlinks)
+            if e.errno not in unsupported_errnos and e.errno not in (errno.EMLINK, errno.EPERM):
+                raise
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        strategy = copy_data(fsrc, fdst, throttle)
+    shutil.copymode(src, dst)
+    return strategy
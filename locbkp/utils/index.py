@@ -0,0 +1,113 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import json
+import os
+
+from locbkp.utils.dictionary import META_DIRECTORY, INDEX_FILENAME_TEMPLATE
+from locbkp.utils.utils import logger, hash_file
+
+INDEX_VERSION = 1
+
+# Positions of the values stored per file in the index
+IDX_SIZE = 0
+IDX_MTIME_NS = 1
+IDX_INODE = 2
+IDX_HASH = 3
+
+
+def get_index_path(destdir, backup_name):
+    return os.path.join(destdir, META_DIRECTORY, INDEX_FILENAME_TEMPLATE.format(backup_name))
+
+
+def new_index(backup_name):
+    return {
+        "version": INDEX_VERSION,
+        "backup_name": backup_name,
+        "chain": [],
+        "files": {}
+    }
+
+
+def load_index(index_path, backup_name):
+    if not os.path.exists(index_path):
+        logger.info("No file-state index found at {}.".format(index_path))
+        return new_index(backup_name)
+    try:
+        with open(index_path, "r", encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        if index.get("version") != INDEX_VERSION:
+            logger.warning("Index {} has unsupported version {}. Ignoring it."
+                           .format(index_path, index.get("version")))
+            return new_index(backup_name)
+        return index
+    except BaseException as e:
+        logger.warning("Could not load index {}: {}. Ignoring it.".format(index_path, e.__class__.__name__))
+        return new_index(backup_name)
+
+
+def save_index(index_path, index):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file)
+        index_file.flush()
+        os.fsync(index_file.fileno())
+    os.replace(temp_path, index_path)
+
+
+def file_state(st, file_hash=None):
+    return [st.st_size, st.st_mtime_ns, st.st_ino, file_hash]
+
+
+def is_unchanged(state, st):
+    return state[IDX_SIZE] == st.st_size and state[IDX_MTIME_NS] == st.st_mtime_ns and state[IDX_INODE] == st.st_ino
+
+
+def get_changes(index, files, use_hash=False):
+    """Compares scanned files (path -> os.stat_result) with the index.
+    Returns (changed, deleted, new_states): changed is a dict in the same format as files,
+    deleted is a list of paths that are in the index but not on disk anymore and new_states
+    is the file-state map to store in the index if the backup succeeds."""
+    known = index["files"]
+    changed = {}
+    new_states = {}
+    for apath, st in files.items():
+        state = known.get(apath)
+        if state is not None and is_unchanged(state, st):
+            new_states[apath] = state
+            continue
+        file_hash = hash_file(apath) if use_hash else None
+        new_states[apath] = file_state(st, file_hash)
+        # Only metadata changed (e.g. touch or a rewrite with the same content)
+        if state is not None and file_hash is not None and state[IDX_HASH] == file_hash:
+            continue
+        changed[apath] = st
+    deleted = [apath for apath in known if apath not in files]
+    return changed, deleted, new_states
+
+
+def get_journal_changes(index, files, removed, use_hash=False):
+    """get_changes for a backup that only stat-ed the paths in the change journal: files are the
+    files found there, removed are files of the index that are gone. Every other file of the
+    index is unchanged."""
+    new_states = dict(index["files"])
+    for apath in removed:
+        del new_states[apath]
+    changed, _, states = get_changes({"files": {apath: index["files"][apath] for apath in files
+                                                if apath in index["files"]}}, files, use_hash)
+    new_states.update(states)
+    return changed, list(removed), new_states
@@ -0,0 +1,338 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Change journal: a watcher process follows the backup paths with inotify and appends every
+changed path to a journal file, so a backup can stat only what changed instead of walking the
+whole tree.
+
+Every watcher run is a session with a journal file of its own, "<session>.journal", and the state
+file "watcher.json" names the current session. A journal position is (session, offset). A backup
+can use the journal between the position its previous backup recorded and the current one only if
+the session is the same (the watcher was not restarted), the watcher is still alive and there is no
+overflow marker in between. Otherwise it walks the tree.
+
+scan_tree follows symlinks, the watcher does not: changes under a symlinked directory or to the
+target of a symlinked file would be missed. A symlink in a watched tree, found when it is added or
+created later, makes the session incomplete, so backups walk the tree until the watcher restarts.
+
+Journal lines: a type and a JSON-encoded path.
+    F <path>  the path changed, was created or removed
+    D <path>  a directory was created or moved in: everything under it has to be scanned
+    !         events were lost (inotify queue overflow)"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import struct
+import uuid
+from datetime import datetime
+from stat import S_ISDIR, S_ISREG
+
+from locbkp.utils.dictionary import META_DIRECTORY, JOURNAL_DIRECTORY_TEMPLATE
+from locbkp.utils.utils import logger, scan_tree, stat_file
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 256 * 1024
+
+STATE_FILENAME = "watcher.json"
+ENTRY_CHANGED = "F"
+ENTRY_NEW_DIR = "D"
+ENTRY_OVERFLOW = "!"
+# The watcher starts a new session (and journal) when the journal grows bigger than this
+default_journal_max_mb = 256
+
+
+def get_journal_dir(destdir, backup_name):
+    return os.path.join(destdir, META_DIRECTORY, JOURNAL_DIRECTORY_TEMPLATE.format(backup_name))
+
+
+def get_journal_path(journal_dir, session):
+    return os.path.join(journal_dir, "{}.journal".format(session))
+
+
+def load_state(journal_dir):
+    try:
+        with open(os.path.join(journal_dir, STATE_FILENAME), "r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def journal_position(journal_dir, paths):
+    """Current (session, offset) of a running watcher that watches all of paths, or None."""
+    state = load_state(journal_dir)
+    if state is None or not state.get("complete") or not is_alive(state["pid"]):
+        return
+    if not set(os.path.abspath(apath) for apath in paths).issubset(state["paths"]):
+        return
+    try:
+        offset = os.path.getsize(get_journal_path(journal_dir, state["session"]))
+    except OSError:
+        return
+    return {"session": state["session"], "offset": offset}
+
+
+def read_journal(journal_dir, start, end):
+    """Returns (changed paths, new directories) journaled between the positions start and end or
+    None if the journal cannot be trusted there."""
+    if start is None or end is None or start["session"] != end["session"] or start["offset"] > end["offset"]:
+        return
+    changed = set()
+    new_dirs = set()
+    with open(get_journal_path(journal_dir, end["session"]), "rb") as journal:
+        journal.seek(start["offset"])
+        data = journal.read(end["offset"] - start["offset"])
+    # The watcher writes whole lines, but a position may have been taken in the middle of one
+    data = data[:data.rfind(b"\n") + 1]
+    for line in data.decode("utf-8").splitlines():
+        if line == ENTRY_OVERFLOW:
+            return
+        entry_type, apath = line[0], json.loads(line[2:])
+        if entry_type == ENTRY_NEW_DIR:
+            new_dirs.add(apath)
+        else:
+            changed.add(apath)
+    return changed, new_dirs
+
+
+def collect_journal_changes(changed, new_dirs, known_files, known_dirs, rules=None):
+    """Stats only the journaled paths. Returns (files, dirs, removed): files found (path -> stat)
+    that have to be compared with the index, all directories of the backup (path -> stat) and
+    files of the index that do not exist anymore. Excluded paths (rules) are left out."""
+    files = {}
+    dirs = {}
+    visited = set()
+    removed = set()
+    for apath in sorted(changed | new_dirs):
+        path_rules = rules.for_path(apath) if rules is not None else None
+        if rules is not None and path_rules is None:
+            continue
+        try:
+            st = os.lstat(apath)
+        except FileNotFoundError:
+            removed.add(apath)
+            continue
+        except OSError:
+            continue
+        if path_rules is not None and (path_rules.is_excluded(apath, S_ISDIR(st.st_mode)) or
+                                       S_ISREG(st.st_mode) and path_rules.is_excluded_file(apath, st)):
+            continue
+        if S_ISDIR(st.st_mode):
+            if apath in new_dirs:
+                scan_tree(apath, files, dirs, visited, path_rules)
+            else:
+                dirs[apath] = st
+        elif S_ISREG(st.st_mode):
+            scan_tree(apath, files, dirs, visited)
+    # A removed or moved away directory takes everything under it with it
+    removed_prefixes = tuple(apath + "/" for apath in removed)
+    removed_files = [apath for apath in known_files if apath in removed or
+                     (removed_prefixes and apath.startswith(removed_prefixes))]
+    for adir in known_dirs:
+        if adir in dirs or adir in removed or (removed_prefixes and adir.startswith(removed_prefixes)):
+            continue
+        st = stat_file(adir)
+        if st is not None:
+            dirs[adir] = st
+    return files, dirs, removed_files
+
+
+def get_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class JournalWatcher:
+    """Watches the paths of a backup list with inotify and journals changes to them."""
+
+    def __init__(self, journal_dir, paths, journal_max_mb=default_journal_max_mb):
+        self.journal_dir = journal_dir
+        self.paths = [os.path.abspath(apath) for apath in paths]
+        self.journal_max_size = journal_max_mb * 1024 * 1024
+        self.libc = get_libc()
+        self.fd = None
+        self.watches = {}
+        self.session = None
+        self.journal = None
+        self.complete = True
+
+    def add_watch(self, apath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(apath), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            # ENOSPC: out of fs.inotify.max_user_watches. Changes there would be missed
+            logger.error("Could not watch {}: {}. Backups will walk the tree."
+                         .format(apath, os.strerror(error)))
+            self.mark_incomplete()
+            return
+        self.watches[wd] = apath
+
+    def mark_incomplete(self):
+        if self.complete and self.journal is not None:
+            # At once, not only when the session changes: a backup that reads the journal
+            # meanwhile stops at the marker, the ones after it see an incomplete state
+            self.complete = False
+            self.write_entries([ENTRY_OVERFLOW + "\n"])
+            self.write_state()
+        self.complete = False
+
+    def found_symlink(self, apath):
+        if self.complete:
+            logger.warning("{} is a symlink, which the watcher does not follow. Backups will walk the tree."
+                           .format(apath))
+        self.mark_incomplete()
+
+    def add_tree(self, apath):
+        """Watches apath and every directory under it. Returns directories added."""
+        added = []
+        if os.path.islink(apath):
+            self.found_symlink(apath)
+            return added
+        if not os.path.isdir(apath):
+            self.add_watch(apath)
+            return added
+        stack = [apath]
+        while stack:
+            adir = stack.pop()
+            self.add_watch(adir)
+            added.append(adir)
+            try:
+                with os.scandir(adir) as entries:
+                    for entry in entries:
+                        if entry.is_symlink():
+                            self.found_symlink(entry.path)
+                        elif entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return added
+
+    def start_session(self):
+        if self.journal is not None:
+            os.close(self.journal)
+            os.remove(get_journal_path(self.journal_dir, self.session))
+        self.session = uuid.uuid4().hex
+        self.journal = os.open(get_journal_path(self.journal_dir, self.session),
+                               os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.write_state()
+
+    def write_state(self):
+        state = {"session": self.session, "pid": os.getpid(), "started": datetime.now().isoformat(),
+                 "paths": self.paths, "complete": self.complete}
+        state_path = os.path.join(self.journal_dir, STATE_FILENAME)
+        with open(state_path + ".tmp", "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(state_path + ".tmp", state_path)
+
+    def write_entries(self, entries):
+        if not entries:
+            return
+        # One write per batch, so readers see whole lines
+        os.write(self.journal, "".join(entries).encode("utf-8", "surrogateescape"))
+        if os.fstat(self.journal).st_size > self.journal_max_size:
+            logger.info("Journal is over {}Mb. Starting a new one.".format(self.journal_max_size // 1024 // 1024))
+            self.start_session()
+
+    def parse_events(self, data):
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + name_len].rstrip(b"\0")
+            pos += name_len
+            yield wd, mask, os.fsdecode(name)
+
+    def handle_events(self, data):
+        entries = []
+        seen = set()
+        for wd, mask, name in self.parse_events(data):
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflow: the next backup will walk the tree.")
+                entries.append(ENTRY_OVERFLOW + "\n")
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            watched = self.watches.get(wd)
+            if watched is None:
+                continue
+            apath = os.path.join(watched, name) if name else watched
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have been created in it before the watch was added: it is scanned whole
+                self.add_tree(apath)
+                entries.append("{} {}\n".format(ENTRY_NEW_DIR, json.dumps(apath)))
+            elif apath not in seen:
+                if mask & (IN_CREATE | IN_MOVED_TO) and os.path.islink(apath):
+                    self.found_symlink(apath)
+                seen.add(apath)
+                entries.append("{} {}\n".format(ENTRY_CHANGED, json.dumps(apath)))
+        self.write_entries(entries)
+
+    def run(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # The journal is open before the watches are added, so nothing happening meanwhile is lost,
+        # but the session is only marked complete once everything is watched
+        self.complete = False
+        self.start_session()
+        self.complete = True
+        for apath in self.paths:
+            self.add_tree(apath)
+        self.write_state()
+        logger.info("Watching {} directories under {} paths. Journal: {}".format(
+            len(self.watches), len(self.paths), get_journal_path(self.journal_dir, self.session)))
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except InterruptedError:
+                continue
+            self.handle_events(data)
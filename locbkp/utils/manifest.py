@@ -0,0 +1,234 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Backup manifest: a JSON-lines file with one entry per backed up file or directory.
+
+Entries are sorted by path and the path of every entry is stored as the length of the prefix it
+shares with the previous path plus the rest of it. Every INDEX_EVERY-th entry starts a block and
+stores its full path. The first line is a header, the last line is a sparse index of the block
+starts (path and byte offset), so a path is found by reading the footer, bisecting it and decoding
+one block.
+
+Entry lines: [prefix length, path suffix, type, size, mtime_ns, mode, hash]"""
+
+import heapq
+import json
+import os
+from bisect import bisect_right
+
+MANIFEST_FORMAT = "locbkp-manifest"
+MANIFEST_VERSION = 1
+INDEX_EVERY = 256
+# Entries sorted in memory at once when the manifest is finalized
+SORT_RUN_SIZE = 200000
+
+TYPE_FILE = "f"
+TYPE_DIR = "d"
+# Files of an incremental or differential backup that were deleted since the backups it is based on
+TYPE_DELETED = "x"
+
+
+def common_prefix_len(first, second):
+    limit = min(len(first), len(second))
+    num = 0
+    while num < limit and first[num] == second[num]:
+        num += 1
+    return num
+
+
+class ManifestWriter:
+    """Appends entries to an unsorted journal as they come and turns it into a sorted manifest
+    in close(), with an external merge sort, so no full list of paths is kept in memory."""
+
+    def __init__(self, path, header=None):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.journal = open(self.journal_path, "w", encoding="utf-8")
+        self.header = dict(header or {})
+        self.files = 0
+        self.dirs = 0
+
+    def add(self, apath, entry_type, st=None, file_hash=None):
+        if st is None:
+            record = [apath, entry_type, None, None, None, file_hash]
+        else:
+            record = [apath, entry_type, st.st_size, st.st_mtime_ns, st.st_mode, file_hash]
+        self.journal.write(json.dumps(record))
+        self.journal.write("\n")
+        if entry_type == TYPE_DIR:
+            self.dirs += 1
+        elif entry_type == TYPE_FILE:
+            self.files += 1
+
+    def add_file(self, apath, st=None, file_hash=None):
+        self.add(apath, TYPE_FILE, st, file_hash)
+
+    def add_dir(self, apath, st=None):
+        self.add(apath, TYPE_DIR, st)
+
+    def add_deleted(self, apath):
+        self.add(apath, TYPE_DELETED)
+
+    def write_runs(self):
+        runs = []
+        with open(self.journal_path, "r", encoding="utf-8") as journal:
+            while True:
+                records = [json.loads(line) for _, line in zip(range(SORT_RUN_SIZE), journal)]
+                if not records:
+                    break
+                records.sort(key=lambda x: x[0])
+                run_path = "{}.run{}".format(self.path, len(runs))
+                with open(run_path, "w", encoding="utf-8") as run:
+                    for record in records:
+                        run.write(json.dumps(record))
+                        run.write("\n")
+                runs.append(run_path)
+        return runs
+
+    def close(self):
+        self.journal.close()
+        runs = self.write_runs()
+        run_files = [open(run_path, "r", encoding="utf-8") for run_path in runs]
+        try:
+            records = heapq.merge(*[map(json.loads, run_file) for run_file in run_files], key=lambda x: x[0])
+            self.write_manifest(records)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+            for run_path in runs:
+                os.remove(run_path)
+            os.remove(self.journal_path)
+        return self.path
+
+    def write_manifest(self, records):
+        header = {"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION}
+        header.update(self.header)
+        index = []
+        entries = 0
+        previous = ""
+        with open(self.path, "wb") as manifest:
+            manifest.write(json.dumps(header).encode("utf-8") + b"\n")
+            for record in records:
+                apath = record[0]
+                if apath == previous and entries:
+                    # The same path given twice: the first one wins
+                    continue
+                if entries % INDEX_EVERY == 0:
+                    index.append([apath, manifest.tell()])
+                    prefix = 0
+                else:
+                    prefix = common_prefix_len(previous, apath)
+                manifest.write(json.dumps([prefix, apath[prefix:]] + record[1:]).encode("utf-8") + b"\n")
+                previous = apath
+                entries += 1
+            footer = {"index": index, "entries": entries, "files": self.files, "dirs": self.dirs}
+            manifest.write(json.dumps(footer).encode("utf-8") + b"\n")
+
+
+def decode_entry(apath, record):
+    return {
+        "path": apath,
+        "type": record[2],
+        "size": record[3],
+        "mtime_ns": record[4],
+        "mode": record[5],
+        "hash": record[6]
+    }
+
+
+class ManifestReader:
+    """Looks up paths in a manifest reading only its header, footer and one block."""
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = open(path, "rb")
+        self.header = json.loads(self.manifest.readline())
+        if self.header.get("format") != MANIFEST_FORMAT:
+            raise ValueError("{} is not a LocBkp manifest".format(path))
+        self.footer = json.loads(self.read_last_line())
+        self.index_paths = [anentry[0] for anentry in self.footer["index"]]
+        self.index_offsets = [anentry[1] for anentry in self.footer["index"]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.manifest.close()
+
+    def read_last_line(self):
+        end = self.manifest.seek(0, os.SEEK_END)
+        step = 64 * 1024
+        while True:
+            start = max(0, end - step)
+            self.manifest.seek(start)
+            data = self.manifest.read(end - start)
+            # The last byte is the newline that ends the footer
+            newline = data.rfind(b"\n", 0, len(data) - 1)
+            if newline != -1 or start == 0:
+                return data[newline + 1:]
+            step *= 2
+
+    def iter_from(self, block):
+        if block < 0 or block >= len(self.index_offsets):
+            return
+        self.manifest.seek(self.index_offsets[block])
+        apath = ""
+        for line in self.manifest:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                return
+            apath = apath[:record[0]] + record[1]
+            yield decode_entry(apath, record)
+
+    def lookup(self, apath):
+        """Returns the entry of apath or None."""
+        for entry in self.iter_from(bisect_right(self.index_paths, apath) - 1):
+            if entry["path"] == apath:
+                return entry
+            if entry["path"] > apath:
+                return
+
+    def iter_entries(self, prefix=""):
+        """Yields entries, in path order, whose paths start with prefix."""
+        for entry in self.iter_from(max(0, bisect_right(self.index_paths, prefix) - 1)):
+            if entry["path"].startswith(prefix):
+                yield entry
+            elif entry["path"] > prefix:
+                return
+
+
+def export_json_report(manifest_path, report_file, extra=None):
+    """Writes the legacy LocBkp_report JSON (files_backed and dirs_backed lists) from a manifest
+    without loading it, entry by entry."""
+    with ManifestReader(manifest_path) as reader:
+        report_file.write("{\n")
+        for key, value in (extra or {}).items():
+            report_file.write("    {}: {},\n".format(json.dumps(key), json.dumps(value)))
+        for key, entry_type in (("files_backed", TYPE_FILE), ("dirs_backed", TYPE_DIR)):
+            report_file.write("    {}: [".format(json.dumps(key)))
+            first = True
+            for entry in reader.iter_entries():
+                if entry["type"] != entry_type:
+                    continue
+                report_file.write("\n        " if first else ",\n        ")
+                report_file.write(json.dumps(entry["path"]))
+                first = False
+            report_file.write("]" if first else "\n    ]")
+            report_file.write(",\n" if entry_type == TYPE_FILE else "\n")
+        report_file.write("}\n")
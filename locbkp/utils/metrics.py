@@ -0,0 +1,202 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Run metrics: stage timings, the slowest copies and optional cProfile profiles of the stages,
+exported as a JSON run record (one line per run in locbkp_runs.jsonl) and a Prometheus textfile
+(locbkp_<backup name>.prom, for the node_exporter textfile collector)."""
+
+import cProfile
+import heapq
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from locbkp.utils.utils import logger
+
+STAGE_WALK = "walk"
+STAGE_PLAN = "plan"
+STAGE_COPY = "copy"
+STAGE_COMPRESS = "compress"
+STAGE_TRANSFER = "transfer"
+stages = (STAGE_WALK, STAGE_PLAN, STAGE_COPY, STAGE_COMPRESS, STAGE_TRANSFER)
+
+RUNS_FILENAME = "locbkp_runs.jsonl"
+PROMETHEUS_FILENAME_TEMPLATE = "locbkp_{}.prom"
+PROFILE_FILENAME_TEMPLATE = "locbkp_{}_{}_{}.prof"
+slowest_files_count = 10
+
+prometheus_metrics = (
+    ("locbkp_last_run_timestamp_seconds", "Time the last backup finished."),
+    ("locbkp_last_run_success", "1 if the last backup reached its destination."),
+    ("locbkp_phase_duration_seconds", "Duration of a phase of the last backup."),
+    ("locbkp_phase_bytes_per_second", "Throughput of a phase of the last backup."),
+    ("locbkp_files", "Files of the last backup."),
+    ("locbkp_bytes", "Size of the last backup before and after compression."),
+    ("locbkp_compression_ratio", "Compressed size divided by the uncompressed size."),
+    ("locbkp_errors", "Errors of the last backup."),
+    ("locbkp_peak_rss_bytes", "Peak resident set size of LocBkp and of its child processes.")
+)
+
+
+def get_log_directory():
+    """Directory of the log file, where metrics go by default."""
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return os.path.dirname(handler.baseFilename)
+    return tempfile.gettempdir()
+
+
+def get_peak_rss():
+    """Peak RSS in bytes of this process and of its waited-for children (7z), or Nones."""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+class Metrics:
+    """Collects what happens during a backup. Stages are timed with stage(), which also profiles
+    them if they are in profile_stages. file_copied is called from the copy threads."""
+
+    def __init__(self, profile_stages=()):
+        self.profile_stages = set(profile_stages)
+        self.lock = threading.Lock()
+        self.time_start = time.monotonic()
+        self.stages = []
+        self.slowest = []
+        self.profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        profile = self.start_profile(name) if name in self.profile_stages else None
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            if profile is not None:
+                profile.disable()
+            self.stages.append({"stage": name, "start": round(start - self.time_start, 6),
+                                "seconds": round(end - start, 6)})
+
+    def start_profile(self, name):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time, and it sees every thread
+            return
+        with self.lock:
+            self.profiles.setdefault(name, []).append(profile)
+        return profile
+
+    def profiled(self, name, function):
+        """function, profiled in the thread that calls it if the stage name is profiled. cProfile
+        only follows the thread it was enabled in before Python 3.12."""
+        if name not in self.profile_stages:
+            return function
+
+        def wrapper(*args, **kwargs):
+            profile = self.start_profile(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        return wrapper
+
+    def file_copied(self, apath, seconds, size):
+        with self.lock:
+            entry = (seconds, apath, size)
+            if len(self.slowest) < slowest_files_count:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_slowest_files(self):
+        return [{"path": apath, "seconds": round(seconds, 6), "size": size}
+                for seconds, apath, size in sorted(self.slowest, reverse=True)]
+
+    def write_profiles(self, directory, backup_name, date):
+        for name, profiles in self.profiles.items():
+            profile_path = os.path.join(directory, PROFILE_FILENAME_TEMPLATE.format(backup_name, date, name))
+            try:
+                pstats.Stats(*profiles).dump_stats(profile_path)
+                logger.info("Profile of the {} stage is saved to {}.".format(name, profile_path))
+            except BaseException as e:
+                logger.error("Could not save profile to {}: {}".format(profile_path, e.__class__.__name__))
+
+
+def format_labels(labels):
+    return ",".join("{}=\"{}\"".format(key, str(value).replace("\\", "\\\\").replace("\"", "\\\""))
+                    for key, value in labels.items())
+
+
+def get_prometheus_samples(record):
+    labels = {"backup": record["backup_name"]}
+    samples = [
+        ("locbkp_last_run_timestamp_seconds", labels, record["finished"]),
+        ("locbkp_last_run_success", labels, int(record["success"])),
+        ("locbkp_compression_ratio", labels, record["compression_ratio"])
+    ]
+    for phase, seconds in record["phases"].items():
+        samples.append(("locbkp_phase_duration_seconds", dict(labels, phase=phase), seconds))
+    for phase, rate in record["bytes_per_second"].items():
+        samples.append(("locbkp_phase_bytes_per_second", dict(labels, phase=phase), rate))
+    for kind, count in record["files"].items():
+        samples.append(("locbkp_files", dict(labels, kind=kind), count))
+    for kind, size in record["bytes"].items():
+        samples.append(("locbkp_bytes", dict(labels, kind=kind), size))
+    for kind, count in record["errors"].items():
+        samples.append(("locbkp_errors", dict(labels, kind=kind), count))
+    for process, rss in record["peak_rss_bytes"].items():
+        samples.append(("locbkp_peak_rss_bytes", dict(labels, process=process), rss))
+    return [asample for asample in samples if asample[2] is not None]
+
+
+def write_prometheus(prometheus_path, record):
+    """Written to a temporary file and renamed, so the collector never reads half of it."""
+    samples = get_prometheus_samples(record)
+    lines = []
+    for name, description in prometheus_metrics:
+        metric_samples = [asample for asample in samples if asample[0] == name]
+        if not metric_samples:
+            continue
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        for _, labels, value in metric_samples:
+            lines.append("{}{{{}}} {}".format(name, format_labels(labels), value))
+    with open(prometheus_path + ".tmp", "w", encoding="utf-8") as prometheus_file:
+        prometheus_file.write("\n".join(lines) + "\n")
+    os.replace(prometheus_path + ".tmp", prometheus_path)
+
+
+def write_run_record(directory, record):
+    """Appends the record to the runs file and writes the Prometheus textfile."""
+    with open(os.path.join(directory, RUNS_FILENAME), "a", encoding="utf-8") as runs_file:
+        runs_file.write(json.dumps(record) + "\n")
+    write_prometheus(os.path.join(directory, PROMETHEUS_FILENAME_TEMPLATE.format(record["backup_name"])), record)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""A stand-in for an S3-compatible object store, to try remote destinations without one:
+
+    python3 -m locbkp.utils.objectserver --root /tmp/objects --port 9000 [--fail-rate 0.1]
+
+with "REMOTE_URL": "http://127.0.0.1:9000/bucket/prefix" in the backup list. It supports what
+destination.ObjectStoreDestination uses (PUT, GET, HEAD and DELETE of objects, ListObjectsV2 and
+multipart uploads) and checks Content-MD5, but ignores signatures. Buckets are directories of
+root, created when they are first written to. --fail-rate makes that share of part uploads fail
+with a 500 error, to see retries and resumption at work."""
+
+import argparse
+import hashlib
+import base64
+import os
+import random
+import re
+import shutil
+import uuid
+import xml.etree.ElementTree as ElementTree
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+UPLOADS_DIRECTORY = ".uploads"
+xml_header = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+s3_xmlns = "http://s3.amazonaws.com/doc/2006-03-01/"
+max_keys = 1000
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    root = None
+    fail_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        """(bucket, key or None, query) of the request, or None if the path is not acceptable."""
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        if not bucket or bucket.startswith(".") or any(part in ("", ".", "..") for part in key.split("/") if key):
+            return
+        query = {akey: values[0] for akey, values in parse_qs(url.query, keep_blank_values=True).items()}
+        return bucket, key or None, query
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for akey, value in (headers or {}).items():
+            self.send_header(akey, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_xml(self, status, xml):
+        self.send(status, (xml_header + xml).encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def send_error_code(self, status, code):
+        self.send_xml(status, "<Error><Code>{}</Code></Error>".format(code))
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def upload_path(self, upload_id):
+        if not re.fullmatch(r"[0-9a-f]{32}", upload_id or ""):
+            return
+        return os.path.join(self.root, UPLOADS_DIRECTORY, upload_id)
+
+    def check_md5(self, body):
+        expected = self.headers.get("Content-MD5")
+        if expected is not None and base64.b64encode(hashlib.md5(body).digest()).decode("ascii") != expected:
+            self.send_error_code(400, "BadDigest")
+            return False
+        return True
+
+    def do_PUT(self):
+        parsed = self.parse()
+        if parsed is None or parsed[1] is None:
+            self.send_error_code(400, "InvalidRequest")
+            return
+        bucket, key, query = parsed
+        body = self.read_body()
+        if "uploadId" in query:
+            if random.random() < self.fail_rate:
+                self.send_error_code(500, "InternalError")
+                return
+            upload_path = self.upload_path(query["uploadId"])
+            if upload_path is None or not os.path.isdir(upload_path):
+                self.send_error_code(404, "NoSuchUpload")
+                return
+            destination = os.path.join(upload_path, "{:05d}".format(int(query["partNumber"])))
+        else:
+            destination = self.object_path(bucket, key)
+        if not self.check_md5(body):
+            return
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination + ".tmp", "wb") as afile:
+            afile.write(body)
+        os.replace(destination + ".tmp", destination)
+        self.send(200, headers={"ETag": "\"{}\"".format(hashlib.md5(body).hexdigest())})
+
+    def do_POST(self):
+        parsed = self.parse()
+        if parsed is None or parsed[1] is None:
+            self.send_error_code(400, "InvalidRequest")
+            return
+        bucket, key, query = parsed
+        body = self.read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self.upload_path(upload_id))
+            with open(os.path.join(self.upload_path(upload_id), "key"), "w", encoding="utf-8") as key_file:
+                key_file.write("{}/{}".format(bucket, key))
+            self.send_xml(200, "<InitiateMultipartUploadResult xmlns=\"{}\"><Bucket>{}</Bucket><Key>{}</Key>"
+                               "<UploadId>{}</UploadId></InitiateMultipartUploadResult>"
+                          .format(s3_xmlns, escape(bucket), escape(key), upload_id))
+            return
+        upload_path = self.upload_path(query.get("uploadId"))
+        if upload_path is None or not os.path.isdir(upload_path):
+            self.send_error_code(404, "NoSuchUpload")
+            return
+        digests = []
+        part_paths = []
+        for part in ElementTree.fromstring(body).iter("Part"):
+            part_path = os.path.join(upload_path, "{:05d}".format(int(part.findtext("PartNumber"))))
+            if not os.path.exists(part_path):
+                self.send_error_code(400, "InvalidPart")
+                return
+            with open(part_path, "rb") as part_file:
+                digest = hashlib.md5(part_file.read()).digest()
+            if digest.hex() != part.findtext("ETag").strip("\""):
+                self.send_error_code(400, "InvalidPart")
+                return
+            digests.append(digest)
+            part_paths.append(part_path)
+        destination = self.object_path(bucket, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination + ".tmp", "wb") as afile:
+            for part_path in part_paths:
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, afile)
+        os.replace(destination + ".tmp", destination)
+        shutil.rmtree(upload_path)
+        etag = "{}-{}".format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+        self.send_xml(200, "<CompleteMultipartUploadResult xmlns=\"{}\"><Key>{}</Key><ETag>\"{}\"</ETag>"
+                           "</CompleteMultipartUploadResult>".format(s3_xmlns, escape(key), etag))
+
+    def do_GET(self):
+        parsed = self.parse()
+        if parsed is None:
+            self.send_error_code(400, "InvalidRequest")
+            return
+        bucket, key, query = parsed
+        if key is None:
+            self.list_objects(bucket, query)
+        elif "uploadId" in query:
+            self.list_parts(key, query)
+        else:
+            self.get_object(bucket, key)
+
+    def do_HEAD(self):
+        parsed = self.parse()
+        if parsed is None or parsed[1] is None:
+            self.send(400)
+            return
+        apath = self.object_path(parsed[0], parsed[1])
+        if not os.path.isfile(apath):
+            self.send(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(apath)))
+        self.end_headers()
+
+    def get_object(self, bucket, key):
+        apath = self.object_path(bucket, key)
+        if not os.path.isfile(apath):
+            self.send_error_code(404, "NoSuchKey")
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(apath)))
+        self.end_headers()
+        with open(apath, "rb") as afile:
+            shutil.copyfileobj(afile, self.wfile)
+
+    def list_parts(self, key, query):
+        upload_path = self.upload_path(query["uploadId"])
+        if upload_path is None or not os.path.isdir(upload_path):
+            self.send_error_code(404, "NoSuchUpload")
+            return
+        parts = []
+        for afile in sorted(os.listdir(upload_path)):
+            if afile.isdigit():
+                with open(os.path.join(upload_path, afile), "rb") as part_file:
+                    data = part_file.read()
+                parts.append("<Part><PartNumber>{}</PartNumber><ETag>\"{}\"</ETag><Size>{}</Size></Part>"
+                             .format(int(afile), hashlib.md5(data).hexdigest(), len(data)))
+        self.send_xml(200, "<ListPartsResult xmlns=\"{}\"><Key>{}</Key><UploadId>{}</UploadId>"
+                           "<IsTruncated>false</IsTruncated>{}</ListPartsResult>"
+                      .format(s3_xmlns, escape(key), query["uploadId"], "".join(parts)))
+
+    def list_objects(self, bucket, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        start_after = query.get("continuation-token", "")
+        bucket_path = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, names in os.walk(bucket_path):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), bucket_path).replace(os.sep, "/")
+                if key.startswith(prefix) and key > start_after and \
+                        not (delimiter and delimiter in key[len(prefix):]):
+                    keys.append(key)
+        keys.sort()
+        page = keys[:max_keys]
+        contents = "".join("<Contents><Key>{}</Key><Size>{}</Size></Contents>".format(
+            escape(key), os.path.getsize(self.object_path(bucket, key))) for key in page)
+        truncated = len(keys) > max_keys
+        token = "<NextContinuationToken>{}</NextContinuationToken>".format(escape(page[-1])) if truncated else ""
+        self.send_xml(200, "<ListBucketResult xmlns=\"{}\"><Name>{}</Name><Prefix>{}</Prefix>"
+                           "<KeyCount>{}</KeyCount><IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>"
+                      .format(s3_xmlns, escape(bucket), escape(prefix), len(page), str(truncated).lower(), token,
+                              contents))
+
+    def do_DELETE(self):
+        parsed = self.parse()
+        if parsed is None or parsed[1] is None:
+            self.send_error_code(400, "InvalidRequest")
+            return
+        bucket, key, query = parsed
+        if "uploadId" in query:
+            upload_path = self.upload_path(query["uploadId"])
+            if upload_path is None or not os.path.isdir(upload_path):
+                self.send_error_code(404, "NoSuchUpload")
+                return
+            shutil.rmtree(upload_path)
+        elif os.path.isfile(self.object_path(bucket, key)):
+            os.remove(self.object_path(bucket, key))
+        self.send(204)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A stand-in for an S3-compatible object store.")
+    parser.add_argument("--root", required=True, help="Directory buckets are stored in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of part uploads that fail.")
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    ObjectStoreHandler.root = os.path.abspath(args.root)
+    ObjectStoreHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer((args.host, args.port), ObjectStoreHandler)
+    print("Serving {} on http://{}:{}/".format(ObjectStoreHandler.root, args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Planning of a backup before anything is copied: the temporary directory, staging or streaming and
+the compression level, from an estimate of the archive size and of the duration.
+
+The archive size is estimated by compressing samples of the files found by the scan with the
+configured codec. Samples are taken at evenly spaced bytes of the whole backup, so big files get
+more of them. Earlier runs (the run records of metrics.py) correct the estimate: the ratio of the
+actual to the sampled compression and the measured throughputs of the phases replace the defaults."""
+
+import bisect
+import bz2
+import json
+import lzma
+import os
+import statistics
+import threading
+import zlib
+from collections import Counter
+from datetime import timedelta
+
+from locbkp.utils.compression import compressed_extensions, incompressible_ratio, sample_size
+from locbkp.utils.dictionary import ENGINE_7Z
+from locbkp.utils.metrics import RUNS_FILENAME
+from locbkp.utils.progress import format_size
+from locbkp.utils.utils import logger, get_free_space_in_dir
+
+STRATEGY_STAGING = "staging"
+STRATEGY_STREAMING = "streaming"
+
+sample_count = 32
+# Runs of the same backup the plan learns from, read from the end of the runs file
+history_runs = 20
+history_read_size = 4 * 1024 * 1024
+# The archive may turn out bigger than estimated; reports, manifests and the filesystem need some space too
+space_margin = 1.2
+space_reserve = 256 * 1024 * 1024
+# Levels tried to meet TARGET_WINDOW_MINUTES, best compression first
+window_levels = (9, 7, 5, 3, 1)
+# Guesses until there is history, in bytes per second. Compression rates are of one LZMA2 thread.
+default_copy_rate = 200 * 1024 * 1024
+default_transfer_rate = 200 * 1024 * 1024
+default_compress_rates = {0: 500 * 1024 * 1024, 1: 40 * 1024 * 1024, 3: 20 * 1024 * 1024, 5: 8 * 1024 * 1024,
+                          7: 5 * 1024 * 1024, 9: 4 * 1024 * 1024}
+# Dictionary for sample compression: bigger ones cost memory and time and samples are small anyway
+sample_dictionary_size = 8 * 1024 * 1024
+calibration_limits = (0.5, 2.0)
+
+
+def get_default_compress_rate(level):
+    return default_compress_rates[min(default_compress_rates, key=lambda x: abs(x - level))]
+
+
+def pick_samples(files, count=sample_count):
+    """(path, offset) of count samples at evenly spaced bytes of files ({path: stat}). Paths are
+    sorted, so the same files give the same samples."""
+    paths = sorted(apath for apath, st in files.items() if st.st_size)
+    ends = []
+    total = 0
+    for apath in paths:
+        total += files[apath].st_size
+        ends.append(total)
+    samples = []
+    for num in range(min(count, total)):
+        position = (2 * num + 1) * total // (2 * count)
+        index = bisect.bisect_right(ends, position)
+        start = ends[index] - files[paths[index]].st_size
+        # The sample ends at the end of the file at the latest
+        offset = max(0, min(position - start, files[paths[index]].st_size - sample_size))
+        samples.append((paths[index], offset))
+    return samples
+
+
+def read_samples(samples):
+    """(sample data, size of samples that will not compress). Already compressed files are not read
+    and random data is found with a quick zlib pass, as compression.is_compressed does: compressing
+    it with LZMA would take most of the planning time for nothing."""
+    data = []
+    incompressible = 0
+    for apath, offset in samples:
+        if os.path.splitext(apath)[1].lower() in compressed_extensions:
+            incompressible += sample_size
+            continue
+        try:
+            with open(apath, "rb") as afile:
+                afile.seek(offset)
+                asample = afile.read(sample_size)
+        except OSError:
+            continue
+        if len(zlib.compress(asample, 1)) > len(asample) * incompressible_ratio:
+            incompressible += len(asample)
+        else:
+            data.append(asample)
+    return data, incompressible
+
+
+def compress_samples(data, engine, codec, level):
+    """Size the samples compress to. 7z archives are solid, so the samples are compressed as one
+    stream; zip compresses every file separately."""
+    compressed = 0
+    if engine == ENGINE_7Z:
+        if level == 0:
+            return sum(len(asample) for asample in data)
+        compressor = lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=[
+            {"id": lzma.FILTER_LZMA2, "preset": min(level, 9), "dict_size": sample_dictionary_size}])
+        for asample in data:
+            compressed += len(compressor.compress(asample))
+        return compressed + len(compressor.flush())
+    if codec == "store":
+        return sum(len(asample) for asample in data)
+    for asample in data:
+        if codec == "bzip2":
+            compressed += len(bz2.compress(asample, max(1, min(level if level is not None else 9, 9))))
+        elif codec == "lzma":
+            compressed += len(lzma.compress(asample, format=lzma.FORMAT_RAW, filters=[
+                {"id": lzma.FILTER_LZMA1, "preset": min(level if level is not None else 6, 9),
+                 "dict_size": sample_dictionary_size}]))
+        else:
+            # zlib stands in for codecs it does not have
+            compressed += len(zlib.compress(asample, level if level is not None else 6))
+    return compressed
+
+
+def read_history(directory, backup_name, count=history_runs):
+    """The last count run records of backup_name, oldest first."""
+    runs_path = os.path.join(directory, RUNS_FILENAME)
+    try:
+        with open(runs_path, "rb") as runs_file:
+            runs_file.seek(max(0, os.path.getsize(runs_path) - history_read_size))
+            lines = runs_file.read().splitlines()
+    except OSError:
+        return []
+    records = []
+    # The first line may be cut in the middle
+    for line in lines[1:] if len(lines) > 1 else lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("backup_name") == backup_name and record.get("success"):
+            records.append(record)
+    return records[-count:]
+
+
+def get_free_space(candidates):
+    """{directory: free space} of the candidate temporary directories that can be created."""
+    free_space = {}
+    for adir in candidates:
+        try:
+            os.makedirs(adir, exist_ok=True)
+            free_space[adir] = get_free_space_in_dir(adir)
+        except BaseException as e:
+            logger.error("Could not use temp directory {}: {}.".format(adir, e.__class__.__name__))
+    return free_space
+
+
+class Plan:
+    def __init__(self, temp, strategy, level, ratio, sampled_ratio, backup_size, required_space, seconds):
+        self.temp = temp
+        self.strategy = strategy
+        self.level = level
+        self.ratio = ratio
+        self.sampled_ratio = sampled_ratio
+        self.archive_size = int(backup_size * ratio)
+        self.required_space = required_space
+        self.seconds = seconds
+
+    @property
+    def total_seconds(self):
+        return sum(self.seconds.values())
+
+    def to_record(self):
+        return {"temp": self.temp, "strategy": self.strategy, "compression_level": self.level,
+                "ratio": round(self.ratio, 6), "sampled_ratio": round(self.sampled_ratio, 6)
+                if self.sampled_ratio is not None else None, "archive_size": self.archive_size,
+                "required_space": self.required_space,
+                "seconds": {phase: round(seconds, 3) for phase, seconds in self.seconds.items()}}
+
+
+class Planner:
+    """Estimates archive sizes and durations of a backup of files ({path: stat} from the scan) for
+    the compression levels and strategies it is asked about. threads: compression threads."""
+
+    def __init__(self, files, backup_size, engine, codec, threads, history):
+        self.backup_size = backup_size
+        self.engine = engine
+        self.codec = codec
+        self.threads = max(1, threads or 1)
+        self.history = history
+        picked = pick_samples(files) if backup_size else []
+        self.sample_count = len(picked)
+        self.samples, self.incompressible = read_samples(picked)
+        self.sampled_bytes = sum(len(asample) for asample in self.samples) + self.incompressible
+        self.ratios = {}
+
+    def get_sampled_ratio(self, level):
+        if not self.sampled_bytes:
+            return
+        if level not in self.ratios:
+            compressed = compress_samples(self.samples, self.engine, self.codec, level) + self.incompressible
+            self.ratios[level] = compressed / self.sampled_bytes
+        return self.ratios[level]
+
+    def get_runs(self, level=None):
+        return [arun for arun in self.history if level is None or arun.get("compression_level") == level]
+
+    def get_ratio(self, level):
+        """Sampled ratio corrected by how far off the samples were in earlier runs."""
+        sampled = self.get_sampled_ratio(level)
+        corrections = [arun["compression_ratio"] / arun["plan"]["sampled_ratio"] for arun in self.get_runs(level)
+                       if arun.get("compression_ratio") and (arun.get("plan") or {}).get("sampled_ratio")]
+        if sampled is None:
+            ratios = [arun["compression_ratio"] for arun in self.get_runs(level) if arun.get("compression_ratio")]
+            return statistics.median(ratios) if ratios else 1.0
+        if corrections:
+            sampled *= min(calibration_limits[1], max(calibration_limits[0], statistics.median(corrections)))
+        return min(sampled, 1.05)
+
+    def get_rate(self, phase, default, runs):
+        rates = [arun["bytes_per_second"][phase] for arun in runs if arun.get("bytes_per_second", {}).get(phase)]
+        return statistics.median(rates) if rates else default
+
+    def get_compress_rate(self, level):
+        rate = self.get_rate("compress", None, self.get_runs(level))
+        if rate is not None:
+            return rate
+        # Measured at other levels: scaled like the defaults scale
+        runs = [arun for arun in self.get_runs() if arun.get("compression_level") is not None]
+        scaled = [arun["bytes_per_second"]["compress"] * get_default_compress_rate(level) /
+                  get_default_compress_rate(arun["compression_level"])
+                  for arun in runs if arun.get("bytes_per_second", {}).get("compress")]
+        if scaled:
+            return statistics.median(scaled)
+        return get_default_compress_rate(level) * self.threads
+
+    def get_seconds(self, level, strategy, ratio):
+        seconds = {}
+        if strategy == STRATEGY_STAGING:
+            staged_runs = [arun for arun in self.get_runs()
+                           if (arun.get("plan") or {}).get("strategy", STRATEGY_STAGING) == STRATEGY_STAGING]
+            seconds["copy"] = self.backup_size / self.get_rate("copy", default_copy_rate, staged_runs)
+        seconds["compress"] = self.backup_size / self.get_compress_rate(level)
+        seconds["transfer"] = self.backup_size * ratio / self.get_rate("transfer", default_transfer_rate,
+                                                                       self.get_runs())
+        return seconds
+
+    def get_required_space(self, strategy, ratio):
+        required_space = int(self.backup_size * ratio * space_margin) + space_reserve
+        if strategy == STRATEGY_STAGING:
+            required_space += self.backup_size
+        return required_space
+
+    def plan(self, candidates, levels, strategies, window=None, reserved=None):
+        """The plan with the best compression level that fits into a candidate temporary directory and
+        finishes within window seconds, staging preferred over streaming; the fastest plan that fits
+        if none finishes in time; None if nothing fits. reserved: {device: bytes} other backups
+        count on, taken as used."""
+        free_space = get_free_space(candidates)
+        if not free_space:
+            return
+        if reserved:
+            free_space = {adir: free - reserved[os.stat(adir).st_dev] for adir, free in free_space.items()}
+        feasible = []
+        for level in levels:
+            ratio = self.get_ratio(level)
+            for strategy in strategies:
+                required_space = self.get_required_space(strategy, ratio)
+                temp = next((adir for adir in free_space if free_space[adir] > required_space), None)
+                if temp is None:
+                    continue
+                plan = Plan(temp, strategy, level, ratio, self.get_sampled_ratio(level), self.backup_size,
+                            required_space, self.get_seconds(level, strategy, ratio))
+                if window is None or plan.total_seconds <= window:
+                    return plan
+                feasible.append(plan)
+        for adir, free in free_space.items():
+            logger.info("{}: {} free.".format(adir, format_size(free)))
+        if not feasible:
+            return
+        plan = min(feasible, key=lambda x: x.total_seconds)
+        logger.warning("No plan finishes within {}. Choosing the fastest one.".format(timedelta(seconds=int(window))))
+        return plan
+
+
+class TempSpace:
+    """Temporary space of backups running at the same time (see Scheduler): what the plan of one
+    reserved, by filesystem, is not counted as free by the plans made after it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reserved = Counter()
+
+
+class TempReservation:
+    """The share of a TempSpace of one backup."""
+
+    def __init__(self, space):
+        self.space = space
+        self.device = None
+        self.size = 0
+
+    def plan(self, planner, candidates, levels, strategies, window=None):
+        """Planner.plan with the space the other backups reserved taken as used. Reserves what the
+        plan needs before another plan can be made."""
+        # Samples are compressed before the lock is taken: that is most of the planning time
+        for level in levels:
+            planner.get_ratio(level)
+        with self.space.lock:
+            plan = planner.plan(candidates, levels, strategies, window, self.space.reserved)
+            if plan is not None:
+                self.device = os.stat(plan.temp).st_dev
+                self.size = plan.required_space
+                self.space.reserved[self.device] += self.size
+        return plan
+
+    def release(self):
+        with self.space.lock:
+            if self.device is not None:
+                self.space.reserved[self.device] -= self.size
+            self.device = None
+            self.size = 0
+
+
+def describe_plan(plan, samples):
+    return "{} in {}, compression level {}: archive of about {} (ratio {:.2f}, from {} samples), {} of temp " \
+           "space. Predicted duration {} ({}).".format(
+            plan.strategy.capitalize(), plan.temp, plan.level, format_size(plan.archive_size), plan.ratio, samples,
+            format_size(plan.required_space), timedelta(seconds=int(plan.total_seconds)),
+            ", ".join("{} {:.0f}s".format(phase, seconds) for phase, seconds in plan.seconds.items()))
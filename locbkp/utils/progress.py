@@ -0,0 +1,116 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import re
+import threading
+import time
+from datetime import timedelta
+
+from locbkp.utils.utils import logger
+
+default_progress_interval = 10
+# "-bsp1" progress of 7z: " 42% 1234 + path", redrawn with backspaces or carriage returns
+p7z_progress_regex = re.compile(rb"^\s*(\d{1,3})%")
+p7z_separators_regex = re.compile(rb"[\r\n\b]+")
+
+
+def format_size(size):
+    if size >= 1024 * 1024 * 1024:
+        return "{:.2f}G".format(size / 1024 / 1024 / 1024)
+    return "{:.1f}Mb".format(size / 1024 / 1024)
+
+
+class Progress:
+    """Byte-weighted progress of a phase, logged with the rate and an ETA at most once every interval
+    seconds. update() is called for every file (or block) and only adds to two counters, so it is
+    cheap even for millions of files. It is thread-safe. consume() makes it usable as the throttle
+    of copy_file, to follow a single big file: the throttle it wraps, if any, is still applied."""
+
+    def __init__(self, phase, total_bytes, total_items=None, interval=default_progress_interval, throttle=None):
+        self.phase = phase
+        self.total_bytes = total_bytes
+        self.total_items = total_items
+        self.interval = interval
+        self.throttle = throttle
+        self.done_bytes = 0
+        self.done_items = 0
+        self.lock = threading.Lock()
+        self.time_start = time.monotonic()
+        self.next_log = self.time_start + interval
+
+    def update(self, size, items=0):
+        with self.lock:
+            self.done_bytes += size
+            self.done_items += items
+            now = time.monotonic()
+            if now < self.next_log:
+                return
+            self.next_log = now + self.interval
+            self.log(now)
+
+    def consume(self, size):
+        self.update(size)
+        if self.throttle is not None:
+            self.throttle.consume(size)
+
+    def log(self, now):
+        elapsed = now - self.time_start
+        rate = self.done_bytes / elapsed if elapsed else 0
+        if self.total_bytes:
+            percent = min(100.0, self.done_bytes / self.total_bytes * 100)
+        elif self.total_items:
+            percent = min(100.0, self.done_items / self.total_items * 100)
+        else:
+            percent = 0.0
+        message = "{}: {:.1f}% ({} of {}".format(self.phase, percent, format_size(self.done_bytes),
+                                                 format_size(self.total_bytes))
+        if self.total_items:
+            message += ", {} of {} files".format(self.done_items, self.total_items)
+        message += "), {}/s".format(format_size(rate))
+        if rate and self.total_bytes > self.done_bytes:
+            message += ", ETA {}".format(timedelta(seconds=int((self.total_bytes - self.done_bytes) / rate)))
+        logger.info(message)
+
+    def finish(self):
+        elapsed = time.monotonic() - self.time_start
+        logger.info("{}: {} in {:.3f}s ({}/s).".format(self.phase, format_size(self.done_bytes), elapsed,
+                                                      format_size(self.done_bytes / elapsed if elapsed else 0)))
+
+
+def read_7z_output(stream, output, progress=None, size=0):
+    """Reads the output of 7z run with -bsp1: percentages go to progress (as a share of size bytes),
+    everything else to output."""
+    done = 0
+    pending = b""
+    for chunk in iter(lambda: stream.read1(64 * 1024), b""):
+        parts = p7z_separators_regex.split(pending + chunk)
+        # The last part may be cut in the middle
+        pending = parts.pop()
+        for part in parts:
+            match = p7z_progress_regex.match(part)
+            if match is None:
+                if part.strip():
+                    output.write(part + b"\n")
+                continue
+            if progress is not None:
+                current = size * min(int(match.group(1)), 100) // 100
+                if current > done:
+                    progress.update(current - done)
+                    done = current
+    if pending.strip() and p7z_progress_regex.match(pending) is None:
+        output.write(pending + b"\n")
+    if progress is not None and size > done:
+        progress.update(size - done)
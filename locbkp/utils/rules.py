@@ -0,0 +1,228 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Exclusion rules, applied while the backup paths are walked, so excluded directories are never
+listed and excluded names are never stat-ed.
+
+A rule is a glob or, with the "re:" prefix, a regular expression searched in the full path.
+Globs work like in .gitignore: a glob without a slash matches a name at any depth ("node_modules",
+"*.pyc"), a glob starting with a slash matches the full path ("/var/lib/app/cache"), any other
+glob matches the end of the path ("app/tmp/*.sock"). "*" does not cross directories, "**" does,
+a trailing slash matches directories only. INCLUDE rules win over EXCLUDE rules and the size and
+age limits, but an excluded directory is not entered, so nothing inside it can be included.
+
+Ignore files (".locbkpignore" by default) add rules for the directory they are in and everything
+under it: one glob per line, relative to that directory, "!" includes, "#" starts a comment."""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+from locbkp.utils.dictionary import EXCLUDE, INCLUDE, MAX_FILE_SIZE_MB, MAX_FILE_AGE_DAYS, IGNORE_FILE, \
+    IGNORE_FILENAME
+from locbkp.utils.utils import logger
+
+REGEX_PREFIX = "re:"
+
+
+def glob_to_regex(glob):
+    regex = []
+    pos = 0
+    while pos < len(glob):
+        char = glob[pos]
+        if glob.startswith("**/", pos):
+            regex.append("(?:.*/)?")
+            pos += 3
+            continue
+        if glob.startswith("**", pos):
+            regex.append(".*")
+            pos += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in glob[pos + 2:]:
+            end = glob.index("]", pos + 2)
+            chars = glob[pos + 1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[{}]".format(chars.replace("\\", "\\\\")))
+            pos = end
+        else:
+            regex.append(re.escape(char))
+        pos += 1
+    return "".join(regex)
+
+
+def compile_rule(rule, base=None):
+    """Returns (regex, directories only) for a rule of a backup list (base is None) or a line of an
+    ignore file in the directory base."""
+    if rule.startswith(REGEX_PREFIX):
+        return rule[len(REGEX_PREFIX):], False
+    dirs_only = rule.endswith("/")
+    glob = rule.rstrip("/")
+    if base is not None:
+        base = re.escape(base.rstrip("/"))
+        if "/" in glob:
+            return "^{}/{}$".format(base, glob_to_regex(glob.lstrip("/"))), dirs_only
+        return "^{}/(?:.*/)?{}$".format(base, glob_to_regex(glob)), dirs_only
+    if glob.startswith("/"):
+        return "^{}$".format(glob_to_regex(glob)), dirs_only
+    return "(?:^|/){}$".format(glob_to_regex(glob)), dirs_only
+
+
+def combine(rules, dirs):
+    """One regex for all rules that apply to directories (dirs) or to files, or None."""
+    parts = ["(?:{})".format(regex) for regex, dirs_only in rules if dirs or not dirs_only]
+    return re.compile("|".join(parts)) if parts else None
+
+
+def read_ignore_file(apath):
+    excludes = []
+    includes = []
+    try:
+        with open(apath, "r", encoding="utf-8", errors="surrogateescape") as ignore_file:
+            for line in ignore_file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("!"):
+                    includes.append(line[1:])
+                else:
+                    excludes.append(line)
+    except OSError as e:
+        logger.warning("Could not read {}: {}".format(apath, e.__class__.__name__))
+    return excludes, includes
+
+
+class Rules:
+    """Compiled rules. for_directory returns the rules for the entries of a directory, which
+    differ from the parent's only when the directory has an ignore file."""
+
+    def __init__(self, excludes=(), includes=(), max_size=None, min_mtime=None, ignore_filename=None, roots=()):
+        self.excludes = list(excludes)
+        self.includes = list(includes)
+        self.max_size = max_size
+        self.min_mtime = min_mtime
+        self.ignore_filename = ignore_filename
+        self.roots = [os.path.abspath(aroot) for aroot in roots]
+        self.exclude_files = combine(self.excludes, False)
+        self.exclude_dirs = combine(self.excludes, True)
+        self.include_files = combine(self.includes, False)
+        self.include_dirs = combine(self.includes, True)
+        # Shared by all rules derived from these
+        self.directories = {}
+        self.excluded_count = [0]
+
+    def derive(self, excludes, includes):
+        rules = Rules(self.excludes + excludes, self.includes + includes, self.max_size, self.min_mtime,
+                      self.ignore_filename)
+        rules.roots = self.roots
+        rules.directories = self.directories
+        rules.excluded_count = self.excluded_count
+        return rules
+
+    def for_directory(self, adir, names=None):
+        """Rules for the entries of adir: these ones and the ones of its ignore file, if it has one.
+        names: names in adir, if they are already known."""
+        if not self.ignore_filename:
+            return self
+        if names is not None:
+            has_ignore_file = self.ignore_filename in names
+        else:
+            has_ignore_file = os.path.isfile(os.path.join(adir, self.ignore_filename))
+        if not has_ignore_file:
+            return self
+        key = (id(self), adir)
+        if key not in self.directories:
+            excludes, includes = read_ignore_file(os.path.join(adir, self.ignore_filename))
+            self.directories[key] = self.derive([compile_rule(arule, adir) for arule in excludes],
+                                                [compile_rule(arule, adir) for arule in includes])
+        return self.directories[key]
+
+    def for_path(self, apath):
+        """Rules to check apath with, found by going down from its backup path, or None if a
+        directory on the way is excluded. A backup path itself is never excluded."""
+        apath = os.path.abspath(apath)
+        for aroot in self.roots:
+            if apath == aroot:
+                return self
+            if not apath.startswith(aroot.rstrip("/") + "/"):
+                continue
+            rules = self
+            current = aroot
+            for name in os.path.relpath(os.path.dirname(apath), aroot).split(os.sep):
+                if name == ".":
+                    break
+                rules = rules.for_directory(current)
+                current = os.path.join(current, name)
+                if rules.is_excluded(current, True):
+                    return
+            return rules.for_directory(current)
+        return self
+
+    def is_excluded(self, apath, is_dir):
+        """Name and path rules: checked before apath is stat-ed."""
+        exclude = self.exclude_dirs if is_dir else self.exclude_files
+        if exclude is None or not exclude.search(apath):
+            return False
+        include = self.include_dirs if is_dir else self.include_files
+        if include is not None and include.search(apath):
+            return False
+        self.excluded_count[0] += 1
+        return True
+
+    def is_excluded_file(self, apath, st):
+        """Size and age limits of a regular file."""
+        if (self.max_size is None or st.st_size <= self.max_size) and \
+                (self.min_mtime is None or st.st_mtime >= self.min_mtime):
+            return False
+        if self.include_files is not None and self.include_files.search(apath):
+            return False
+        self.excluded_count[0] += 1
+        return True
+
+    @property
+    def excluded(self):
+        return self.excluded_count[0]
+
+
+def get_rules(backup_list, paths):
+    """Rules of a backup list with the backup paths paths, or None if a rule is invalid."""
+    excludes = backup_list[EXCLUDE] if EXCLUDE in backup_list else []
+    includes = backup_list[INCLUDE] if INCLUDE in backup_list else []
+    max_size_mb = backup_list[MAX_FILE_SIZE_MB] if MAX_FILE_SIZE_MB in backup_list else None
+    max_age_days = backup_list[MAX_FILE_AGE_DAYS] if MAX_FILE_AGE_DAYS in backup_list else None
+    ignore_filename = backup_list[IGNORE_FILE] if IGNORE_FILE in backup_list else IGNORE_FILENAME
+    try:
+        rules = Rules([compile_rule(arule) for arule in excludes], [compile_rule(arule) for arule in includes],
+                      max_size_mb * 1024 * 1024 if max_size_mb is not None else None,
+                      time.time() - max_age_days * 24 * 60 * 60 if max_age_days is not None else None,
+                      ignore_filename, paths)
+    except re.error as e:
+        logger.error("Invalid {}/{} rule: {}. Nothing will be excluded.".format(EXCLUDE, INCLUDE, e))
+        return
+    return rules
+
+
+def get_rules_fingerprint(backup_list):
+    """Changes whenever the rules in the backup list do."""
+    rules = [backup_list[akey] if akey in backup_list else None
+             for akey in (EXCLUDE, INCLUDE, MAX_FILE_SIZE_MB, MAX_FILE_AGE_DAYS, IGNORE_FILE)]
+    return hashlib.sha1(json.dumps(rules).encode("utf-8")).hexdigest()
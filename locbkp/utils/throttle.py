@@ -0,0 +1,216 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Throttling, so a backup can run next to a production workload: a token bucket caps the bandwidth
+of copies and transfers, the external compressor runs with a lower CPU and IO priority, and the
+adaptive mode slows the backup down while the load average or the utilization of the disks it uses
+is over a threshold."""
+
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from locbkp.utils.utils import logger
+
+ionice_classes = {
+    "idle": ["-c", "3"],
+    "best-effort": ["-c", "2", "-n", "7"]
+}
+# How often the adaptive mode looks at the load
+check_interval = 1
+default_max_disk_util_pct = 80
+# The adaptive mode never slows a backup down below this
+min_rate = 1024 * 1024
+# A compressor paused for this long runs for one interval, so the backup still finishes
+max_pause = 10
+diskstats_path = "/proc/diskstats"
+
+
+def get_priority_prefix(nice=None, ionice_class=None):
+    """Command prefix that runs a command with a lower CPU (nice) and IO (ionice) priority."""
+    prefix = []
+    if os.name == "nt":
+        return prefix
+    if ionice_class:
+        if ionice_class not in ionice_classes:
+            logger.warning("Unknown ionice class \"{}\". Known classes: {}".format(ionice_class,
+                                                                               ", ".join(ionice_classes)))
+        elif shutil.which("ionice") is None:
+            logger.warning("ionice is not found. IO priority will not be changed.")
+        else:
+            prefix.extend(["ionice"] + ionice_classes[ionice_class])
+    if nice:
+        if shutil.which("nice") is None:
+            logger.warning("nice is not found. CPU priority will not be changed.")
+        else:
+            prefix.extend(["nice", "-n", str(nice)])
+    return prefix
+
+
+def set_process_priority(nice=None, ionice_class=None):
+    """Lowers the priority of the current process. Used as the initializer of worker processes."""
+    if os.name == "nt":
+        return
+    if nice:
+        os.nice(nice)
+    if ionice_class in ionice_classes and shutil.which("ionice"):
+        subprocess.run(["ionice"] + ionice_classes[ionice_class] + ["-p", str(os.getpid())],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_devices(paths):
+    """(major, minor) of the block devices paths are on."""
+    devices = set()
+    for apath in paths:
+        try:
+            st_dev = os.stat(apath).st_dev
+        except OSError:
+            continue
+        devices.add((os.major(st_dev), os.minor(st_dev)))
+    return devices
+
+
+def read_io_ticks(devices):
+    """Milliseconds each of devices has spent doing IO, from /proc/diskstats. Devices that are not
+    there (network and virtual filesystems, not Linux) are left out."""
+    io_ticks = {}
+    if not devices:
+        return io_ticks
+    try:
+        with open(diskstats_path, "r") as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                device = (int(fields[0]), int(fields[1]))
+                if device in devices:
+                    io_ticks[device] = int(fields[12])
+    except (OSError, ValueError, IndexError):
+        pass
+    return io_ticks
+
+
+class Throttle:
+    """Shared by all threads of a backup. consume(size) is called for every size bytes read or
+    written and sleeps for as long as the rate requires: the bucket goes into debt, so threads
+    that take tokens at the same time wait one after another.
+
+    In the adaptive mode the rate is halved every interval the system is overloaded and grows
+    back by a quarter every interval it is not, up to the limit. Without a limit it starts from
+    the throughput the backup had and is lifted again once it reaches the best one seen."""
+
+    def __init__(self, rate_mb=None, adaptive=False, max_load=None, max_disk_util_pct=None, paths=()):
+        self.limit = rate_mb * 1024 * 1024 if rate_mb else None
+        self.rate = self.limit
+        self.adaptive = adaptive
+        self.max_load = max_load or os.cpu_count() or 1
+        self.max_disk_util_pct = max_disk_util_pct or default_max_disk_util_pct
+        self.devices = get_devices(paths) if adaptive else set()
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.last_fill = time.monotonic()
+        self.last_check = self.last_fill
+        self.io_ticks = read_io_ticks(self.devices)
+        self.bytes_since_check = 0
+        self.peak_rate = 0
+        self.overloaded = False
+        self.paused = {}
+        self.time_throttled = 0.0
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            if self.adaptive and now - self.last_check >= check_interval:
+                self.adapt(now)
+            self.bytes_since_check += size
+            if self.rate is None:
+                return
+            # Up to a second of unused bandwidth is kept for bursts
+            self.tokens = min(self.rate, self.tokens + (now - self.last_fill) * self.rate) - size
+            self.last_fill = now
+            if self.tokens >= 0:
+                return
+            delay = -self.tokens / self.rate
+            self.time_throttled += delay
+        time.sleep(delay)
+
+    def get_overload(self, elapsed):
+        """Why the system is overloaded, or None if it is not."""
+        io_ticks = read_io_ticks(self.devices)
+        previous, self.io_ticks = self.io_ticks, io_ticks
+        if hasattr(os, "getloadavg"):
+            load = os.getloadavg()[0]
+            if load > self.max_load:
+                return "load average {:.2f}".format(load)
+        for device, ticks in io_ticks.items():
+            if device not in previous:
+                continue
+            util = (ticks - previous[device]) / (elapsed * 1000) * 100
+            if util > self.max_disk_util_pct:
+                return "device {}:{} is {:.0f}% busy".format(device[0], device[1], util)
+
+    def adapt(self, now):
+        elapsed = now - self.last_check
+        throughput = self.bytes_since_check / elapsed
+        self.bytes_since_check = 0
+        self.last_check = now
+        if self.rate is None:
+            self.peak_rate = max(self.peak_rate, throughput)
+        overload = self.get_overload(elapsed)
+        if overload is not None:
+            base = self.rate if self.rate is not None else max(throughput, min_rate)
+            self.rate = max(min_rate, base / 2)
+            if not self.overloaded:
+                logger.info("System is overloaded ({}). Slowing down to {:.1f}Mb/s."
+                            .format(overload, self.rate / 1024 / 1024))
+        elif self.rate is not None and self.rate != self.limit:
+            self.rate *= 1.25
+            if self.limit is not None and self.rate >= self.limit:
+                self.rate = self.limit
+            elif self.limit is None and self.rate >= self.peak_rate:
+                self.rate = None
+        if self.overloaded and overload is None:
+            logger.info("System load is back to normal.")
+        self.overloaded = overload is not None
+
+    def is_overloaded(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_check >= check_interval:
+                self.adapt(now)
+            return self.overloaded
+
+    def pace(self, process):
+        """Called every interval while process runs: pauses it while the system is overloaded."""
+        if os.name == "nt" or not self.adaptive:
+            return
+        overloaded = self.is_overloaded()
+        paused_since = self.paused.get(process.pid)
+        if paused_since is None:
+            if overloaded and process.poll() is None:
+                process.send_signal(signal.SIGSTOP)
+                self.paused[process.pid] = time.monotonic()
+        elif not overloaded or time.monotonic() - paused_since >= max_pause:
+            self.resume(process)
+
+    def resume(self, process):
+        paused_since = self.paused.pop(process.pid, None)
+        if paused_since is None:
+            return
+        with self.lock:
+            self.time_throttled += time.monotonic() - paused_since
+        process.send_signal(signal.SIGCONT)
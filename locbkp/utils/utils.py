@@ -15,12 +15,19 @@
 #  along with this program; if not, write to the Free Software
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import hashlib
+import heapq
 import json
 import os
+import re
 import shutil
 import tempfile
 from stat import *
-from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_LIST, TYPE_DIRECTORY, TYPE_FILE
+from datetime import datetime
+
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_LIST, TYPE_DIRECTORY, TYPE_FILE, DATE_FORMAT, \
+    MODE_FULL, MODE_INCREMENTAL, MODE_DIFFERENTIAL, SHARD_INDEX_SUFFIX, MANIFEST_SUFFIX, \
+    CHECKSUM_SUFFIX
 import logging
 import sys
 _format = "%(asctime)s - [%(levelname)-7s] - {}: %(filename)32s:%(lineno)-3s | %(message)s"
@@ -32,17 +39,8 @@ default_logpath = os.path.join(tempfile.gettempdir(), "LocBkp.log")
 default_logger = None
 
 default_level = logging.INFO
-progress_bar_resolution_pct = {
-    1: 100,
-    2: 50,
-    20: 20,
-    100: 20,
-    300: 10,
-    500: 5,
-    1000: 1
-}
 
-wont_backup = []
+wont_backup = set()
 
 
 def get_stream_handlers(logpath, level=logging.INFO, format=default_format):
@@ -100,80 +98,96 @@ def getdebug():
 logger = get_logger()
 
 
-def closest_divisible(num, divby):
-    c1 = num - (num % divby)
-    c2 = (num + divby) - (num % divby)
-    if num - c1 > c2 - num:
-        return c2
-    else:
-        return c1
-
-
-def get_progress_bar_resolution(total_items):
-    if total_items == 0:
-        return 100
-    resolutions = progress_bar_resolution_pct.keys()
-    resolution = 1
-    for anumber in resolutions:
-        if total_items > anumber:
-            resolution = progress_bar_resolution_pct[resolution]
-    return resolution
-
-
-def progress_bar(current, total):
-    if total == 0:
-        return
-    cur_progress = current / total * 100
-    progress_one_percent = total / 100
-    resolution = get_progress_bar_resolution(total)
-    resolution_pct = int(progress_one_percent * resolution)
-    if resolution_pct == 0:
-        return
-    if current % resolution_pct  == 0:
-        logger.info("{}%".format(closest_divisible(int(cur_progress), resolution)))
-    return cur_progress
-
-
 def get_dir_size_mb(path):
     size = get_dir_size(path)
     return size / 1024 / 1024
 
 
-def stat_file(apath):
+def stat_file(apath, entry=None, errors=None):
     try:
+        if entry is not None:
+            return entry.stat()
         return os.stat(apath)
     except BaseException as e:
+        if errors is not None:
+            errors["stat"] += 1
         if apath not in wont_backup:
             logger.warning("Could not stat {}: {}. Will not back up.".format(apath, e.__class__.__name__))
-            wont_backup.append(apath)
+            wont_backup.add(apath)
         return
 
 
-def get_tree(apath, get_dirs=True):
-    result = []
-    try:
-        st = stat_file(apath)
-        if st is None:
-            return result
-        if get_dirs:
-            if S_ISDIR(st.st_mode):
-                result = [apath]
-                for name in os.listdir(apath):
-                    dirs = get_tree(apath+os.sep+name, get_dirs)
-                    if dirs is not None:
-                        result.extend(dirs)
-        else:
-            result = [apath]
-            if S_ISDIR(st.st_mode):
-                for name in os.listdir(apath):
-                    dirs = get_tree(apath+os.sep+name, get_dirs)
-                    if dirs is not None:
-                        result.extend(dirs)
-        return result
-    except BaseException as e:
-        logger.warning("Could not get tree for {}: {}. This file(dir) and everything inside "
-                       "(in case it is a dir) will not be backed up".format(apath, e.__class__.__name__))
-        return result
+def scan_tree(apath, files, dirs, visited=None, rules=None, errors=None):
+    """Walks apath once with os.scandir and records every regular file and directory found in
+    files/dirs (dicts of path -> os.stat_result, so dedup is O(1)). Returns the amount of bytes
+    in files that were not seen before. rules (utils.rules.Rules) are checked for everything
+    under apath before it is stat-ed: excluded directories are not entered. errors (a Counter)
+    counts paths that could not be stat-ed ("stat") or listed ("scan")."""
+    if visited is None:
+        visited = set()
+    added_size = 0
+    st = stat_file(apath, errors=errors)
+    if st is None:
+        return added_size
+    if not S_ISDIR(st.st_mode):
+        if S_ISREG(st.st_mode) and apath not in files:
+            files[apath] = st
+            added_size += st.st_size
+            parent = os.path.dirname(apath)
+            if parent and parent not in dirs:
+                parent_st = stat_file(parent)
+                if parent_st is not None:
+                    dirs[parent] = parent_st
+        return added_size
+    stack = [(apath, st, rules)]
+    while stack:
+        adir, dir_st, dir_rules = stack.pop()
+        if (dir_st.st_dev, dir_st.st_ino) in visited:
+            continue
+        visited.add((dir_st.st_dev, dir_st.st_ino))
+        if adir not in dirs:
+            dirs[adir] = dir_st
+        try:
+            with os.scandir(adir) as entries:
+                entries = list(entries)
+            if dir_rules is not None:
+                dir_rules = dir_rules.for_directory(adir, [entry.name for entry in entries])
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir and entry.path in files:
+                    continue
+                if dir_rules is not None and dir_rules.is_excluded(entry.path, is_dir):
+                    continue
+                entry_st = stat_file(entry.path, entry, errors)
+                if entry_st is None:
+                    continue
+                if is_dir:
+                    stack.append((entry.path, entry_st, dir_rules))
+                elif S_ISREG(entry_st.st_mode):
+                    if dir_rules is not None and dir_rules.is_excluded_file(entry.path, entry_st):
+                        continue
+                    files[entry.path] = entry_st
+                    added_size += entry_st.st_size
+        except BaseException as e:
+            if errors is not None:
+                errors["scan"] += 1
+            logger.warning("Could not get tree for {}: {}. This dir and everything inside "
+                           "will not be backed up".format(adir, e.__class__.__name__))
+    return added_size
+
+
+def scan_trees(paths, rules=None, errors=None):
+    """Single pass over all backup paths. Returns (files, dirs, total_size)."""
+    files = {}
+    dirs = {}
+    visited = set()
+    total_size = 0
+    for apath in paths:
+        total_size += scan_tree(apath, files, dirs, visited, rules, errors)
+    return files, dirs, total_size
 
 
 def validate_config(config):
@@ -197,7 +211,8 @@ def validate_config(config):
         if not os.path.exists(anitem):
             logger.warning("Path {} does not exist. Will not backup.".format(anitem))
         else:
-            newbkplist.append(anitem)
+            # Streaming runs 7z in the packing directory, where a relative path would not be found
+            newbkplist.append(os.path.abspath(anitem))
     logger.info("Config is at least semi-valid. Will proceed")
     config[BACKUP_LIST] = newbkplist
     return config
@@ -256,3 +271,129 @@ def files(path):
     for afile in os.listdir(path):
         if os.path.isfile(os.path.join(path, afile)):
             yield afile
+
+
+def hash_file(apath, blocksize=1024 * 1024, throttle=None):
+    try:
+        file_hash = hashlib.sha256()
+        with open(apath, "rb") as afile:
+            for block in iter(lambda: afile.read(blocksize), b""):
+                file_hash.update(block)
+                if throttle is not None:
+                    throttle.consume(len(block))
+        return file_hash.hexdigest()
+    except BaseException as e:
+        logger.warning("Could not hash {}: {}".format(apath, e.__class__.__name__))
+        return
+
+
+def write_checksums(checksums_path, checksums):
+    """Writes {filename: sha256} in the format of sha256sum, so it can be checked with sha256sum -c too."""
+    with open(checksums_path + ".tmp", "w", encoding="utf-8") as checksums_file:
+        for filename, file_hash in sorted(checksums.items()):
+            checksums_file.write("{}  {}\n".format(file_hash, filename))
+    os.replace(checksums_path + ".tmp", checksums_path)
+
+
+def read_checksums(checksums_path):
+    checksums = {}
+    with open(checksums_path, "r", encoding="utf-8") as checksums_file:
+        for line in checksums_file:
+            file_hash, _, filename = line.rstrip("\n").partition("  ")
+            if filename:
+                checksums[filename] = file_hash
+    return checksums
+
+
+backup_filename_suffixes = {}
+for extension in ("7z", "zip"):
+    backup_filename_suffixes.update({
+        "." + extension: MODE_FULL,
+        "_inc." + extension: MODE_INCREMENTAL,
+        "_diff." + extension: MODE_DIFFERENTIAL
+    })
+
+
+# Volumes ("name.7z.001"), shards ("name.7z.s001"), shard indexes ("name.7z.shards.json"),
+# manifests ("name.7z.manifest") and checksum files ("name.7z.sha256")
+archive_part_suffix = re.compile(r"\.(\d{3,}|s\d{3,}|" + re.escape(SHARD_INDEX_SUFFIX) + "|" +
+                                 re.escape(MANIFEST_SUFFIX) + "|" + re.escape(CHECKSUM_SUFFIX) + ")$")
+
+
+def split_archive_part(filename):
+    """Returns (archive name, part) for a file that is a part of a multi-file archive or
+    (filename, None)."""
+    match = archive_part_suffix.search(filename)
+    if match is None:
+        return filename, None
+    return filename[:match.start()], match.group(1)
+
+
+def archive_exists(directory, archive_name):
+    return any(os.path.exists(os.path.join(directory, apath)) for apath in
+               (archive_name, "{}.001".format(archive_name), "{}.{}".format(archive_name, SHARD_INDEX_SUFFIX)))
+
+
+def get_archive_parts(directory, archive_name, multipart):
+    """Files of an archive that are in directory: the archive, or its volumes or shards if multipart.
+    The first volume always goes last (see Backup.execute_7z_pipelined), as does the shard index,
+    which marks a complete shard set."""
+    if not multipart:
+        archive_path = sanitize_path(directory, archive_name)
+        return [archive_path] if os.path.exists(archive_path) else []
+    parts = []
+    for afile in os.listdir(directory):
+        name, part = split_archive_part(afile)
+        # The manifest is not a part of the archive, it is transferred separately
+        if name == archive_name and part not in (None, MANIFEST_SUFFIX, CHECKSUM_SUFFIX):
+            parts.append((part in ("001", SHARD_INDEX_SUFFIX), part, os.path.join(directory, afile)))
+    return [apart[2] for apart in sorted(parts)]
+
+
+def partition_by_size(items, parts):
+    """Splits (item, size) pairs into parts lists with sums of sizes as close as possible:
+    the biggest items go first, each to the currently smallest part."""
+    heap = [(0, num, []) for num in range(parts)]
+    for item, size in sorted(items, key=lambda x: x[1], reverse=True):
+        total, num, part = heapq.heappop(heap)
+        part.append(item)
+        heapq.heappush(heap, (total + size, num, part))
+    return [part for _, _, part in sorted(heap, key=lambda x: x[1])]
+
+
+def parse_backup_filename(filename, backup_name):
+    """Returns (date, mode) for an archive (or a volume of one) of backup_name or None if
+    filename is not one."""
+    if not filename.startswith(backup_name + "_"):
+        return
+    filename = split_archive_part(filename)[0]
+    for suffix, mode in backup_filename_suffixes.items():
+        if filename.endswith(suffix):
+            try:
+                return datetime.strptime(filename[len(backup_name) + 1:-len(suffix)], DATE_FORMAT), mode
+            except ValueError:
+                continue
+
+
+def get_backup_chains(filesindir, backup_name):
+    """Groups archives of backup_name into chains: a full backup followed by the incremental and
+    differential backups that depend on it. Archives without a full backup before them form
+    a chain of their own. Backups are (archive name, date, mode, files) sorted by date."""
+    backup_files = {}
+    for afile in filesindir:
+        parsed = parse_backup_filename(afile, backup_name)
+        if parsed is not None:
+            # All volumes, shards and the manifest of an archive are one backup
+            archive_name = split_archive_part(afile)[0]
+            backup_files.setdefault(archive_name, (archive_name, parsed[0], parsed[1], []))[3].append(afile)
+    return group_backup_chains(backup_files.values())
+
+
+def group_backup_chains(backups):
+    """Chains of (archive name, date, mode, files) backups."""
+    chains = []
+    for abackup in sorted(backups, key=lambda x: x[1]):
+        if abackup[2] == MODE_FULL or not chains:
+            chains.append([])
+        chains[-1].append(abackup)
+    return chains
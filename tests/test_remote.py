@@ -0,0 +1,158 @@
+#  LocBkp - a small backup script
+#  Copyright (C) 2022  Locchan <locchan@protonmail.com>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  (version 2) as published by the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""Remote destinations against the stand-in object server (utils.objectserver), served from a
+thread of the test process:
+
+    python3 -m unittest discover tests"""
+
+import __main__
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from locbkp.utils.utils import get_logger
+
+# The modules expect what the locbkp script defines
+__main__.version = "test"
+__main__.logger = get_logger(level=logging.WARNING, logpath=os.path.join(tempfile.gettempdir(), "LocBkp_test.log"),
+                             redefine_default=True)
+
+from locbkp.Backup import Backup
+from locbkp.utils.destination import ObjectStoreDestination, TransferError, min_part_size
+from locbkp.utils.dictionary import DESTINATION_DIRECTORY, BACKUP_LIST, BACKUP_NAME, RETENTION, \
+    COMPRESSION_ENGINE, ENGINE_ZIP, REMOTE_URL, UPLOAD_PART_MB, UPLOAD_RETRIES
+from locbkp.utils.objectserver import ObjectStoreHandler
+
+bucket = "bucket"
+
+
+def get_free_port():
+    with socket.socket() as asocket:
+        asocket.bind(("127.0.0.1", 0))
+        return asocket.getsockname()[1]
+
+
+class RemoteTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server_root = tempfile.mkdtemp(prefix="locbkp_objects_")
+        ObjectStoreHandler.root = cls.server_root
+        ObjectStoreHandler.fail_rate = 0.0
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ObjectStoreHandler)
+        cls.url = "http://127.0.0.1:{}/{}".format(cls.server.server_address[1], bucket)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.server_root, ignore_errors=True)
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp(prefix="locbkp_test_")
+        self.addCleanup(shutil.rmtree, self.work, True)
+
+    def get_destination(self, prefix):
+        return ObjectStoreDestination("{}/{}".format(self.url, prefix), os.path.join(self.work, "uploads"),
+                                      part_size=min_part_size, threads=2, retries=0)
+
+    def make_file(self, name, size):
+        apath = os.path.join(self.work, name)
+        with open(apath, "wb") as afile:
+            afile.write(os.urandom(size))
+        return apath
+
+    def assert_uploaded(self, prefix, name, local_path):
+        with open(os.path.join(self.server_root, bucket, prefix, name), "rb") as remote, \
+                open(local_path, "rb") as local:
+            self.assertEqual(hashlib.sha256(remote.read()).hexdigest(), hashlib.sha256(local.read()).hexdigest())
+
+    def test_multipart_upload(self):
+        local_path = self.make_file("archive.zip", min_part_size * 2 + 1000)
+        destination = self.get_destination("multipart")
+        destination.put(local_path, "archive.zip")
+        self.assert_uploaded("multipart", "archive.zip", local_path)
+        self.assertEqual(destination.list_files(), {"archive.zip": os.path.getsize(local_path)})
+        self.assertEqual(os.listdir(destination.state_directory), [])
+
+    def test_resume(self):
+        local_path = self.make_file("archive.zip", min_part_size * 3)
+        destination = self.get_destination("resume")
+        upload_body = destination.upload_body
+        uploaded_parts = []
+        failed = []
+
+        def failing_upload_body(method, key, query, body):
+            if query.get("partNumber") == "3" and not failed:
+                failed.append(query["partNumber"])
+                raise TransferError("Part 3 failed", 500)
+            uploaded_parts.append(query.get("partNumber"))
+            return upload_body(method, key, query, body)
+
+        destination.upload_body = failing_upload_body
+        with self.assertRaises(TransferError):
+            destination.put(local_path, "archive.zip")
+        self.assertEqual(len(os.listdir(destination.state_directory)), 1)
+        del uploaded_parts[:]
+        # Parts the server has are not sent again
+        destination.put(local_path, "archive.zip")
+        self.assertEqual(sorted(uploaded_parts), ["3"])
+        self.assert_uploaded("resume", "archive.zip", local_path)
+        self.assertEqual(os.listdir(destination.state_directory), [])
+
+    def write_backup_list(self, url, retention):
+        source = os.path.join(self.work, "source")
+        os.makedirs(source, exist_ok=True)
+        with open(os.path.join(source, "file"), "wb") as afile:
+            afile.write(os.urandom(1024))
+        destdir = os.path.join(self.work, "destination")
+        os.makedirs(destdir, exist_ok=True)
+        backup_list_path = os.path.join(self.work, "backup.json")
+        with open(backup_list_path, "w") as backup_list:
+            json.dump({DESTINATION_DIRECTORY: destdir, BACKUP_LIST: [source], BACKUP_NAME: "test",
+                       RETENTION: retention, COMPRESSION_ENGINE: ENGINE_ZIP, REMOTE_URL: url, UPLOAD_PART_MB: 5,
+                       UPLOAD_RETRIES: 0}, backup_list)
+        return backup_list_path
+
+    def test_retention(self):
+        backup_list_path = self.write_backup_list("{}/retention".format(self.url), 2)
+        for _ in range(3):
+            self.assertTrue(Backup(backup_list_path).start())
+            # Archive names have a resolution of a second
+            time.sleep(1.1)
+        self.assertEqual(len(os.listdir(os.path.join(self.server_root, bucket, "retention"))), 2)
+
+    def test_retention_unreachable(self):
+        backup_list_path = self.write_backup_list("http://127.0.0.1:{}/{}".format(get_free_port(), bucket), 1)
+        # The transfer fails, retention is skipped without failing the run any further
+        self.assertFalse(Backup(backup_list_path).start())
+
+
+if __name__ == "__main__":
+    unittest.main()